@@ -1,12 +1,55 @@
 import cv2
-from deepface import DeepFace as dp
+import threading
+from collections.abc import Mapping
 import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
-def extract_face(frame, relative_bounding_box):
-    #extracting face from the bound box detected by MP
+EMBEDDING_MODEL_NAME = "Facenet"
+# upper bound on the number of crops sent through the model in one forward pass
+EMBED_MAX_BATCH_SIZE = 32
+
+_model_lock = threading.Lock()
+# set by use_server: embeddings (and matching) are then done by a recognition_server instance
+_client = None
+
+def _deepface():
+    #DeepFace imports TensorFlow, which takes seconds, so it is only imported when first needed
+    from deepface import DeepFace
+    return DeepFace
+
+def use_server(url, timeout=5.0):
+    #Thin client mode: embed_face/embed_faces and warm_up go to the recognition server at url,
+    #TensorFlow and the model are never loaded in this process. Returns the RecognitionClient
+    global _client
+    from recognition_client import RecognitionClient
+    _client = RecognitionClient(url, timeout)
+    return _client
+
+def get_client():
+    #the RecognitionClient of thin client mode, None when embedding locally
+    return _client
+
+def load_model():
+    #Builds (once) and returns the embedding model; safe to call from a background thread
+    with _model_lock:
+        return _deepface().build_model(EMBEDDING_MODEL_NAME)
+
+def warm_up(batch_size=2):
+    #Runs a dummy batch through the model so that graph tracing and memory allocation
+    #happen at startup instead of stalling the first real recognition
+    if _client is not None:
+        status = _client.wait_until_ready()
+        logger.info(f"warm_up: using recognition server {_client.url} ({status['gallery']} embeddings)")
+        return
+    load_model()
+    dummy_faces = [np.zeros((224, 224, 3), dtype=np.uint8) for _ in range(batch_size)]
+    embed_faces(dummy_faces)
+    logger.info("warm_up: embedding model ready")
+
+def crop_face(frame, relative_bounding_box):
+    #cuts the face out of the frame at its native resolution (a view, not a copy)
     frame_height, frame_width,_ = frame.shape
     xmin = int(relative_bounding_box.xmin * frame_width)
     ymin = int(relative_bounding_box.ymin * frame_height)
@@ -19,22 +62,133 @@ def extract_face(frame, relative_bounding_box):
     xmax = min(frame_width, xmin + width)
     ymax = min(frame_height, ymin + height)
 
-    face = frame[ymin:ymax, xmin:xmax]
-    face_resized = cv2.resize(face, (224, 224))
-    bbox = relative_bounding_box
-    y_center = bbox.ymin + bbox.height / 2
-    x_center = bbox.xmin + bbox.width / 2
-    return face_resized
+    return frame[ymin:ymax, xmin:xmax]
 
-def embed_face(face_image):
-    embeddings = dp.represent(face_image, model_name = "Facenet", enforce_detection = False)
-    if not embeddings:
-        logger.warning("embed_face: no face detected")
+def extract_face(frame, relative_bounding_box):
+    #extracting face from the bound box detected by MP
+    face = crop_face(frame, relative_bounding_box)
+    if face.size == 0:
         return None
-    else:
-        logger.info("embed_face: face detected, embedding extracted")
-        embedding = embeddings[0]["embedding"]
-        return embedding
+    return resize_face(face)
+
+def resize_face(face):
+    return cv2.resize(face, (224, 224))
+
+# Face quality gate: crops scoring below QUALITY_THRESHOLD are not worth an embedding
+QUALITY_THRESHOLD = 0.5
+MIN_FACE_SIZE = 40 # pixels, smaller crops are rejected outright
+GOOD_FACE_SIZE = 112 # pixels, larger crops get the full size score
+GOOD_SHARPNESS = 100.0 # Laplacian variance of a sharp face crop
+MAX_YAW = 60.0 # degrees, faces turned further away are rejected
+
+def estimate_yaw(relative_keypoints):
+    #Rough head yaw in degrees from MediaPipe's face keypoints
+    #(0 right eye, 1 left eye, 2 nose tip, 3 mouth, 4 right ear tragion, 5 left ear tragion):
+    #a frontal face has its nose halfway between the ears. Returns None without keypoints
+    if relative_keypoints is None or len(relative_keypoints) < 6:
+        return None
+    nose_x = relative_keypoints[2].x
+    right_distance = abs(nose_x - relative_keypoints[4].x)
+    left_distance = abs(nose_x - relative_keypoints[5].x)
+    if right_distance + left_distance == 0:
+        return None
+    asymmetry = (left_distance - right_distance) / (left_distance + right_distance)
+    return float(np.degrees(np.arcsin(np.clip(asymmetry, -1.0, 1.0))))
+
+def sharpness(face):
+    #variance of the Laplacian, low for blurred crops
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def face_quality(face, detection_score=None, relative_keypoints=None):
+    #Scores a native-resolution crop (see crop_face) in [0, 1] from its pixel size, sharpness,
+    #estimated yaw and the detector confidence; the overall score is the geometric mean of the parts
+    #Returns {'score', 'size', 'sharpness', 'yaw', 'detection'} where the parts are the individual scores
+    if face is None or face.size == 0:
+        return {"score": 0.0, "size": 0.0, "sharpness": 0.0, "yaw": 0.0, "detection": 0.0}
+    face_size = min(face.shape[0], face.shape[1])
+    size_score = float(np.clip((face_size - MIN_FACE_SIZE) / (GOOD_FACE_SIZE - MIN_FACE_SIZE), 0.0, 1.0))
+    sharpness_score = float(np.clip(sharpness(face) / GOOD_SHARPNESS, 0.0, 1.0))
+    yaw = estimate_yaw(relative_keypoints)
+    yaw_score = 1.0 if yaw is None else float(np.clip(1.0 - abs(yaw) / MAX_YAW, 0.0, 1.0))
+    detection_score = 1.0 if detection_score is None else float(detection_score)
+    parts = (size_score, sharpness_score, yaw_score, detection_score)
+    return {
+        "score": float(np.prod(parts) ** (1.0 / len(parts))),
+        "size": size_score,
+        "sharpness": sharpness_score,
+        "yaw": yaw_score,
+        "detection": detection_score
+    }
+
+def update_best_faces(frame, face_tracker):
+    #scores the crop of every unrecognized track on a detection frame and keeps each track's best one,
+    #crops under the quality threshold never reach the embedding model.
+    #Tracks the detector missed on this frame are skipped: their box is only predicted (the face may be occluded
+    #or turned away) and their score and keypoints come from an older detection
+    for face_data in face_tracker.get_all_tracked_faces_data():
+        if face_data["name"] is None and face_data["bbox_relative"] and face_data["detected"]:
+            face = crop_face(frame, face_data["bbox_relative"])
+            quality = face_quality(face, face_data["score"], face_data["keypoints"])
+            if quality["score"] >= QUALITY_THRESHOLD:
+                face_tracker.offer_face(face_data["id"], face, quality["score"])
+
+def embed_face(face_image):
+    #Embedding of a single crop, None if it is empty. Goes through embed_faces, so single and batched
+    #embeddings get the same preprocessing, see _represent_input
+    return embed_faces([face_image])[0]
+
+# DeepFace.represent settings every stored embedding was made with (embed_face used to call it with
+# enforce_detection=False and the defaults otherwise): the crop is searched again with OpenCV's face detector and
+# aligned before it reaches the model. Skipping that step gives embeddings that no longer match the stored ones
+# the same way, and the enrollment photos are not kept to redo them
+REPRESENT_DETECTOR_BACKEND = "opencv"
+
+def _represent_input(face_image, target_size):
+    #model input DeepFace.represent builds for the first face it finds in the crop (the whole crop when it finds
+    #none), only the forward pass is left out so that embed_faces can batch it
+    from deepface.modules import detection, preprocessing
+    face_objs = detection.extract_faces(
+        img_path=face_image,
+        detector_backend=REPRESENT_DETECTOR_BACKEND,
+        grayscale=False,
+        enforce_detection=False,
+        align=True,
+        expand_percentage=0,
+    )
+    # extract_faces returns RGB, represent flips it back before resizing
+    face = face_objs[0]["face"][:, :, ::-1]
+    face = preprocessing.resize_image(img=face, target_size=target_size)
+    return preprocessing.normalize_input(img=face, normalization="base")
+
+def embed_faces(face_images, max_batch_size=EMBED_MAX_BATCH_SIZE):
+    #Embeds many face crops with one forward pass per max_batch_size crops.
+    #face_images is either a list of crops or a dict {track_id: crop}; the result has the same shape
+    #(list aligned with the input, or dict keyed by the same track ids), None for empty crops.
+    #Every crop is preprocessed as DeepFace.represent does it (re-detection, alignment, resize/padding, scaling),
+    #so the embeddings are comparable with the ones already stored; only the model calls are batched
+    if isinstance(face_images, Mapping):
+        keys = list(face_images.keys())
+        embeddings = embed_faces(list(face_images.values()), max_batch_size)
+        return dict(zip(keys, embeddings))
+    if _client is not None:
+        return _client.embed_faces(face_images)
+
+    embeddings = [None] * len(face_images)
+    valid_indices = [i for i, face in enumerate(face_images) if face is not None and face.size > 0]
+    if not valid_indices:
+        return embeddings
+
+    model = load_model()
+    target_width, target_height = model.input_shape
+    for start in range(0, len(valid_indices), max_batch_size):
+        batch_indices = valid_indices[start:start + max_batch_size]
+        batch = np.concatenate([_represent_input(face_images[i], (target_height, target_width)) for i in batch_indices])
+        batch_embeddings = model.model(batch, training=False).numpy()
+        for i, embedding in zip(batch_indices, batch_embeddings):
+            embeddings[i] = embedding
+    logger.debug(f"embed_faces: embedded {len(valid_indices)} faces in {-(-len(valid_indices) // max_batch_size)} batches")
+    return embeddings
 
 def cosine_similarity (embedding1, embedding2):
     dot_product = np.dot(embedding1, embedding2)
@@ -52,77 +206,76 @@ def compare_embeddings(embedding1, embedding2):
         return False
     similarity = cosine_similarity(embedding1, embedding2)
     distance = 1 - similarity
-    logger.info(f"Cosine similarity: {similarity:.4f}")
-    logger.info(f"Cosine distance: {distance:.4f}")
+    logger.debug(f"Cosine similarity: {similarity:.4f}")
+    logger.debug(f"Cosine distance: {distance:.4f}")
 
     # Using cosine distance
     if similarity > 0.6:
-        logger.info( "compare_embeddings: embeddings match")
+        logger.debug( "compare_embeddings: embeddings match")
         return True
     else:
-        logger.info( "compare_embeddings: embeddings do not match")
+        logger.debug( "compare_embeddings: embeddings do not match")
         return False
 
 
-def visualization_wrapper (frame, relative_bounding_box, img_test, saved_cropped = False):
-    cropped_face, x_center, y_center = extract_face(frame, relative_bounding_box)
-
-    if cropped_face is None or cropped_face.shape[0] < 100 or cropped_face.shape[1] < 100:
-        logger.warning("visualization_wrapper: cropped face is None or too small")
-        return
-
 def get_distance(embedding1, embedding2):
     if embedding1 is None or embedding2 is None:
         logger.warning("get_distance: one of the embeddings is None")
         return float('inf')
     distance = 1 - cosine_similarity(embedding1, embedding2)
-    logger.info(f"get_distance: Cosine distance: {distance:.4f}")
+    logger.debug(f"get_distance: Cosine distance: {distance:.4f}")
     return distance
 
-def detect_and_extract_face_from_image(full_image, detector_backend='mtcnn', target_size=(224, 224)):
+# reasons extract_single_face gives for not returning a face
+NO_FACE = "no_face"
+MULTIPLE_FACES = "multiple_faces"
+DETECTION_ERROR = "detection_error"
+
+def extract_single_face(full_image, detector_backend='mtcnn', target_size=(224, 224), min_confidence=0.8):
+    #Detects the faces in a photo and returns (face, None) when there is exactly one confident face,
+    #(None, reason) otherwise, with reason one of NO_FACE, MULTIPLE_FACES or DETECTION_ERROR.
+    #The face is a BGR uint8 crop, resized to target_size unless it is None
     if full_image is None:
-        logger.warning("detect_and_extract_face_from_image: full_image is None")
-        return None
+        return None, NO_FACE
     try:
-        extracted_res = dp.extract_faces(
+        extracted_res = _deepface().extract_faces(
             img_path=full_image,
             detector_backend=detector_backend,
             enforce_detection=False,
             align=True,
         )
-
-        print("extracted_res: ", extracted_res)
-
-        high_confidence_faces = [
-            face_data for face_data in extracted_res
-            if face_data['confidence'] >= 0.8
-        ]
-
-        if len(high_confidence_faces) == 0:
-            logger.warning("detect_and_extract_face_from_image: no face detected")
-            return None
-        elif len(high_confidence_faces) > 1:
-            # @TODO: We could try to get the largest face (?)
-            logger.warning("detect_and_extract_face_from_image: more than one face detected")
-            return None
-        else:
-            logger.info("detect_and_extract_face_from_image: one face detected")
-            face_data = high_confidence_faces[0]
-            face_img_raw = face_data["face"]
-
-            if face_img_raw.dtype == np.float32 or face_img_raw.dtype == np.float64:
-                 face_img_bgr = cv2.cvtColor((face_img_raw * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
-            elif len(face_img_raw.shape) == 3 and face_img_raw.shape[2] == 3:
-                 face_img_bgr = cv2.cvtColor(face_img_raw, cv2.COLOR_RGB2BGR)
-            else:
-                 face_img_bgr = face_img_raw
-            
-            if target_size:
-                face_img_resized = cv2.resize(face_img_bgr, target_size, interpolation=cv2.INTER_AREA)
-                return face_img_resized
-            else:
-                return face_img_bgr
     except Exception as e:
-        logger.error(f"detect_and_extract_face_from_image: error in face detection: {e}")
-        return None
+        logger.error(f"extract_single_face: error in face detection: {e}")
+        return None, DETECTION_ERROR
+
+    high_confidence_faces = [
+        face_data for face_data in extracted_res
+        if face_data['confidence'] >= min_confidence
+    ]
+    if len(high_confidence_faces) == 0:
+        return None, NO_FACE
+    if len(high_confidence_faces) > 1:
+        # @TODO: We could try to get the largest face (?)
+        return None, MULTIPLE_FACES
+
+    face_img_raw = high_confidence_faces[0]["face"]
+    if face_img_raw.dtype == np.float32 or face_img_raw.dtype == np.float64:
+        face_img_bgr = cv2.cvtColor((face_img_raw * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+    elif len(face_img_raw.shape) == 3 and face_img_raw.shape[2] == 3:
+        face_img_bgr = cv2.cvtColor(face_img_raw, cv2.COLOR_RGB2BGR)
+    else:
+        face_img_bgr = face_img_raw
+    if target_size:
+        face_img_bgr = cv2.resize(face_img_bgr, target_size, interpolation=cv2.INTER_AREA)
+    return face_img_bgr, None
 
+def detect_and_extract_face_from_image(full_image, detector_backend='mtcnn', target_size=(224, 224)):
+    if full_image is None:
+        logger.warning("detect_and_extract_face_from_image: full_image is None")
+        return None
+    face, reason = extract_single_face(full_image, detector_backend, target_size)
+    if face is None:
+        logger.warning(f"detect_and_extract_face_from_image: {reason.replace('_', ' ')}")
+        return None
+    logger.info("detect_and_extract_face_from_image: one face detected")
+    return face
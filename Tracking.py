@@ -1,16 +1,93 @@
 import cv2
 import time
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+class RelativeBoundingBox:
+    #Same fields as MediaPipe's relative_bounding_box, used for boxes predicted by the motion model
+    __slots__ = ("xmin", "ymin", "width", "height")
+
+    def __init__(self, xmin, ymin, width, height):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.width = width
+        self.height = height
+
+class BoxKalmanFilter:
+    #Constant-velocity Kalman filter over a box (center x, center y, width, height) in relative coordinates.
+    #State is the box plus its velocity per second; noise scales with the box height (as in SORT/DeepSORT)
+    #so small far-away faces and large close faces are treated alike.
+    #The noise weights are per frame of a REFERENCE_FPS camera and are rescaled by the elapsed time
+    REFERENCE_FPS = 30.0
+    STD_WEIGHT_POSITION = 1.0 / 20
+    STD_WEIGHT_VELOCITY = REFERENCE_FPS / 160
+
+    def __init__(self, relative_bounding_box, timestamp):
+        self.timestamp = timestamp
+        self.state = np.zeros(8)
+        self.state[:4] = _box_to_measurement(relative_bounding_box)
+        height = self.state[3]
+        std = np.array([2 * self.STD_WEIGHT_POSITION * height] * 4 + [10 * self.STD_WEIGHT_VELOCITY * height] * 4)
+        self.covariance = np.diag(np.square(std))
+        self.measurement_matrix = np.eye(4, 8)
+
+    def predict(self, timestamp):
+        #advances the state to timestamp and returns the predicted RelativeBoundingBox
+        dt = timestamp - self.timestamp
+        if dt > 0:
+            transition = np.eye(8)
+            transition[:4, 4:] = dt * np.eye(4)
+            height = self.state[3]
+            std = np.array([self.STD_WEIGHT_POSITION * height] * 4 + [self.STD_WEIGHT_VELOCITY * height] * 4)
+            # process noise grows with the number of reference frames elapsed since the last step
+            process_noise = np.diag(np.square(std)) * dt * self.REFERENCE_FPS
+            self.state = transition @ self.state
+            self.state[2:4] = np.maximum(self.state[2:4], 1e-4)
+            self.covariance = transition @ self.covariance @ transition.T + process_noise
+            self.timestamp = timestamp
+        return self.get_box()
+
+    def update(self, relative_bounding_box, timestamp):
+        #corrects the state with a detected box
+        self.predict(timestamp)
+        measurement = _box_to_measurement(relative_bounding_box)
+        height = self.state[3]
+        measurement_noise = np.diag(np.square([self.STD_WEIGHT_POSITION * height] * 4))
+        projected_covariance = self.measurement_matrix @ self.covariance @ self.measurement_matrix.T + measurement_noise
+        kalman_gain = self.covariance @ self.measurement_matrix.T @ np.linalg.inv(projected_covariance)
+        self.state = self.state + kalman_gain @ (measurement - self.measurement_matrix @ self.state)
+        self.covariance = (np.eye(8) - kalman_gain @ self.measurement_matrix) @ self.covariance
+
+    def get_box(self):
+        center_x, center_y, width, height = self.state[:4]
+        return RelativeBoundingBox(center_x - width / 2, center_y - height / 2, width, height)
+
+def _box_to_measurement(relative_bounding_box):
+    bb = relative_bounding_box
+    return np.array([bb.xmin + bb.width / 2, bb.ymin + bb.height / 2, bb.width, bb.height])
 
 class FaceAnnotation:
     #Represents a single tracked face and its associated annotation.
     #It stores the face's ID, current bounding box, and handles drawing the annotations
-    def __init__(self, identifier, initial_detection_data, frame_shape):
+    def __init__(self, identifier, initial_detection_data, frame_shape, timestamp=None):
         #identifier = unique ID for a specific tracked face
         #initial_detection_data (mediapipe.framework.formats.detection_pb2.Detection)
         #frame_shape = tuple containing (height, width, channels) at the time of initial detection
+        #timestamp = time of the detection, defaults to now
         self.id = identifier
         self.name = None
         self.text_to_display = f"ID: {self.id}"
+        #True while a crop of this face is queued or being processed by the recognition worker,
+        #so the same track is not submitted twice
+        self.recognition_pending = False
+        self.recognition_attempts = 0
+        #best-quality crop seen so far (see Recognition.face_quality) and whether it was sent to recognition yet
+        self.best_face = None
+        self.best_face_quality = 0.0
+        self.has_new_best_face = False
+        #detector confidence and keypoints of the last detection, used to score crop quality
+        self.detection_score = None
+        self.relative_keypoints = None
 
         #Stores MediaPipe's relative_bounding_box
         self.current_bounding_box_relative = None
@@ -20,16 +97,35 @@ class FaceAnnotation:
         self.last_seen_time = time.time()
         # stores the shape of the frame at the time of the last update to correctly calculate bbox
         self.frame_shape_at_last_update = frame_shape
+        #motion model used to predict the box on frames where detection is skipped
+        self.motion_model = None
 
         #initialize with the first detection data
-        self.update_detection_data(initial_detection_data, frame_shape)
+        self.update_detection_data(initial_detection_data, frame_shape, timestamp)
 
-    def update_detection_data(self, detection_data, frame_shape):
+    def update_detection_data(self, detection_data, frame_shape, timestamp=None):
         #Updates the face's data based on a new MediaPipe detection
+        if timestamp is None:
+            timestamp = time.time()
         self.current_bounding_box_relative= detection_data.location_data.relative_bounding_box
+        self.detection_score = detection_data.score[0] if detection_data.score else None
+        self.relative_keypoints = list(detection_data.location_data.relative_keypoints)
+        if self.motion_model is None:
+            self.motion_model = BoxKalmanFilter(self.current_bounding_box_relative, timestamp)
+        else:
+            self.motion_model.update(self.current_bounding_box_relative, timestamp)
         self.frame_shape_at_last_update = frame_shape
         self.update_absolute_bbox()
-        self.last_seen_time = time.time()
+        self.last_seen_time = timestamp
+
+    def predict(self, timestamp, frame_shape=None):
+        #Moves the box to where the motion model expects the face at timestamp (no detection involved)
+        if self.motion_model is None:
+            return
+        self.current_bounding_box_relative = self.motion_model.predict(timestamp)
+        if frame_shape is not None:
+            self.frame_shape_at_last_update = frame_shape
+        self.update_absolute_bbox()
     def update_absolute_bbox(self):
         if not self.current_bounding_box_relative or not self.frame_shape_at_last_update:
             self.current_bounding_box_abs = None
@@ -72,6 +168,18 @@ class FaceAnnotation:
         if text_position:
             cv2.putText(frame, self.text_to_display,text_position, cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
 
+    def offer_face(self, face, quality):
+        #keeps the crop if it is better than every crop seen so far
+        if quality > self.best_face_quality:
+            self.best_face = face.copy()
+            self.best_face_quality = quality
+            self.has_new_best_face = True
+
+    def take_best_face(self):
+        #returns the best crop and marks it as sent to recognition
+        self.has_new_best_face = False
+        return self.best_face
+
     def set_recognized_name(self, recognized_name):
         self.name = recognized_name
         if self.name:
@@ -112,6 +220,31 @@ def calculate_iou(box1_rel_bbox, box2_rel_bbox):
     iou = inter_area / union_area
     return iou
 
+def bbox_to_corners(relative_bounding_box):
+    #(xmin, ymin, xmax, ymax) of a relative bounding box
+    return (relative_bounding_box.xmin, relative_bounding_box.ymin,
+            relative_bounding_box.xmin + relative_bounding_box.width,
+            relative_bounding_box.ymin + relative_bounding_box.height)
+
+def calculate_iou_matrix(boxes1, boxes2):
+    #Vectorized IoU between every box of boxes1 (N x 4) and every box of boxes2 (M x 4),
+    #boxes given as (xmin, ymin, xmax, ymax) rows; returns an N x M matrix
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    xi1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    yi1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    xi2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    yi2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    inter_area = np.clip(xi2 - xi1, 0, None) * np.clip(yi2 - yi1, 0, None)
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union_area = area1[:, None] + area2[None, :] - inter_area
+
+    iou = np.zeros_like(inter_area)
+    np.divide(inter_area, union_area, out=iou, where=union_area > 0)
+    return iou
+
 class FaceTracker:
     #Manages multiple FaceAnnotation objects to track faces across frames
     #It uses IoU to match detections to existing tracks, assigns new IDs, and also removes tracks no longer seen
@@ -122,34 +255,35 @@ class FaceTracker:
         self.next_face_id = 0 #Iterator for new ID's
         self.iou_threshold = iou_threshold
         self.last_track_timeout = last_track_timeout
+        self.last_detection_time = None # timestamp of the latest update_tracks, None after a predict-only frame
 
-    def update_tracks(self, current_mp_detections, frame_shape):
-        current_time = time.time()
+    def update_tracks(self, current_mp_detections, frame_shape, timestamp=None):
+        #timestamp = capture time of the frame the detections come from, defaults to now
+        current_time = timestamp if timestamp is not None else time.time()
+        self.last_detection_time = current_time
         #in case of no detections
         if not current_mp_detections:
             current_mp_detections = []
+        #moving every track to its predicted position first, so fast faces still overlap their detection
+        for face_obj in self.tracked_faces.values():
+            face_obj.predict(current_time, frame_shape)
         matched_current_detection_indices = [False] * len(current_mp_detections) # initializes an array of the length and every element initialized with False
 
-        #attempting to match existing tracked_faces with current_detections
-        for face_id, face_obj in list(self.tracked_faces.items()):
-            best_match_idx = -1
-            max_iou_for_this_tracked_face = self.iou_threshold
-
-            for i, mp_detection in enumerate(current_mp_detections):
-                if not matched_current_detection_indices[i]:
-                    #ensuring we have a bounding box to compare with\
-                    if not matched_current_detection_indices[i]:
-                        if face_obj.current_bounding_box_relative:
-                            iou = calculate_iou(face_obj.current_bounding_box_relative, mp_detection.location_data.relative_bounding_box)
-
-                        if iou > max_iou_for_this_tracked_face:
-                            max_iou_for_this_tracked_face = iou
-                            best_match_idx = i
-
-            if best_match_idx != -1:
-                #found a match: update the FaceAnnotation object
-                face_obj.update_detection_data(current_mp_detections[best_match_idx], frame_shape)
-                matched_current_detection_indices[best_match_idx] = True
+        #attempting to match existing tracked_faces with current_detections:
+        #IoU between every track and every detection in one call, then a globally optimal assignment
+        track_ids = [face_id for face_id, face_obj in self.tracked_faces.items() if face_obj.current_bounding_box_relative]
+        if track_ids and current_mp_detections:
+            track_boxes = [bbox_to_corners(self.tracked_faces[face_id].current_bounding_box_relative) for face_id in track_ids]
+            detection_boxes = [bbox_to_corners(mp_detection.location_data.relative_bounding_box) for mp_detection in current_mp_detections]
+            iou = calculate_iou_matrix(track_boxes, detection_boxes)
+            #pairs below the threshold can never match, so they must not steer the assignment
+            iou[iou <= self.iou_threshold] = 0.0
+            track_indices, detection_indices = linear_sum_assignment(iou, maximize=True)
+            for track_idx, detection_idx in zip(track_indices, detection_indices):
+                if iou[track_idx, detection_idx] > self.iou_threshold:
+                    #found a match: update the FaceAnnotation object
+                    self.tracked_faces[track_ids[track_idx]].update_detection_data(current_mp_detections[detection_idx], frame_shape, current_time)
+                    matched_current_detection_indices[detection_idx] = True
         #Adding any new unmatched detections in tracked_faces
         for i, mp_detection in enumerate(current_mp_detections):
             if not matched_current_detection_indices[i]:
@@ -157,7 +291,31 @@ class FaceTracker:
                 self.next_face_id += 1
                 self.tracked_faces[new_id] = FaceAnnotation(identifier=new_id,
                                                             initial_detection_data=mp_detection,
-                                                            frame_shape=frame_shape)
+                                                            frame_shape=frame_shape,
+                                                            timestamp=current_time)
+        self.remove_expired_tracks(current_time)
+
+    def predict_tracks(self, frame_shape=None, timestamp=None):
+        #Predict-only update for frames on which the detector is not run:
+        #boxes follow the motion model, tracks are not refreshed and still expire after last_track_timeout
+        current_time = timestamp if timestamp is not None else time.time()
+        self.last_detection_time = None
+        for face_obj in self.tracked_faces.values():
+            face_obj.predict(current_time, frame_shape)
+        self.remove_expired_tracks(current_time)
+
+    def get_predicted_boxes(self, frame_shape=None, timestamp=None):
+        #boxes of all tracks moved to where the motion model expects them at timestamp,
+        #i.e. where a region detector should look for the tracked faces
+        current_time = timestamp if timestamp is not None else time.time()
+        boxes = []
+        for face_obj in self.tracked_faces.values():
+            face_obj.predict(current_time, frame_shape)
+            if face_obj.current_bounding_box_relative:
+                boxes.append(face_obj.current_bounding_box_relative)
+        return boxes
+
+    def remove_expired_tracks(self, current_time):
         #Removing tracks that have not been seen for a timeout period
         for face_id, face_obj in list(self.tracked_faces.items()):
             if current_time - face_obj.last_seen_time > self.last_track_timeout:
@@ -178,17 +336,63 @@ class FaceTracker:
         if face_obj:
             face_obj.set_recognized_name(name)
 
+    def set_recognition_pending(self, face_id, pending):
+        #returns False if the track no longer exists (e.g. it expired while being recognized)
+        face_obj = self.get_face_annotation(face_id)
+        if not face_obj:
+            return False
+        face_obj.recognition_pending = pending
+        if pending:
+            face_obj.recognition_attempts += 1
+        return True
+
+    def offer_face(self, face_id, face, quality):
+        face_obj = self.get_face_annotation(face_id)
+        if face_obj:
+            face_obj.offer_face(face, quality)
+
+    def take_best_face(self, face_id):
+        face_obj = self.get_face_annotation(face_id)
+        return face_obj.take_best_face() if face_obj else None
+
+    def count_unrecognized(self):
+        #returns (tracks never sent to recognition, tracks sent before that are still unrecognized),
+        #only counting tracks with a better crop than the one last sent and not currently being recognized
+        new_faces = 0
+        retry_faces = 0
+        for face_obj in self.tracked_faces.values():
+            if face_obj.name is None and not face_obj.recognition_pending and face_obj.has_new_best_face:
+                if face_obj.recognition_attempts == 0:
+                    new_faces += 1
+                else:
+                    retry_faces += 1
+        return new_faces, retry_faces
+
+    def get_motion_level(self):
+        #mean speed of the tracked face centers (relative frame units per second), 0 without tracks
+        speeds = [np.hypot(*face_obj.motion_model.state[4:6]) for face_obj in self.tracked_faces.values()
+                  if face_obj.motion_model is not None]
+        return float(np.mean(speeds)) if speeds else 0.0
+
     def get_all_tracked_faces_data(self):
         #returns a list of dictionaries each containing the data for the tracke face
         #will use for face recognition (deepface)
-        #each dict will contain : {'id': face_id, 'bbox_relative' : face_obj.current_bounding_box_relative}
+        #each dict will contain : {'id': face_id, 'bbox_relative' : face_obj.current_bounding_box_relative, 'name': ..., 'pending': ...,
+        #                          'score': ..., 'keypoints': ..., 'has_new_best_face': ..., 'detected': ...}
+        #detected is True when the track was matched by a detection in the latest update_tracks; otherwise its box is
+        #a motion prediction and score/keypoints belong to an older detection
         faces_data = []
         for face_id, face_obj in self.tracked_faces.items():
             if face_obj.current_bounding_box_relative:
                 faces_data.append({
                     'id':face_id,
                     'bbox_relative': face_obj.current_bounding_box_relative,
-                    'name':face_obj.name # none if not recognized
+                    'name':face_obj.name, # none if not recognized
+                    'pending':face_obj.recognition_pending,
+                    'score':face_obj.detection_score,
+                    'keypoints':face_obj.relative_keypoints,
+                    'has_new_best_face':face_obj.has_new_best_face,
+                    'detected':self.last_detection_time is not None and face_obj.last_seen_time == self.last_detection_time
                 })
         return faces_data
 
@@ -0,0 +1,130 @@
+import os
+import logging
+import zipfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class IVFIndex:
+    #Inverted-file (IVF) approximate nearest-neighbour index over the rows of the EmbeddedDb gallery matrix.
+    #Rows are clustered with spherical k-means, every cluster keeps the list of row ids assigned to it,
+    #and a query only scans the rows of its nprobe closest clusters.
+    #nprobe is the recall/latency knob: nprobe == nlist is an exact scan, smaller values are faster.
+    FORMAT_VERSION = 2
+
+    def __init__(self, nlist=None, nprobe=8, kmeans_iterations=10, seed=0):
+        #nlist = number of clusters, chosen from the gallery size at training time if None
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.trained_count = 0 # gallery size when the clusters were last trained
+        self.count = 0 # number of gallery rows covered by the index
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, matrix):
+        #(Re)builds the clusters and inverted lists from the normalized gallery rows
+        count = len(matrix)
+        nlist = self.nlist or int(np.clip(4 * np.sqrt(count), 1, 4096))
+        nlist = min(nlist, count)
+        rng = np.random.default_rng(self.seed)
+        sample = matrix
+        if count > 256 * nlist:
+            sample = matrix[rng.choice(count, 256 * nlist, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            assignment = _nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            sizes = np.bincount(assignment, minlength=nlist)
+            empty = sizes == 0
+            if empty.any():
+                #re-seed empty clusters with random points
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids.astype(np.float32)
+        self.lists = [np.empty(0, dtype=np.int32) for _ in range(nlist)]
+        self.trained_count = count
+        self.count = 0
+        self.add(matrix, 0)
+        logger.info(f"IVFIndex: trained {nlist} clusters over {count} embeddings")
+
+    def add(self, rows, start_row):
+        #Assigns new gallery rows (starting at start_row) to their nearest cluster
+        if not len(rows):
+            return
+        assignment = _nearest(rows, self.centroids)
+        row_ids = np.arange(start_row, start_row + len(rows), dtype=np.int32)
+        for cluster in np.unique(assignment):
+            self.lists[cluster] = np.concatenate((self.lists[cluster], row_ids[assignment == cluster]))
+        self.count = start_row + len(rows)
+
+    def needs_retraining(self):
+        #clusters trained on a much smaller gallery become unbalanced, so retrain once the gallery doubled
+        return self.count > 2 * self.trained_count
+
+    def candidates(self, queries, nprobe=None):
+        #Returns, for every normalized query, the gallery rows stored in its nprobe closest clusters
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_similarities = queries @ self.centroids.T
+        if nprobe < len(self.centroids):
+            probes = np.argpartition(-centroid_similarities, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(len(self.centroids)), (len(queries), nprobe))
+        return [np.concatenate([self.lists[cluster] for cluster in row]) for row in probes]
+
+    def save(self, path, fingerprint):
+        #fingerprint = identifies the gallery rows, in order, the index was built over (see EmbeddedDb._ann_fingerprint).
+        #Written to a temporary file and renamed, other processes sharing the path never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=self.FORMAT_VERSION,
+                centroids=self.centroids,
+                list_sizes=np.array([len(rows) for rows in self.lists], dtype=np.int64),
+                list_rows=np.concatenate(self.lists) if self.lists else np.empty(0, dtype=np.int32),
+                trained_count=self.trained_count,
+                count=self.count,
+                fingerprint=fingerprint,
+                nprobe=self.nprobe,
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path, count, fingerprint):
+        #Loads a persisted index, returns False if it is missing, unreadable or was built over other gallery rows
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                if int(data["version"]) != self.FORMAT_VERSION:
+                    return False
+                if int(data["count"]) != count or str(data["fingerprint"]) != fingerprint:
+                    return False
+                self.centroids = data["centroids"]
+                self.lists = np.split(data["list_rows"], np.cumsum(data["list_sizes"])[:-1])
+                self.trained_count = int(data["trained_count"])
+                self.count = count
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            logger.warning(f"IVFIndex: could not load {path}: {e}")
+            return False
+        return True
+
+def _nearest(vectors, centroids, chunk_size=16384):
+    #index of the most similar centroid for every (normalized) vector, computed in chunks to bound memory
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        assignment[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignment
+
+def normalize_rows(vectors):
+    #scales every row to unit L2 norm, zero rows are left as they are
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+import Tracking
+import Recognition
+from embedded_db import EmbeddedDb
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+#Reproducible timing of the recognition pipeline hot path, without camera or GPU.
+#Every stage runs on synthetic inputs (random gallery, moving synthetic faces, generated video clip),
+#results are written as JSON with percentiles and compared against a stored baseline.
+#A baseline is only compared with a run of the same configuration (gallery size, faces, resolution, ...) on the
+#same platform; timings of another setup say nothing about a regression.
+#    python benchmark.py --save-baseline          # record benchmark_baseline.json
+#    python benchmark.py                          # compare against it: exit code 1 on regression,
+#                                                 # 2 when the baseline is missing or was recorded differently
+#    python benchmark.py --no-compare             # only measure
+#The committed benchmark_baseline.json is a reference run (see its "platform"), other machines record their own.
+
+STAGES = ["video_decode", "extract_face", "embed_face", "embed_faces", "gallery_search", "gallery_search_batch",
+          "update_tracks", "draw_annotations", "gui_frame_conversion"]
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# settings that change what a stage measures, a baseline must have been recorded with the same values
+# (repeat, warmup, tolerance and the selected stages do not)
+COMPARED_CONFIG = ("gallery_size", "embeddings_per_student", "dim", "faces", "width", "height", "clip_frames", "seed")
+
+_qt_app = None # kept alive for the gui stage
+
+class SyntheticDetectionStream:
+    #Faces drifting slowly across the frame, returned in the same shape as MediaPipe detections
+    def __init__(self, num_faces, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.sizes = self.rng.uniform(0.04, 0.12, num_faces)
+        self.positions = self.rng.uniform(0.0, 1.0 - self.sizes[:, None], (num_faces, 2))
+        self.velocities = self.rng.normal(0.0, 0.002, (num_faces, 2))
+
+    def next(self):
+        self.positions = np.clip(self.positions + self.velocities, 0.0, 1.0 - self.sizes[:, None])
+        return [make_detection(x, y, size, size) for (x, y), size in zip(self.positions, self.sizes)]
+
+def make_detection(xmin, ymin, width, height, score=0.9):
+    keypoints = [SimpleNamespace(x=xmin + width * kx, y=ymin + height * ky)
+                 for kx, ky in ((0.3, 0.35), (0.7, 0.35), (0.5, 0.55), (0.5, 0.75), (0.05, 0.45), (0.95, 0.45))]
+    return SimpleNamespace(
+        score=[score],
+        location_data=SimpleNamespace(
+            relative_bounding_box=SimpleNamespace(xmin=xmin, ymin=ymin, width=width, height=height),
+            relative_keypoints=keypoints
+        )
+    )
+
+def synthetic_frame(rng, height, width):
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+def load_synthetic_gallery(num_students, embeddings_per_student, dim, rng):
+    EmbeddedDb.embedded_db.clear()
+    for student in range(num_students):
+        EmbeddedDb.embedded_db[f"student_{student}"] = {
+            "group": f"group_{student % 50}",
+            "embeddings": list(rng.standard_normal((embeddings_per_student, dim)).astype(np.float32))
+        }
+    EmbeddedDb.rebuild_matrix()
+
+def generate_clip(path, rng, frames, height, width, fps=30):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    base = synthetic_frame(rng, height, width)
+    for i in range(frames):
+        writer.write(np.roll(base, i * 4, axis=1))
+    writer.release()
+
+def time_stage(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000.0)
+    return durations
+
+def summarize(durations):
+    values = np.asarray(durations)
+    return {
+        "runs": len(values),
+        "mean_ms": float(values.mean()),
+        "min_ms": float(values.min()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+def build_stages(args, rng):
+    #returns {stage name: zero-argument callable timing one iteration}
+    frame = synthetic_frame(rng, args.height, args.width)
+    stream = SyntheticDetectionStream(args.faces, args.seed)
+    detections = stream.next()
+    boxes = [detection.location_data.relative_bounding_box for detection in detections]
+    face = Recognition.extract_face(frame, boxes[0])
+    faces = [Recognition.extract_face(frame, box) for box in boxes]
+    query = rng.standard_normal(args.dim).astype(np.float32)
+    queries = rng.standard_normal((args.faces, args.dim)).astype(np.float32)
+
+    canvas = frame.copy()
+    tracker = Tracking.FaceTracker()
+    tracker.update_tracks(detections, frame.shape, 0.0)
+    clock = {"t": 0.0}
+    def update_tracks():
+        clock["t"] += 1 / 30
+        tracker.update_tracks(stream.next(), frame.shape, clock["t"])
+
+    clip_path = os.path.join(tempfile.mkdtemp(prefix="mpface_bench_"), "clip.avi")
+    generate_clip(clip_path, rng, args.clip_frames, args.height, args.width)
+    capture = {"cap": cv2.VideoCapture(clip_path)}
+    def video_decode():
+        ret, _ = capture["cap"].read()
+        if not ret:
+            capture["cap"].release()
+            capture["cap"] = cv2.VideoCapture(clip_path)
+            capture["cap"].read()
+
+    stages = {
+        "video_decode": video_decode,
+        "extract_face": lambda: [Recognition.extract_face(frame, box) for box in boxes],
+        "embed_face": lambda: Recognition.embed_face(face),
+        "embed_faces": lambda: Recognition.embed_faces(faces),
+        "gallery_search": lambda: EmbeddedDb.search(query, k=1),
+        "gallery_search_batch": lambda: EmbeddedDb.search_batch(queries, k=1),
+        "update_tracks": update_tracks,
+        "draw_annotations": lambda: tracker.draw_annotations(canvas),
+    }
+    if "gui_frame_conversion" in args.stages:
+        global _qt_app
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt5.QtCore import QSize
+        from PyQt5.QtWidgets import QApplication
+        from gui import frame_to_pixmap
+        _qt_app = QApplication.instance() or QApplication(sys.argv[:1])
+        label_size = QSize(960, 720)
+        stages["gui_frame_conversion"] = lambda: frame_to_pixmap(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), label_size)
+    return stages
+
+def platform_info():
+    return {"python": ".".join(platform.python_version_tuple()[:2]), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "numpy": np.__version__, "opencv": cv2.__version__}
+
+def config_differences(results, baseline):
+    #settings of the baseline run that differ from this run, as "name: baseline -> this run"
+    differences = []
+    for section, keys in (("config", COMPARED_CONFIG), ("platform", tuple(results["platform"]))):
+        reference = baseline.get(section, {})
+        for key in keys:
+            if reference.get(key) != results[section].get(key):
+                differences.append(f"{key}: {reference.get(key)!r} -> {results[section].get(key)!r}")
+    return differences
+
+def compare(results, baseline, tolerance):
+    #returns the stages whose median got slower than the baseline by more than tolerance (a fraction)
+    regressions = []
+    for stage, summary in results["stages"].items():
+        reference = baseline.get("stages", {}).get(stage)
+        if reference is None:
+            continue
+        ratio = summary["p50_ms"] / reference["p50_ms"] if reference["p50_ms"] > 0 else 1.0
+        summary["baseline_p50_ms"] = reference["p50_ms"]
+        summary["ratio_to_baseline"] = ratio
+        if ratio > 1.0 + tolerance:
+            regressions.append(stage)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recognition pipeline on synthetic data")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--gallery-size", type=int, default=5000, help="number of synthetic students")
+    parser.add_argument("--embeddings-per-student", type=int, default=2)
+    parser.add_argument("--dim", type=int, default=128, help="embedding size (Facenet: 128)")
+    parser.add_argument("--faces", type=int, default=30, help="faces per synthetic frame")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--clip-frames", type=int, default=60, help="length of the generated video clip")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--no-compare", action="store_true", help="only measure, do not compare against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown of the median before failing")
+    args = parser.parse_args(argv)
+
+    setup_logger()
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "baseline", "save_baseline", "no_compare")},
+        "platform": platform_info(),
+        "stages": {}
+    }
+    # checked before measuring, a comparison that can not be made fails right away
+    baseline = None
+    if not args.save_baseline and not args.no_compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}: record one with --save-baseline or run with --no-compare", file=sys.stderr)
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differences = config_differences(results, baseline)
+        if differences:
+            print(f"{args.baseline} was recorded with a different setup, not comparing ({'; '.join(differences)}). "
+                  f"Record a baseline for this setup with --save-baseline", file=sys.stderr)
+            return 2
+
+    rng = np.random.default_rng(args.seed)
+    load_synthetic_gallery(args.gallery_size, args.embeddings_per_student, args.dim, rng)
+    stages = build_stages(args, rng)
+    for stage in args.stages:
+        results["stages"][stage] = summarize(time_stage(stages[stage], args.repeat, args.warmup))
+        print(f"{stage:>22}: p50 {results['stages'][stage]['p50_ms']:8.3f} ms   p99 {results['stages'][stage]['p99_ms']:8.3f} ms", file=sys.stderr)
+
+    exit_code = 0
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        results["regressions"] = regressions
+        missing = [stage for stage in results["stages"] if stage not in baseline.get("stages", {})]
+        if missing:
+            results["not_in_baseline"] = missing
+            print(f"Not in {args.baseline}, not compared: {', '.join(missing)}", file=sys.stderr)
+        if regressions:
+            print(f"Regressions against {args.baseline}: {', '.join(regressions)}", file=sys.stderr)
+            exit_code = 1
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import os
+import cv2
+import time
+import logging
+import threading
+from collections import deque
+
+import metrics
+from frame_pool import FramePool
+
+logger = logging.getLogger(__name__)
+
+class FrameGrabber:
+    #Reads frames from a cv2.VideoCapture source on its own thread into a small ring buffer.
+    #When the buffer is full the oldest frame is dropped, so read() always hands out the freshest frame
+    #and the processing loop never works on frames that piled up while it was busy.
+    #Video files are decoded at their own frame rate, as if they were a live camera
+    def __init__(self, source=0, buffer_size=2, frame_event=None):
+        #source = camera index or video path, anything cv2.VideoCapture accepts
+        #buffer_size = number of frames kept, bounds the latency between capture and processing
+        #frame_event = optional threading.Event set whenever a frame arrives or the source ends,
+        #lets a consumer polling several grabbers wait for any of them
+        self.source = source
+        self.capture = cv2.VideoCapture(source)
+        # keep the driver-side queue as short as possible, buffering happens here
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.frame_event = frame_event
+        # a file can be decoded much faster than real time, it is paced to its frame rate instead
+        self.frame_interval = None
+        if isinstance(source, str) and os.path.isfile(source):
+            fps = self.capture.get(cv2.CAP_PROP_FPS)
+            self.frame_interval = 1.0 / (fps if fps and fps > 0 else 30.0)
+        self._buffer = deque(maxlen=buffer_size) # (frame, capture timestamp)
+        self._condition = threading.Condition()
+        self._running = False
+        self._finished = False
+        self._thread = None
+        # frames are decoded into recycled arrays, the consumer hands them back with recycle()
+        self.pool = FramePool("capture", size=buffer_size + 2)
+        self._frame_shape = None
+        self.frames_captured = 0
+        self.dropped_frames = 0 # frames captured but never returned by read()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"capture-{self.source}", daemon=True)
+        self._thread.start()
+        return self
+
+    def isOpened(self):
+        #True while the source is open or there are still buffered frames to hand out
+        with self._condition:
+            return not self._finished or bool(self._buffer)
+
+    def read(self, timeout=1.0):
+        #Waits for a frame newer than the last one returned and returns (ret, frame, capture_timestamp).
+        #ret is False once the source stopped delivering frames or nothing arrived within timeout,
+        #timeout=0 returns at once (see isOpened to tell both apart)
+        with self._condition:
+            if not self._buffer and not self._finished and timeout > 0:
+                self._condition.wait(timeout)
+            if not self._buffer:
+                return False, None, None
+            frame, timestamp = self._buffer.pop()
+            # whatever is left is older than the frame we hand out
+            self.dropped_frames += len(self._buffer)
+            metrics.FRAMES_DROPPED.inc(len(self._buffer))
+            for dropped_frame, _ in self._buffer:
+                self.pool.release(dropped_frame)
+            self._buffer.clear()
+            return True, frame, timestamp
+
+    def recycle(self, frame):
+        #returns a frame obtained from read() once nothing refers to it anymore, its array is reused for a later frame
+        self.pool.release(frame)
+
+    def release(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.capture.release()
+
+    def _run(self):
+        start = time.monotonic()
+        frame_index = 0
+        while self._running:
+            if self.frame_interval is not None:
+                # frame n of the file is due n frame intervals after the first one
+                delay = start + frame_index * self.frame_interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                frame_index += 1
+            buffer = self.pool.acquire(self._frame_shape) if self._frame_shape else None
+            ret, frame = self.capture.read(buffer) if buffer is not None else self.capture.read()
+            timestamp = time.time()
+            if frame is not buffer:
+                # first frame or the resolution changed, OpenCV allocated a new array
+                self.pool.release(buffer)
+                if ret:
+                    self._frame_shape = frame.shape
+            with self._condition:
+                if not ret:
+                    logger.warning(f"FrameGrabber: source {self.source} stopped delivering frames")
+                    self._finished = True
+                    self._condition.notify_all()
+                    self._signal()
+                    return
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.dropped_frames += 1
+                    metrics.FRAMES_DROPPED.inc()
+                    self.pool.release(self._buffer[0][0])
+                self._buffer.append((frame, timestamp))
+                self.frames_captured += 1
+                metrics.FRAMES_CAPTURED.inc()
+                self._condition.notify_all()
+            self._signal()
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+        self._signal()
+
+    def _signal(self):
+        if self.frame_event is not None:
+            self.frame_event.set()
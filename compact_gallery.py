@@ -0,0 +1,55 @@
+import sys
+import json
+import logging
+import argparse
+
+from embedded_db import EmbeddedDb, MATCH_THRESHOLD
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+#Compaction job: replaces the embeddings of students with many captures by a few prototypes per student
+#(the embeds stay in the database) and reports recognition accuracy before and after. Safe to run periodically,
+#e.g. nightly from cron; stations pick the prototypes up on their next start.
+#    python compact_gallery.py --max-prototypes 4
+#    python compact_gallery.py --dry-run            # accuracy of the current gallery only
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact the gallery into per-student prototypes")
+    parser.add_argument("--max-prototypes", type=int, default=4, help="prototypes kept per student")
+    parser.add_argument("--outlier-distance", type=float, default=0.3,
+                        help="cosine distance to the centroid beyond which a capture is kept as its own prototype")
+    parser.add_argument("--min-embeds", type=int, help="only compact students with more embeds than this (default: --max-prototypes)")
+    parser.add_argument("--threshold", type=float, default=MATCH_THRESHOLD)
+    parser.add_argument("--queries", type=int, default=1000, help="perturbed captures used to measure accuracy")
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--dry-run", action="store_true", help="only report the accuracy of the current gallery")
+    parser.add_argument("--output", help="write the JSON report here as well")
+    args = parser.parse_args(argv)
+
+    setup_logger()
+    EmbeddedDb.populate_db()
+    if EmbeddedDb.size() == 0:
+        logger.error("compact_gallery: the gallery is empty")
+        return 1
+    # the same captures are matched before and after, drawn from the gallery as it is now
+    queries, names = EmbeddedDb.sample_queries(args.queries, args.noise)
+    report = {"before": EmbeddedDb.recognition_accuracy(queries, names, args.threshold)}
+    if not args.dry_run:
+        report["compacted"] = EmbeddedDb.compact(args.max_prototypes, args.outlier_distance, args.min_embeds)
+        report["after"] = EmbeddedDb.recognition_accuracy(queries, names, args.threshold)
+
+    for stage in ("before", "after"):
+        if stage in report:
+            result = report[stage]
+            print(f"{stage:>7}: {result['gallery_rows']:8d} rows  accuracy {100 * result['accuracy']:6.2f}%  "
+                  f"false accepts {100 * result['false_accepts']:5.2f}%  rejected {100 * result['rejected']:5.2f}%", file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
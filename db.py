@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, LargeBinary
+import json
+import hashlib
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, LargeBinary, func, select, insert, text
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
 Base = declarative_base()   
@@ -8,7 +10,8 @@ class Student(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     group = Column(String, nullable=False)
-    embeds = relationship("Embed", back_populates="student", cascade="all, delete-orphan")
+    embeds = relationship("Embed", back_populates="student", cascade="all, delete-orphan", order_by="Embed.id")
+    prototypes = relationship("Prototype", back_populates="student", cascade="all, delete-orphan", order_by="Prototype.id")
 
 class Embed(Base):
     __tablename__ = 'embeds'
@@ -17,10 +20,57 @@ class Embed(Base):
     embedding = Column(LargeBinary, nullable=False)
     student = relationship("Student", back_populates="embeds")
 
-engine = create_engine('sqlite:///db.sqlite')
+class Prototype(Base):
+    #Compacted embeddings of a student (see EmbeddedDb.compact): a centroid plus outliers standing for all embeds
+    #up to max_embed_id. The embeds themselves are kept; the gallery loads the prototypes instead of them
+    __tablename__ = 'prototypes'
+    id = Column(Integer, primary_key=True)
+    student_id = Column(Integer, ForeignKey('students.id'), nullable=False)
+    embedding = Column(LargeBinary, nullable=False)
+    num_embeds = Column(Integer, nullable=False) # embeds this prototype was built from
+    max_embed_id = Column(Integer, nullable=False) # highest embed id of the student covered by the compaction
+    student = relationship("Student", back_populates="prototypes")
+
+class EmbedChange(Base):
+    #Append-only log of embed inserts and deletes, filled by the triggers below so that every writer
+    #(ORM, bulk inserts, other stations, sqlite shell) is recorded. Stations poll it by revision.
+    __tablename__ = 'embed_changes'
+    # AUTOINCREMENT: revisions are never reused, even after the newest rows are deleted
+    __table_args__ = {"sqlite_autoincrement": True}
+    revision = Column(Integer, primary_key=True)
+    embed_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False) # CHANGE_ADD or CHANGE_DELETE
+
+CHANGE_ADD = 'add'
+CHANGE_DELETE = 'delete'
+
+_CHANGE_LOG_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS embeds_log_insert AFTER INSERT ON embeds BEGIN
+        INSERT INTO embed_changes (embed_id, op) VALUES (NEW.id, '{CHANGE_ADD}'); END""",
+    f"""CREATE TRIGGER IF NOT EXISTS embeds_log_delete AFTER DELETE ON embeds BEGIN
+        INSERT INTO embed_changes (embed_id, op) VALUES (OLD.id, '{CHANGE_DELETE}'); END""",
+    # an updated embed is replaced: dropped and added again
+    f"""CREATE TRIGGER IF NOT EXISTS embeds_log_update AFTER UPDATE ON embeds BEGIN
+        INSERT INTO embed_changes (embed_id, op) VALUES (OLD.id, '{CHANGE_DELETE}');
+        INSERT INTO embed_changes (embed_id, op) VALUES (NEW.id, '{CHANGE_ADD}'); END""",
+]
+
+DB_PATH = 'db.sqlite'
+
+engine = create_engine(f'sqlite:///{DB_PATH}')
 Base.metadata.create_all(engine)
+with engine.begin() as _connection:
+    for _trigger in _CHANGE_LOG_TRIGGERS:
+        _connection.execute(text(_trigger))
 Session = sessionmaker(bind=engine)
 
+def enable_wal():
+    #Switches the database to write-ahead logging (persisted in the file): writers no longer block readers,
+    #so a running app keeps reading while a bulk import commits, and commits only append to the log
+    with engine.connect() as connection:
+        mode = connection.execute(text("PRAGMA journal_mode=WAL")).scalar()
+    return mode
+
 def get_all_students(session):
     return session.query(Student).all()
 
@@ -40,4 +90,73 @@ def add_student(session, name, group):
     student = Student(name=name, group=group)
     session.add(student)
     session.commit()
-    return student
\ No newline at end of file
+    return student
+
+def get_gallery_version(session):
+    #[embed count, highest embed id, student count, highest student id, prototype count, highest prototype id,
+    # hash of the students' names and groups, latest change revision], changes whenever embeds, students or
+    #prototypes are added or removed and when a student is renamed or moved to another group
+    embeds, max_embed_id = session.execute(select(func.count(Embed.id), func.max(Embed.id))).one()
+    students, max_student_id = session.execute(select(func.count(Student.id), func.max(Student.id))).one()
+    prototypes, max_prototype_id = session.execute(select(func.count(Prototype.id), func.max(Prototype.id))).one()
+    return [embeds, max_embed_id or 0, students, max_student_id or 0, prototypes, max_prototype_id or 0,
+            get_students_digest(session), get_latest_revision(session)]
+
+def get_students_digest(session):
+    #hash of every student's id, name and group: the gallery labels its rows with them
+    digest = hashlib.sha1()
+    for student_id, name, group in session.execute(select(Student.id, Student.name, Student.group).order_by(Student.id)):
+        digest.update(json.dumps([student_id, name, group]).encode("utf-8"))
+    return digest.hexdigest()
+
+def get_latest_revision(session):
+    return session.execute(select(func.max(EmbedChange.revision))).scalar() or 0
+
+def get_changes_since(session, revision):
+    #Embed changes after revision, in revision order: rows of (revision, op, embed id, student name, group, embedding bytes).
+    #Student and embedding are None for deletes, and for adds of embeds that were deleted since
+    query = (select(EmbedChange.revision, EmbedChange.op, EmbedChange.embed_id, Student.name, Student.group, Embed.embedding)
+             .outerjoin(Embed, (Embed.id == EmbedChange.embed_id) & (EmbedChange.op == CHANGE_ADD))
+             .outerjoin(Student, Student.id == Embed.student_id)
+             .where(EmbedChange.revision > revision)
+             .order_by(EmbedChange.revision))
+    return session.execute(query).all()
+
+def get_gallery_rows(session):
+    #every student with its embeds in one query, ordered by student and embed id:
+    #rows of (student name, group, embed id, embedding bytes), embed columns are None for students without embeds.
+    #Embeds covered by the student's prototypes are left out, see get_prototype_rows
+    covered = (select(Prototype.student_id, func.max(Prototype.max_embed_id).label("max_embed_id"))
+               .group_by(Prototype.student_id).subquery())
+    query = (select(Student.name, Student.group, Embed.id, Embed.embedding)
+             .outerjoin(covered, covered.c.student_id == Student.id)
+             .outerjoin(Embed, (Embed.student_id == Student.id) & (Embed.id > func.coalesce(covered.c.max_embed_id, 0)))
+             .order_by(Student.id, Embed.id))
+    return session.execute(query).all()
+
+def get_prototype_rows(session):
+    #rows of (student name, group, prototype id, embedding bytes) ordered by student and prototype id
+    query = (select(Student.name, Student.group, Prototype.id, Prototype.embedding)
+             .join(Prototype, Prototype.student_id == Student.id)
+             .order_by(Student.id, Prototype.id))
+    return session.execute(query).all()
+
+def get_student_embeds(session):
+    #rows of (student id, embed id, embedding bytes) for every embed, ordered by student and embed id
+    return session.execute(select(Embed.student_id, Embed.id, Embed.embedding).order_by(Embed.student_id, Embed.id)).all()
+
+def replace_prototypes(session, student_id, prototypes, max_embed_id):
+    #replaces the prototypes of a student with (embedding bytes, number of embeds) rows, the caller commits
+    session.query(Prototype).filter(Prototype.student_id == student_id).delete(synchronize_session=False)
+    if prototypes:
+        session.execute(insert(Prototype), [{"student_id": student_id, "embedding": embedding, "num_embeds": num_embeds,
+                                             "max_embed_id": max_embed_id} for embedding, num_embeds in prototypes])
+
+def get_student_ids(session):
+    #{(name, group): student id} for every student
+    return {(name, group): student_id for student_id, name, group in session.execute(select(Student.id, Student.name, Student.group))}
+
+def add_embeds_bulk(session, rows):
+    #inserts (student id, embedding bytes) rows with one executemany, the caller commits
+    if rows:
+        session.execute(insert(Embed), [{"student_id": student_id, "embedding": embedding} for student_id, embedding in rows])
@@ -0,0 +1,268 @@
+import os
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import metrics
+from Tracking import RelativeBoundingBox, bbox_to_corners, calculate_iou_matrix
+
+#Detection on parts of the frame. The detector (MediaPipe FaceDetection) runs on sub-images and
+#its detections are mapped back to frame coordinates, in the same shape as MediaPipe's detections
+#(score, location_data.relative_bounding_box, location_data.relative_keypoints) so FaceTracker takes them as they are.
+
+class Keypoint:
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+class LocationData:
+    __slots__ = ("relative_bounding_box", "relative_keypoints")
+
+    def __init__(self, relative_bounding_box, relative_keypoints):
+        self.relative_bounding_box = relative_bounding_box
+        self.relative_keypoints = relative_keypoints
+
+class Detection:
+    __slots__ = ("score", "location_data")
+
+    def __init__(self, score, relative_bounding_box, relative_keypoints):
+        self.score = [score]
+        self.location_data = LocationData(relative_bounding_box, relative_keypoints)
+
+class DetectionResults:
+    #what detector.process() returns, as MediaPipe's results: detections is None when nothing was found
+    __slots__ = ("detections",)
+
+    def __init__(self, detections):
+        self.detections = detections or None
+
+def run_detector(detector, image_rgb):
+    #MediaPipe detections of an RGB image, [] when nothing was found
+    results = detector.process(image_rgb)
+    return list(results.detections) if results.detections else []
+
+def map_detection(detection, x0, y0, width, height, frame_width, frame_height):
+    #Maps a detection relative to a sub-image to frame coordinates.
+    #The sub-image covered the frame pixels x0..x0+width, y0..y0+height
+    bb = detection.location_data.relative_bounding_box
+    box = RelativeBoundingBox((x0 + bb.xmin * width) / frame_width, (y0 + bb.ymin * height) / frame_height,
+                              bb.width * width / frame_width, bb.height * height / frame_height)
+    keypoints = [Keypoint((x0 + keypoint.x * width) / frame_width, (y0 + keypoint.y * height) / frame_height)
+                 for keypoint in detection.location_data.relative_keypoints]
+    score = detection.score[0] if detection.score else 0.0
+    return Detection(score, box, keypoints)
+
+def non_max_suppression(detections, iou_threshold=0.3, clipped=None, containment_threshold=0.5):
+    #Keeps the highest scoring detection of every group of boxes overlapping by more than iou_threshold.
+    #clipped[i] = True when detection i may only cover part of its face (it touches a tile border inside the frame):
+    #clipped boxes rank below every complete one whatever their score, and are also dropped when more than
+    #containment_threshold of their area lies inside a kept box, as a small piece of a face has a low IoU with it.
+    #A face larger than the tile overlap is cut in every tile: a kept clipped box grows to the union of the
+    #clipped boxes it suppresses
+    if len(detections) < 2:
+        return list(detections)
+    boxes = np.array([bbox_to_corners(detection.location_data.relative_bounding_box) for detection in detections])
+    scores = np.array([detection.score[0] if detection.score else 0.0 for detection in detections])
+    clipped = np.zeros(len(detections), dtype=bool) if clipped is None else np.asarray(clipped, dtype=bool)
+    iou = calculate_iou_matrix(boxes, boxes)
+    # intersection[i, j] from the IoU: inter = iou * (area_i + area_j - inter)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    intersection = iou * (areas[:, None] + areas[None, :]) / (1.0 + iou)
+    containment = np.zeros_like(intersection)
+    np.divide(intersection, areas[:, None], out=containment, where=areas[:, None] > 0)
+    keep = []
+    suppressed = np.zeros(len(detections), dtype=bool)
+    # complete boxes first, then by score (lexsort: last key is the primary one, ties keep their order)
+    for i in np.lexsort((-scores, clipped)):
+        if suppressed[i]:
+            continue
+        overlapping = ~suppressed & ((iou[i] > iou_threshold) | (clipped & (containment[:, i] > containment_threshold)))
+        suppressed |= overlapping
+        if clipped[i]:
+            pieces = boxes[overlapping & clipped]
+            keep.append(Detection(float(scores[i]), _union_box(np.vstack((boxes[i], pieces))),
+                                  detections[i].location_data.relative_keypoints))
+        else:
+            keep.append(detections[i])
+    return keep
+
+def _union_box(corners):
+    #relative bounding box around rows of (xmin, ymin, xmax, ymax)
+    xmin, ymin = corners[:, 0].min(), corners[:, 1].min()
+    return RelativeBoundingBox(float(xmin), float(ymin), float(corners[:, 2].max() - xmin), float(corners[:, 3].max() - ymin))
+
+class RegionDetector:
+    #Runs the detector only around the tracked faces between periodic full-frame sweeps.
+    #Every track box is padded, cut out and scaled into one cell of a square mosaic; the detector runs once
+    #on the mosaic and the detections are mapped back to the frame. The detector input then grows with
+    #the number of faces instead of the camera resolution. New faces only appear on the full sweeps
+    def __init__(self, padding=0.5, cell_size=192, full_sweep_interval=5, max_regions=16, iou_threshold=0.3):
+        #padding = margin around a track box on each side, relative to the box size
+        #cell_size = side in pixels of a mosaic cell
+        #full_sweep_interval = every how many detection runs the whole frame is searched
+        #max_regions = with more tracks than this the faces would get too small in the mosaic, the full frame is used
+        self.padding = padding
+        self.cell_size = cell_size
+        self.full_sweep_interval = full_sweep_interval
+        self.max_regions = max_regions
+        self.iou_threshold = iou_threshold
+        self.runs = 0
+        self.full_sweeps = 0
+
+    def detect(self, detector, frame_rgb, track_boxes):
+        #track_boxes = relative bounding boxes of the current tracks, returns the detections of this frame
+        full_sweep = self.runs % self.full_sweep_interval == 0 or not track_boxes or len(track_boxes) > self.max_regions
+        self.runs += 1
+        if full_sweep:
+            self.full_sweeps += 1
+            return run_detector(detector, frame_rgb)
+        return self.detect_regions(detector, frame_rgb, track_boxes)
+
+    def regions(self, frame_shape, track_boxes):
+        #padded track boxes as pixel rectangles (x0, y0, x1, y1) clipped to the frame
+        frame_height, frame_width = frame_shape[:2]
+        regions = []
+        for box in track_boxes:
+            pad_x = box.width * self.padding
+            pad_y = box.height * self.padding
+            x0 = int(max(0.0, box.xmin - pad_x) * frame_width)
+            y0 = int(max(0.0, box.ymin - pad_y) * frame_height)
+            x1 = int(min(1.0, box.xmin + box.width + pad_x) * frame_width)
+            y1 = int(min(1.0, box.ymin + box.height + pad_y) * frame_height)
+            if x1 - x0 > 1 and y1 - y0 > 1:
+                regions.append((x0, y0, x1, y1))
+        return regions
+
+    def detect_regions(self, detector, frame_rgb, track_boxes):
+        frame_height, frame_width = frame_rgb.shape[:2]
+        regions = self.regions(frame_rgb.shape, track_boxes)
+        if not regions:
+            return []
+        cell = self.cell_size
+        columns = int(np.ceil(np.sqrt(len(regions))))
+        rows = int(np.ceil(len(regions) / columns))
+        mosaic = np.zeros((rows * cell, columns * cell, 3), dtype=np.uint8)
+        placements = [] # (region, scale) per cell
+        for i, (x0, y0, x1, y1) in enumerate(regions):
+            scale = cell / max(x1 - x0, y1 - y0)
+            width = max(1, min(cell, int(round((x1 - x0) * scale))))
+            height = max(1, min(cell, int(round((y1 - y0) * scale))))
+            top, left = (i // columns) * cell, (i % columns) * cell
+            mosaic[top:top + height, left:left + width] = cv2.resize(frame_rgb[y0:y1, x0:x1], (width, height),
+                                                                     interpolation=cv2.INTER_LINEAR)
+            placements.append(((x0, y0, x1, y1), scale))
+
+        mosaic_height, mosaic_width = mosaic.shape[:2]
+        detections = []
+        for detection in run_detector(detector, mosaic):
+            bb = detection.location_data.relative_bounding_box
+            # the cell holding the center of the box decides which region the detection belongs to
+            center_x = (bb.xmin + bb.width / 2) * mosaic_width
+            center_y = (bb.ymin + bb.height / 2) * mosaic_height
+            column = min(columns - 1, max(0, int(center_x // cell)))
+            row = min(rows - 1, max(0, int(center_y // cell)))
+            index = row * columns + column
+            if index >= len(placements):
+                continue
+            (x0, y0, _, _), scale = placements[index]
+            # mosaic pixels -> frame pixels: the cell origin maps to the region origin, sizes divide by scale
+            detections.append(map_detection(detection, x0 - column * cell / scale, y0 - row * cell / scale,
+                                            mosaic_width / scale, mosaic_height / scale, frame_width, frame_height))
+        # neighbouring regions overlap, a face may be found in two cells
+        return non_max_suppression(detections, self.iou_threshold)
+
+class TiledDetector:
+    #Splits the frame into overlapping tiles and runs them through the detector in parallel, so small faces
+    #(the back rows of a lecture hall on a 4K camera) reach the detector at a usable size.
+    #Every worker thread has its own detector instance (MediaPipe graphs can not be shared between threads and
+    #release the GIL while running). Detections are mapped back to the frame and merged with NMS.
+    #Has the same process()/close() interface as the MediaPipe detector, so it can be used wherever that one is
+    EDGE_MARGIN = 2 # pixels, a box this close to a tile border is taken as cut by it
+
+    def __init__(self, create_detector, rows=2, columns=2, overlap=0.15, workers=None, iou_threshold=0.3):
+        #create_detector = callable returning a new detector instance
+        #rows, columns = tile grid; overlap = fraction of a tile shared with its neighbour, in [0, 1), a face cut
+        #by one tile border is then whole in the next tile as long as it is smaller than the overlap
+        #workers = detector instances and threads, defaults to one per tile up to the number of cores
+        if not 0.0 <= overlap < 1.0:
+            raise ValueError(f"TiledDetector: overlap must be in [0, 1), got {overlap}")
+        self.rows = rows
+        self.columns = columns
+        self.overlap = overlap
+        self.iou_threshold = iou_threshold
+        self.workers = workers or max(1, min(rows * columns, os.cpu_count() or 1))
+        self._tile_metrics = [metrics.TILE_DETECTION_SECONDS.labels(str(i)) for i in range(rows * columns)]
+        # a worker takes a free detector for the duration of one tile, so no instance is used by two threads
+        self._detectors = queue.Queue()
+        self._all_detectors = [create_detector() for _ in range(self.workers)]
+        for detector in self._all_detectors:
+            self._detectors.put(detector)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tile-detector")
+
+    def tiles(self, frame_shape):
+        #pixel rectangles (x0, y0, x1, y1) of the tiles, row by row
+        frame_height, frame_width = frame_shape[:2]
+        tiles = []
+        for row in range(self.rows):
+            y0, y1 = self._span(row, self.rows, frame_height)
+            for column in range(self.columns):
+                x0, x1 = self._span(column, self.columns, frame_width)
+                tiles.append((x0, y0, x1, y1))
+        return tiles
+
+    def _span(self, index, count, length):
+        # tiles of equal size that overlap their neighbours by overlap * tile size
+        size = length / (count - (count - 1) * self.overlap) if count > 1 else length
+        start = index * size * (1 - self.overlap)
+        return int(start), min(length, int(round(start + size)))
+
+    def _detect_tile(self, frame_rgb, index, tile):
+        #returns [(detection in frame coordinates, clipped)], clipped = the box touches a border of the tile
+        #that is inside the frame, the face may continue in the neighbouring tile
+        x0, y0, x1, y1 = tile
+        frame_height, frame_width = frame_rgb.shape[:2]
+        detector = self._detectors.get()
+        try:
+            start = time.perf_counter()
+            # MediaPipe wants contiguous memory, a tile view of the frame is not
+            detections = run_detector(detector, np.ascontiguousarray(frame_rgb[y0:y1, x0:x1]))
+            elapsed = time.perf_counter() - start
+        finally:
+            self._detectors.put(detector)
+        self._tile_metrics[index].observe(elapsed)
+        # relative to the tile, the borders shared with the frame do not clip anything
+        margin_x = self.EDGE_MARGIN / (x1 - x0)
+        margin_y = self.EDGE_MARGIN / (y1 - y0)
+        inner_edges = (x0 > 0, y0 > 0, x1 < frame_width, y1 < frame_height)
+        results = []
+        for detection in detections:
+            bb = detection.location_data.relative_bounding_box
+            touches = (bb.xmin <= margin_x, bb.ymin <= margin_y,
+                       bb.xmin + bb.width >= 1.0 - margin_x, bb.ymin + bb.height >= 1.0 - margin_y)
+            clipped = any(inner and touch for inner, touch in zip(inner_edges, touches))
+            results.append((map_detection(detection, x0, y0, x1 - x0, y1 - y0, frame_width, frame_height), clipped))
+        return results
+
+    def process(self, frame_rgb):
+        futures = [self._executor.submit(self._detect_tile, frame_rgb, i, tile) for i, tile in enumerate(self.tiles(frame_rgb.shape))]
+        results = [result for future in futures for result in future.result()]
+        # faces in the overlaps are found by two or four tiles, the box of a tile that holds the whole face wins
+        # over the cut one of its neighbour
+        return DetectionResults(non_max_suppression([detection for detection, _ in results], self.iou_threshold,
+                                                    [clipped for _, clipped in results]))
+
+    def tile_summary(self):
+        #per tile detector time in ms: last run, p50 and p95
+        return {i: {"last_ms": 1000 * tile_metric.last, "p50_ms": 1000 * tile_metric.quantile(0.5),
+                    "p95_ms": 1000 * tile_metric.quantile(0.95)}
+                for i, tile_metric in enumerate(self._tile_metrics)}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for detector in self._all_detectors:
+            detector.close()
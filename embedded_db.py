@@ -1,34 +1,790 @@
+import os
+import copy
+import time
+import atexit
+import hashlib
+import tempfile
+import threading
+import logging
 import numpy as np
 
-from db import Session, Student
+import gallery_snapshot
+from ann_index import IVFIndex, normalize_rows
+from quantized_gallery import QuantizedMatrix
+from prototypes import build_prototypes
+import metrics
+from db import (DB_PATH, Session, CHANGE_ADD, CHANGE_DELETE, get_gallery_rows, get_gallery_version, get_changes_since,
+                get_prototype_rows, get_student_embeds, replace_prototypes)
+
+logger = logging.getLogger(__name__)
+
+# persisted IVF index, stored next to the sqlite database
+ANN_INDEX_PATH = os.path.splitext(DB_PATH)[0] + ".ivf.npz"
+# memory-mapped copy of the gallery matrix, see gallery_snapshot
+GALLERY_SNAPSHOT_PATH = os.path.splitext(DB_PATH)[0] + ".gallery"
+# cosine distance below which the best match is accepted as a recognition
+MATCH_THRESHOLD = 0.6
+
+def prototype_row_id(prototype_id):
+    #_embed_ids entry of a gallery row loaded from a Prototype, kept apart from embed ids and from -1
+    return -1 - prototype_id
 
 class EmbeddedDb:
     embedded_db = {}
+    # guards the gallery: it is loaded and extended from background threads while the main loop searches it
+    _lock = threading.RLock()
+
+    # Contiguous gallery used for matching: one L2-normalized float32 row per stored embedding.
+    # The matrix is over-allocated so add_to_embedded_db can append in place without a rebuild.
+    _matrix = np.empty((0, 0), dtype=np.float32)
+    _labels = np.empty(0, dtype=np.int32) # row -> index into _names/_groups
+    _embed_ids = np.empty(0, dtype=np.int64) # row -> Embed.id, -1 when the row did not come from the database, see prototype_row_id
+    _count = 0
+    _names = []
+    _groups = []
+    _student_index = {} # name -> index into _names/_groups
+    _revision = 0 # latest embed_changes revision reflected in the gallery, see sync
+    _generation = 0 # bumped on every change of the gallery rows, invalidates _group_rows_cache
+    _group_rows_cache = {} # group -> (generation, gallery rows of the group's students)
+    _group_stats = {"hit": 0, "fallback": 0, "unknown_group": 0}
+
+    # Optional approximate index, only used once the gallery holds at least _ann_min_size rows
+    _ann_index = None
+    _ann_min_size = 10000
+    _ann_path = ANN_INDEX_PATH
+    _ann_dirty = False # index changed since it was last written, see flush_ann_index
+    _ann_training = False # a retrain runs in the background, see _retrain_ann_index_later
+
+    # Optional int8/float16 copy of the gallery scanned first, the best _rerank rows are re-scored in float32
+    _quantized = None
+    _rerank = 32
 
     @classmethod
     def get(cls):
         return cls.embedded_db
 
     @classmethod
-    def add_to_embedded_db(cls, name, group, embedding):
+    def add_to_embedded_db(cls, name, group, embedding, embed_id=None):
+        #embed_id = Embed.id of the stored embedding, lets sync() skip it when it shows up in the change log
+        with cls._lock:
+            if embed_id is not None and np.any(cls._embed_ids[:cls._count] == embed_id):
+                return
+            cls._add_embedding(name, group, embedding, embed_id)
+
+    @classmethod
+    def _add_embedding(cls, name, group, embedding, embed_id=None, update_index=True):
         if name not in cls.embedded_db:
             cls.embedded_db[name] = {
                 "group": group,
                 "embeddings": [embedding]
             }
         else:
-            cls.embedded_db[name]["embeddings"].append(embedding)
-
-    @classmethod
-    def populate_db(cls):
-        session = Session()
-        students = session.query(Student).all()
-        for student in students:
-            cls.embedded_db[student.name] = {
-                "group": student.group,
-                "embeddings": [
-                    np.frombuffer(embed.embedding, dtype=np.float32)
-                    for embed in student.embeds
-                ]
-            }
-        session.close()
\ No newline at end of file
+            embeddings = cls.embedded_db[name]["embeddings"]
+            if not isinstance(embeddings, list):
+                # rows mapped from the snapshot
+                embeddings = cls.embedded_db[name]["embeddings"] = list(embeddings)
+            embeddings.append(embedding)
+        cls._append_rows(name, group, [embedding], update_index, None if embed_id is None else [embed_id])
+
+    @classmethod
+    def populate_db(cls, snapshot_path=GALLERY_SNAPSHOT_PATH):
+        #Loads the gallery from the memory-mapped snapshot when it matches the database,
+        #otherwise reads it with one bulk query and rewrites the snapshot.
+        #The embeddings in embedded_db are the normalized gallery rows (views into the matrix)
+        cls._populate(snapshot_path)
+        # an index retrained for the loaded rows is written once the lock is released
+        cls.flush_ann_index()
+
+    @classmethod
+    def _populate(cls, snapshot_path):
+        with cls._lock:
+            start = time.perf_counter()
+            with Session() as session:
+                db_version = get_gallery_version(session)
+                snapshot = gallery_snapshot.read_snapshot(snapshot_path)
+                cls._revision = db_version[-1]
+                if snapshot is not None and snapshot["db_version"] == db_version:
+                    cls._set_gallery(snapshot["students"], snapshot["matrix"], snapshot["embed_ids"])
+                    logger.info(f"EmbeddedDb: mapped {cls._count} embeddings from {snapshot_path} "
+                                f"in {1000 * (time.perf_counter() - start):.1f}ms")
+                    return
+                cls._load_from_sql(session)
+            logger.info(f"EmbeddedDb: loaded {cls._count} embeddings from the database "
+                        f"in {1000 * (time.perf_counter() - start):.1f}ms")
+            cls.save_snapshot(snapshot_path, db_version)
+
+    @classmethod
+    def sync(cls):
+        #Applies the embeds other processes added or deleted since the last load or sync, returns (added, removed).
+        #Only the change log past the current revision is read, without holding the gallery lock
+        with Session() as session:
+            changes = get_changes_since(session, cls._revision)
+        if not changes:
+            # rows registered live since the last call are persisted from here, off the searching threads
+            cls.flush_ann_index()
+            return 0, 0
+        added = 0
+        removed = 0
+        with cls._lock:
+            start_row = cls._count
+            known_ids = set(cls._embed_ids[:cls._count].tolist())
+            if any(op == CHANGE_DELETE for _, op, _, _, _, _ in changes):
+                cls._detach_matrix()
+            for revision, op, embed_id, name, group, embedding in changes:
+                # a populate_db running meanwhile may already include this change
+                if revision <= cls._revision:
+                    continue
+                cls._revision = revision
+                if op == CHANGE_ADD:
+                    # name is None when the embed was deleted again, its delete follows
+                    if name is not None and embed_id not in known_ids:
+                        cls._add_embedding(name, group, np.frombuffer(embedding, dtype=np.float32), embed_id, update_index=False)
+                        known_ids.add(embed_id)
+                        added += 1
+                elif embed_id in known_ids:
+                    cls._remove_embed(embed_id)
+                    known_ids.discard(embed_id)
+                    removed += 1
+            if cls._ann_index is not None:
+                if removed:
+                    # removing rows renumbers them, the index is rebuilt off the lock (exact scans meanwhile)
+                    cls._retrain_ann_index_later()
+                elif added:
+                    cls._update_ann_index(start_row)
+        cls.flush_ann_index()
+        if added or removed:
+            logger.info(f"EmbeddedDb: synced {added} new and {removed} deleted embeddings (revision {cls._revision})")
+        return added, removed
+
+    @classmethod
+    def _detach_matrix(cls):
+        #Copies the gallery arrays before rows are moved: embedded_db entries may be views into them
+        #and the matrix may be a read-only snapshot mapping
+        cls._matrix = cls._copy_rows(cls._matrix[:cls._count])
+        cls._labels = cls._labels[:cls._count].copy()
+        cls._embed_ids = cls._embed_ids[:cls._count].copy()
+
+    @classmethod
+    def _remove_embed(cls, embed_id):
+        #Swap-removes the row of embed_id (the last row takes its place), call _detach_matrix first
+        row = int(np.flatnonzero(cls._embed_ids[:cls._count] == embed_id)[0])
+        student_idx = int(cls._labels[row])
+        last = cls._count - 1
+        cls._matrix[row] = cls._matrix[last]
+        cls._labels[row] = cls._labels[last]
+        cls._embed_ids[row] = cls._embed_ids[last]
+        cls._count = last
+        cls._generation += 1
+        if cls._quantized is not None:
+            cls._quantized.move_row(last, row)
+            cls._quantized.truncate(last)
+        name = cls._names[student_idx]
+        rows = np.flatnonzero(cls._labels[:cls._count] == student_idx)
+        cls.embedded_db[name]["embeddings"] = list(cls._matrix[rows])
+
+    @classmethod
+    def _load_from_sql(cls, session):
+        # students sharing a name are merged, their rows have to be contiguous in the matrix
+        students = {} # name -> [group, row ids, embedding blobs]
+        for name, group, embed_id, embedding in get_gallery_rows(session):
+            entry = students.setdefault(name, [group, [], []])
+            if embed_id is not None:
+                entry[1].append(embed_id)
+                entry[2].append(embedding)
+        # compacted students: their prototypes stand for the embeds left out by get_gallery_rows
+        for name, group, prototype_id, embedding in get_prototype_rows(session):
+            entry = students.setdefault(name, [group, [], []])
+            entry[1].append(prototype_row_id(prototype_id))
+            entry[2].append(embedding)
+        blobs = [blob for _, _, student_blobs in students.values() for blob in student_blobs]
+        embed_ids = np.array([embed_id for _, ids, _ in students.values() for embed_id in ids], dtype=np.int64)
+        matrix = np.frombuffer(b"".join(blobs), dtype=np.float32)
+        matrix = normalize_rows(matrix.reshape(len(blobs), -1)) if blobs else np.empty((0, 0), dtype=np.float32)
+        cls._set_gallery([[name, group, len(ids)] for name, (group, ids, _) in students.items()], matrix, embed_ids)
+
+    @classmethod
+    def _set_gallery(cls, students, matrix, embed_ids):
+        #replaces the gallery with normalized rows grouped by student, students = [[name, group, number of rows], ...]
+        counts = np.array([num_rows for _, _, num_rows in students], dtype=np.int64)
+        ends = np.cumsum(counts)
+        if cls._quantized is not None and not isinstance(matrix, np.memmap):
+            matrix = cls._copy_rows(matrix)
+        cls._matrix = matrix
+        cls._labels = np.repeat(np.arange(len(students), dtype=np.int32), counts)
+        cls._embed_ids = embed_ids
+        cls._count = len(matrix)
+        cls._generation += 1
+        cls._names = [name for name, _, _ in students]
+        cls._groups = [group for _, group, _ in students]
+        cls._student_index = {name: i for i, name in enumerate(cls._names)}
+        cls.embedded_db.clear()
+        for (name, group, num_rows), end in zip(students, ends):
+            cls.embedded_db[name] = {"group": group, "embeddings": matrix[end - num_rows:end]}
+        if cls._quantized is not None:
+            cls._quantized.build(matrix)
+        if cls._ann_index is not None:
+            cls._load_or_train_ann_index()
+
+    @classmethod
+    def save_snapshot(cls, path=GALLERY_SNAPSHOT_PATH, db_version=None):
+        #Writes the current gallery as a snapshot of db_version (the current database state if None).
+        #Only rows that came from the database can be saved, otherwise the next start would skip them
+        with cls._lock:
+            if np.any(cls._embed_ids[:cls._count] == -1):
+                logger.warning("EmbeddedDb: gallery holds rows that are not in the database, snapshot not written")
+                return False
+            if db_version is None:
+                with Session() as session:
+                    db_version = get_gallery_version(session)
+            counts = np.bincount(cls._labels[:cls._count], minlength=len(cls._names))
+            students = [[name, group, int(count)] for name, group, count in zip(cls._names, cls._groups, counts)]
+            try:
+                gallery_snapshot.write_snapshot(path, db_version, students, cls._matrix[:cls._count], cls._embed_ids[:cls._count])
+            except OSError as e:
+                logger.warning(f"EmbeddedDb: could not write the gallery snapshot {path}: {e}")
+                return False
+            return True
+
+    @classmethod
+    def rebuild_matrix(cls):
+        #Rebuilds the gallery matrix from embedded_db (used after a bulk load)
+        cls._matrix = np.empty((0, 0), dtype=np.float32)
+        cls._labels = np.empty(0, dtype=np.int32)
+        cls._embed_ids = np.empty(0, dtype=np.int64)
+        cls._count = 0
+        cls._generation += 1
+        cls._names = []
+        cls._groups = []
+        cls._student_index = {}
+        if cls._quantized is not None:
+            cls._quantized.build(np.empty((0, 0), dtype=np.float32))
+        for name, data in cls.embedded_db.items():
+            cls._append_rows(name, data["group"], data["embeddings"], update_index=False)
+        if cls._ann_index is not None:
+            cls._load_or_train_ann_index()
+
+    @classmethod
+    def _append_rows(cls, name, group, embeddings, update_index=True, embed_ids=None):
+        if not len(embeddings):
+            return
+        rows = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        student_idx = cls._student_index.get(name)
+        if student_idx is None:
+            student_idx = len(cls._names)
+            cls._student_index[name] = student_idx
+            cls._names.append(name)
+            cls._groups.append(group)
+
+        new_count = cls._count + len(rows)
+        if cls._count == 0 and cls._matrix.shape[1] != rows.shape[1]:
+            cls._matrix = np.empty((0, rows.shape[1]), dtype=np.float32)
+        if new_count > cls._matrix.shape[0]:
+            #grow geometrically so that appends are amortized O(1)
+            capacity = max(new_count, 2 * cls._matrix.shape[0], 64)
+            matrix = cls._new_matrix(capacity, rows.shape[1])
+            matrix[:cls._count] = cls._matrix[:cls._count]
+            labels = np.empty(capacity, dtype=np.int32)
+            labels[:cls._count] = cls._labels[:cls._count]
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:cls._count] = cls._embed_ids[:cls._count]
+            cls._matrix, cls._labels, cls._embed_ids = matrix, labels, ids
+        cls._matrix[cls._count:new_count] = rows
+        cls._labels[cls._count:new_count] = student_idx
+        cls._embed_ids[cls._count:new_count] = -1 if embed_ids is None else embed_ids
+        start_row = cls._count
+        cls._count = new_count
+        cls._generation += 1
+        if cls._quantized is not None:
+            cls._quantized.add(rows, start_row)
+        if update_index and cls._ann_index is not None:
+            cls._update_ann_index(start_row)
+
+    @classmethod
+    def size(cls):
+        return cls._count
+
+    @classmethod
+    def enable_ann_index(cls, nprobe=8, nlist=None, min_size=10000, path=ANN_INDEX_PATH):
+        #Turns on approximate search for large galleries. Off unless asked for (--ann-index): some queries miss
+        #their closest student, which changes match decisions without any sign, check ann_recall first.
+        #nprobe = clusters scanned per query (higher = better recall, slower), see IVFIndex
+        #min_size = below this many embeddings the exact scan is cheap enough and is used instead
+        with cls._lock:
+            cls._ann_index = IVFIndex(nlist=nlist, nprobe=nprobe)
+            cls._ann_min_size = min_size
+            cls._ann_path = path
+            cls._load_or_train_ann_index()
+        cls.flush_ann_index()
+        # rows added since the last flush are written when the process ends
+        atexit.register(cls.flush_ann_index)
+
+    @classmethod
+    def disable_ann_index(cls):
+        cls._ann_index = None
+
+    @classmethod
+    def enable_quantization(cls, mode="int8", rerank=32):
+        #Scans a compact int8 or float16 copy of the gallery first and re-ranks the best rerank rows
+        #(per query) against the float32 rows. The gain is memory: the float32 rows are moved to a file-backed
+        #mapping (see _new_matrix) and only the re-ranked ones are paged in, the codes are 4x (int8) or
+        #2x (float16) smaller. The scan itself is not faster than the float32 one, numpy has no int8/float16
+        #matrix product. See quantization_accuracy for the effect on the match decisions and the speed
+        with cls._lock:
+            quantized = QuantizedMatrix(mode)
+            quantized.build(cls._matrix[:cls._count])
+            cls._quantized = quantized
+            cls._rerank = rerank
+            if not isinstance(cls._matrix, np.memmap):
+                cls._matrix = cls._copy_rows(cls._matrix[:cls._count])
+                cls._refresh_student_embeddings()
+            logger.info(f"EmbeddedDb: {mode} gallery of {cls._count} embeddings, "
+                        f"{quantized.nbytes() / 2**20:.1f}MB in memory, {4 * cls._matrix[:cls._count].size / 2**20:.1f}MB "
+                        f"of float32 rows mapped for the re-rank")
+
+    @classmethod
+    def disable_quantization(cls):
+        cls._quantized = None
+
+    @classmethod
+    def _new_matrix(cls, rows, dim):
+        #Storage for rows float32 gallery rows. With quantization the searches scan the codes and read only the
+        #re-ranked rows of the matrix: it is then backed by an unlinked temporary file next to the database,
+        #so the OS pages the rows in on demand and can drop them again instead of keeping them all on the heap
+        if cls._quantized is None or rows == 0:
+            return np.empty((rows, dim), dtype=np.float32)
+        # the mapping keeps its own descriptor, the file disappears once the matrix is released
+        with tempfile.TemporaryFile(prefix="gallery-rows-", dir=os.path.dirname(os.path.abspath(DB_PATH))) as f:
+            f.truncate(rows * dim * 4)
+            return np.memmap(f, dtype=np.float32, mode="r+", shape=(rows, dim))
+
+    @classmethod
+    def _copy_rows(cls, rows):
+        matrix = cls._new_matrix(*rows.shape)
+        matrix[:] = rows
+        return matrix
+
+    @classmethod
+    def _refresh_student_embeddings(cls):
+        #points the embedded_db entries at the rows of the current matrix, after it was replaced by a copy
+        labels = cls._labels[:cls._count]
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(len(cls._names) + 1))
+        for student_idx, name in enumerate(cls._names):
+            if name not in cls.embedded_db:
+                continue
+            rows = order[bounds[student_idx]:bounds[student_idx + 1]]
+            if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+                cls.embedded_db[name]["embeddings"] = cls._matrix[rows[0]:rows[-1] + 1]
+            else:
+                cls.embedded_db[name]["embeddings"] = [cls._matrix[row] for row in rows]
+
+    @classmethod
+    def _load_or_train_ann_index(cls):
+        if cls._count < cls._ann_min_size:
+            return
+        if cls._ann_index.load(cls._ann_path, cls._count, cls._ann_fingerprint()):
+            logger.info(f"EmbeddedDb: loaded ANN index from {cls._ann_path}")
+            cls._ann_dirty = False
+            return
+        cls._ann_index.train(cls._matrix[:cls._count])
+        cls._ann_dirty = True
+
+    @classmethod
+    def _update_ann_index(cls, start_row):
+        index = cls._ann_index
+        if not index.is_trained() or index.count != start_row:
+            # the gallery just outgrew min_size, or the index is being rebuilt after a removal
+            cls._retrain_ann_index_later()
+            return
+        index.add(cls._matrix[start_row:cls._count], start_row)
+        cls._ann_dirty = True
+        if index.needs_retraining():
+            # still usable meanwhile, only its clusters get unbalanced
+            cls._retrain_ann_index_later()
+
+    @classmethod
+    def _retrain_ann_index_later(cls):
+        #Trains a new index on a background thread, call with the lock held. Training takes seconds on a large
+        #gallery, it must not hold the lock the searches need; while the index does not cover every row
+        #(see _use_ann_index) searches use the exact scan
+        if cls._ann_training or cls._count < cls._ann_min_size:
+            return
+        cls._ann_training = True
+        threading.Thread(target=cls._retrain_ann_index, name="ann-retrain", daemon=True).start()
+
+    @classmethod
+    def _retrain_ann_index(cls):
+        try:
+            while True:
+                with cls._lock:
+                    index = cls._ann_index
+                    if index is None or cls._count < cls._ann_min_size:
+                        return
+                    rows = cls._matrix[:cls._count].copy()
+                    embed_ids = cls._embed_ids[:cls._count].copy()
+                new_index = IVFIndex(nlist=index.nlist, nprobe=index.nprobe,
+                                     kmeans_iterations=index.kmeans_iterations, seed=index.seed)
+                new_index.train(rows)
+                with cls._lock:
+                    if cls._ann_index is not index:
+                        # disabled or enabled again meanwhile
+                        return
+                    # rows appended meanwhile are added, rows removed or reloaded meanwhile need another pass
+                    # (a removal always changes the embed id of a row: the last row takes its place)
+                    if cls._count >= len(rows) and np.array_equal(cls._embed_ids[:len(rows)], embed_ids):
+                        new_index.add(cls._matrix[len(rows):cls._count], len(rows))
+                        cls._ann_index = new_index
+                        cls._ann_dirty = True
+                        break
+        finally:
+            with cls._lock:
+                cls._ann_training = False
+        cls.flush_ann_index()
+
+    @classmethod
+    def _ann_fingerprint(cls):
+        #Identifies the gallery rows in order: a saved index lists row numbers, so it only fits a gallery holding
+        #the same rows at the same positions (a reload orders rows by student, live additions were appended)
+        digest = hashlib.sha1(cls._embed_ids[:cls._count].tobytes())
+        digest.update(cls._matrix[:cls._count].sum(axis=1, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def flush_ann_index(cls):
+        #Writes the index if it changed since the last write. The file is written outside the gallery lock,
+        #from a copy, so searches are not blocked meanwhile. Called after loads and syncs and at exit
+        with cls._lock:
+            if not cls._ann_dirty or cls._ann_index is None or not cls._ann_index.is_trained():
+                return False
+            if cls._ann_index.count != cls._count:
+                return False
+            index = copy.copy(cls._ann_index)
+            # inverted lists are replaced, never modified in place, a shallow copy of the list is a stable view
+            index.lists = list(index.lists)
+            fingerprint = cls._ann_fingerprint()
+            cls._ann_dirty = False
+        try:
+            index.save(cls._ann_path, fingerprint)
+        except OSError as e:
+            logger.warning(f"EmbeddedDb: could not write the ANN index {cls._ann_path}: {e}")
+            cls._ann_dirty = True
+            return False
+        return True
+
+    @classmethod
+    def _use_ann_index(cls):
+        return (cls._ann_index is not None and cls._ann_index.is_trained()
+                and cls._ann_index.count == cls._count and cls._count >= cls._ann_min_size)
+
+    @classmethod
+    def search(cls, query, k=1):
+        #Returns the k closest students to a single embedding, see search_batch
+        return cls.search_batch([query], k)[0]
+
+    @classmethod
+    def search_batch(cls, queries, k=1, group=None, threshold=MATCH_THRESHOLD):
+        #Matches every query against the gallery with a single matrix product (or through the ANN index).
+        #Returns one list per query with up to k dicts {'name', 'group', 'distance'},
+        #ordered by cosine distance, with at most one entry per student.
+        #With a group, queries are matched against that group's students first and only fall back to the
+        #whole gallery when the best in-group distance is not below threshold (see group_search_stats)
+        _check_k(k)
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis, :]
+        with cls._lock:
+            if cls._count == 0 or len(queries) == 0:
+                return [[] for _ in range(len(queries))]
+
+            queries = normalize_rows(queries)
+            if group is not None:
+                return cls._search_group_first(queries, k, group, threshold)
+            return cls._search_all(queries, k)
+
+    @classmethod
+    def _search_all(cls, queries, k):
+        if cls._use_ann_index():
+            return cls._search_ann(queries, k)
+        return cls._search_exact(queries, k)
+
+    @classmethod
+    def _search_group_first(cls, queries, k, group, threshold):
+        rows = cls._group_rows(group)
+        if not len(rows):
+            cls._count_group_searches("unknown_group", len(queries))
+            return cls._search_all(queries, k)
+        # a class is a few dozen rows, an exact float32 scan of them is cheaper than any index
+        similarities = queries @ cls._matrix[rows].T
+        results = [cls._top_k_students(row, k, rows) for row in similarities]
+        fallback = [i for i, matches in enumerate(results) if not matches or matches[0]["distance"] >= threshold]
+        if fallback:
+            for i, matches in zip(fallback, cls._search_all(queries[fallback], k)):
+                results[i] = matches
+        cls._count_group_searches("hit", len(queries) - len(fallback))
+        cls._count_group_searches("fallback", len(fallback))
+        return results
+
+    @classmethod
+    def _group_rows(cls, group):
+        #gallery rows of the students of group, cached until the gallery changes
+        cached = cls._group_rows_cache.get(group)
+        if cached is not None and cached[0] == cls._generation:
+            return cached[1]
+        students = [i for i, student_group in enumerate(cls._groups) if student_group == group]
+        rows = np.flatnonzero(np.isin(cls._labels[:cls._count], students)) if students else np.empty(0, dtype=np.int64)
+        cls._group_rows_cache[group] = (cls._generation, rows)
+        return rows
+
+    @classmethod
+    def _count_group_searches(cls, outcome, amount):
+        if amount:
+            cls._group_stats[outcome] += amount
+            metrics.GROUP_SEARCHES.labels(outcome).inc(amount)
+
+    @classmethod
+    def group_search_stats(cls):
+        #counts of group-first searches: matched in the group, fell back to the whole gallery, group not in the gallery
+        with cls._lock:
+            stats = dict(cls._group_stats)
+        total = sum(stats.values())
+        stats["hit_rate"] = stats["hit"] / total if total else 0.0
+        stats["fallback_rate"] = stats["fallback"] / total if total else 0.0
+        return stats
+
+    @classmethod
+    def _search_exact(cls, queries, k, use_quantized=True):
+        if use_quantized and cls._quantized is not None:
+            return [cls._rerank_candidates(query, scores, k) for query, scores in zip(queries, cls._quantized.scores(queries))]
+        similarities = queries @ cls._matrix[:cls._count].T
+        return [cls._top_k_students(row, k) for row in similarities]
+
+    @classmethod
+    def _search_ann(cls, queries, k, nprobe=None):
+        results = []
+        for query, rows in zip(queries, cls._ann_index.candidates(queries, nprobe)):
+            if cls._quantized is not None:
+                results.append(cls._rerank_candidates(query, cls._quantized.scores(query[np.newaxis, :], rows)[0], k, rows))
+                continue
+            similarities = cls._matrix[rows] @ query
+            results.append(cls._top_k_students(similarities, k, rows))
+        return results
+
+    @classmethod
+    def _rerank_candidates(cls, query, approximate, k, rows=None):
+        #approximate[i] = quantized similarity of gallery row rows[i] (or row i), the best rows are re-scored exactly
+        if rows is None:
+            rows = np.arange(len(approximate))
+        # a student may own several of the best rows, keep enough rows to still cover k students
+        num_candidates = min(len(rows), max(cls._rerank, 4 * k))
+        if num_candidates < len(rows):
+            rows = rows[np.argpartition(-approximate, num_candidates - 1)[:num_candidates]]
+        return cls._top_k_students(cls._matrix[rows] @ query, k, rows)
+
+    @classmethod
+    def _top_k_students(cls, similarities, k, rows=None):
+        #similarities[i] belongs to gallery row rows[i] (or row i when rows is None)
+        if rows is None:
+            rows = np.arange(len(similarities))
+        labels = cls._labels[rows]
+        total = len(similarities)
+        num_candidates = min(total, k)
+        while True:
+            # take the best rows, widening the window until it covers k distinct students
+            if num_candidates < total:
+                candidates = np.argpartition(-similarities, num_candidates - 1)[:num_candidates]
+            else:
+                candidates = np.arange(total)
+            candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+            matches = []
+            seen = set()
+            for row in candidates:
+                student_idx = int(labels[row])
+                if student_idx in seen:
+                    continue
+                seen.add(student_idx)
+                matches.append({
+                    "name": cls._names[student_idx],
+                    "group": cls._groups[student_idx],
+                    "distance": float(1.0 - similarities[row])
+                })
+                if len(matches) == k:
+                    return matches
+            if num_candidates >= total:
+                return matches
+            num_candidates = min(total, num_candidates * 4)
+
+    @classmethod
+    def compact(cls, max_prototypes=4, outlier_distance=0.3, min_embeds=None):
+        #Replaces the embeds of every student holding more than min_embeds (default max_prototypes) of them
+        #with at most max_prototypes prototypes (see prototypes.build_prototypes), stored in the Prototype table.
+        #The embeds stay in the database and a later compaction rebuilds the prototypes from all of them.
+        #Reloads the gallery afterwards; returns {'students', 'embeds', 'prototypes'} of the compacted students.
+        #Other running processes pick the prototypes up on their next start, until then they keep matching the embeds
+        min_embeds = max_prototypes if min_embeds is None else min_embeds
+        compacted = {"students": 0, "embeds": 0, "prototypes": 0}
+        with Session() as session:
+            by_student = {}
+            for student_id, embed_id, embedding in get_student_embeds(session):
+                by_student.setdefault(student_id, []).append((embed_id, embedding))
+            for student_id, embeds in by_student.items():
+                if len(embeds) <= min_embeds:
+                    continue
+                matrix = np.frombuffer(b"".join(embedding for _, embedding in embeds), dtype=np.float32).reshape(len(embeds), -1)
+                prototypes, counts = build_prototypes(matrix, max_prototypes, outlier_distance)
+                replace_prototypes(session, student_id, [(prototype.tobytes(), count) for prototype, count in zip(prototypes, counts)],
+                                   max(embed_id for embed_id, _ in embeds))
+                compacted["students"] += 1
+                compacted["embeds"] += len(embeds)
+                compacted["prototypes"] += len(prototypes)
+            session.commit()
+        logger.info(f"EmbeddedDb: compacted {compacted['embeds']} embeddings of {compacted['students']} students "
+                    f"into {compacted['prototypes']} prototypes")
+        cls.populate_db()
+        return compacted
+
+    @classmethod
+    def recognition_accuracy(cls, queries, expected_names, threshold=MATCH_THRESHOLD):
+        #Share of queries recognized as their expected student (best match below threshold), recognized as someone
+        #else, or rejected, plus the gallery size they were matched against. Used to compare galleries, e.g. before
+        #and after compact()
+        all_matches = cls.search_batch(queries, k=1)
+        correct = 0
+        wrong = 0
+        for matches, expected_name in zip(all_matches, expected_names):
+            decision = _decision(matches, threshold)
+            if decision == expected_name:
+                correct += 1
+            elif decision is not None:
+                wrong += 1
+        total = max(len(all_matches), 1)
+        return {
+            "queries": len(all_matches),
+            "gallery_rows": cls._count,
+            "accuracy": correct / total,
+            "false_accepts": wrong / total,
+            "rejected": (len(all_matches) - correct - wrong) / total,
+            "threshold": threshold,
+        }
+
+    @classmethod
+    def sample_queries(cls, num_queries=500, noise=0.3, seed=0):
+        #(queries, expected student names): perturbed gallery rows, like fresh captures of enrolled students
+        with cls._lock:
+            rng = np.random.default_rng(seed)
+            rows = rng.choice(cls._count, min(num_queries, cls._count), replace=False)
+            names = [cls._names[cls._labels[row]] for row in rows]
+            queries = cls._matrix[rows] + noise * rng.standard_normal((len(rows), cls._matrix.shape[1])).astype(np.float32) / np.sqrt(cls._matrix.shape[1])
+        return normalize_rows(queries), names
+
+    @classmethod
+    def ann_recall(cls, queries=None, k=1, threshold=0.6, nprobe=None, num_queries=200, noise=0.3, seed=0):
+        #Compares the ANN index against the exact scan.
+        #queries default to perturbed gallery rows, which behave like fresh captures of enrolled students.
+        #Reports recall@k over students, agreement of the "distance < threshold" match decision
+        #(the rule main.py applies) and the mean latency per query of both searches
+        if cls._ann_index is None or not cls._ann_index.is_trained():
+            raise RuntimeError("ann_recall: ANN index is not enabled or not trained")
+        _check_k(k)
+        queries = cls._probe_queries(queries, num_queries, noise, seed)
+
+        with cls._lock:
+            start = time.perf_counter()
+            exact = cls._search_exact(queries, k, use_quantized=False)
+            exact_time = time.perf_counter() - start
+            start = time.perf_counter()
+            approximate = cls._search_ann(queries, k, nprobe)
+            ann_time = time.perf_counter() - start
+
+        found = 0
+        expected = 0
+        agreements = 0
+        for exact_matches, ann_matches in zip(exact, approximate):
+            ann_names = {match["name"] for match in ann_matches}
+            found += sum(match["name"] in ann_names for match in exact_matches)
+            expected += len(exact_matches)
+            exact_decision = _decision(exact_matches, threshold)
+            agreements += exact_decision == _decision(ann_matches, threshold)
+        return {
+            "queries": len(queries),
+            "recall_at_k": found / expected if expected else 1.0,
+            "decision_agreement": agreements / len(queries) if len(queries) else 1.0,
+            "exact_ms_per_query": 1000 * exact_time / max(len(queries), 1),
+            "ann_ms_per_query": 1000 * ann_time / max(len(queries), 1),
+            "nprobe": nprobe or cls._ann_index.nprobe,
+        }
+
+    @classmethod
+    def quantization_accuracy(cls, queries=None, k=1, threshold=0.6, num_queries=200, noise=0.3, seed=0):
+        #Compares the quantized search (first pass + float32 re-rank) against the float32 scan.
+        #Besides recall@k and agreement of the "distance < threshold" decision, reports how far the distances of
+        #the quantized first pass alone are off (what the re-rank corrects) and the memory of both representations
+        if cls._quantized is None:
+            raise RuntimeError("quantization_accuracy: quantization is not enabled")
+        _check_k(k)
+        queries = cls._probe_queries(queries, num_queries, noise, seed)
+
+        with cls._lock:
+            start = time.perf_counter()
+            exact = cls._search_exact(queries, k, use_quantized=False)
+            exact_time = time.perf_counter() - start
+            start = time.perf_counter()
+            quantized = cls._search_exact(queries, k)
+            quantized_time = time.perf_counter() - start
+            # first pass error over all gallery rows, a few queries at a time to bound the temporaries
+            error_sum = 0.0
+            error_max = 0.0
+            for start in range(0, len(queries), 16):
+                chunk = queries[start:start + 16]
+                error = np.abs(cls._quantized.scores(chunk) - chunk @ cls._matrix[:cls._count].T)
+                error_sum += float(error.sum(dtype=np.float64))
+                error_max = max(error_max, float(error.max(initial=0.0)))
+            quantized_bytes = cls._quantized.nbytes()
+            float32_bytes = cls._matrix[:cls._count].nbytes
+
+        found = 0
+        expected = 0
+        agreements = 0
+        distance_errors = []
+        for exact_matches, quantized_matches in zip(exact, quantized):
+            quantized_by_name = {match["name"]: match["distance"] for match in quantized_matches}
+            found += sum(match["name"] in quantized_by_name for match in exact_matches)
+            expected += len(exact_matches)
+            distance_errors.extend(abs(match["distance"] - quantized_by_name[match["name"]])
+                                   for match in exact_matches if match["name"] in quantized_by_name)
+            agreements += _decision(exact_matches, threshold) == _decision(quantized_matches, threshold)
+        return {
+            "mode": cls._quantized.mode,
+            "queries": len(queries),
+            "recall_at_k": found / expected if expected else 1.0,
+            "decision_agreement": agreements / len(queries) if len(queries) else 1.0,
+            "threshold": threshold,
+            "max_distance_error": max(distance_errors, default=0.0),
+            "first_pass_mean_distance_error": error_sum / max(len(queries) * cls._count, 1),
+            "first_pass_max_distance_error": error_max,
+            "rerank": cls._rerank,
+            "exact_ms_per_query": 1000 * exact_time / max(len(queries), 1),
+            "quantized_ms_per_query": 1000 * quantized_time / max(len(queries), 1),
+            # below 1 when the quantized search is slower than the float32 scan
+            "speedup": exact_time / quantized_time if quantized_time else 1.0,
+            "float32_mb": float32_bytes / 2**20,
+            # mapped float32 rows are paged in for the re-rank only, heap rows are always resident
+            "float32_mapped": isinstance(cls._matrix, np.memmap),
+            "quantized_mb": quantized_bytes / 2**20,
+        }
+
+    @classmethod
+    def _probe_queries(cls, queries, num_queries, noise, seed):
+        if queries is None:
+            return cls.sample_queries(num_queries, noise, seed)[0]
+        return normalize_rows(np.asarray(queries, dtype=np.float32))
+
+def _check_k(k):
+    # _top_k_students widens its window until it holds k students, it would never stop for k < 1
+    if k < 1:
+        raise ValueError(f"EmbeddedDb: k must be at least 1, got {k}")
+
+def _decision(matches, threshold):
+    #name that would be accepted as a recognition, None if the best match is too far
+    if matches and matches[0]["distance"] < threshold:
+        return matches[0]["name"]
+    return None
@@ -0,0 +1,187 @@
+import os
+import cv2
+import csv
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from collections import Counter
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import Recognition
+from db import Session, Student, enable_wal, get_student_ids, add_embeds_bulk
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+#Bulk enrollment of student photos, without going through the registration dialog.
+#    python enroll.py photos/                      # photos/<group>/<student name>/*.jpg
+#    python enroll.py photos/ --group CS-101       # photos/<student name>/*.jpg
+#    python enroll.py manifest.csv                 # columns name, group, path (relative to the CSV)
+#Detection and embedding run in a process pool, one batch of photos per task, and the embeddings
+#are written in large transactions. Photos without exactly one face are listed in the report.
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+# failure reasons besides the ones of Recognition.extract_single_face
+UNREADABLE = "unreadable"
+EMBEDDING_FAILED = "embedding_failed"
+
+def find_images(root, group=None):
+    #photos in root/<group>/<name>/ or, when group is given, in root/<name>/
+    root = Path(root)
+    entries = []
+    for path in sorted(p for p in root.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS):
+        folders = path.relative_to(root).parts[:-1]
+        if group is None and len(folders) == 2:
+            entries.append({"name": folders[1], "group": folders[0], "path": str(path)})
+        elif group is not None and len(folders) == 1:
+            entries.append({"name": folders[0], "group": group, "path": str(path)})
+        else:
+            logger.warning(f"enroll: {path} is not in a <group>/<name> folder, skipping")
+    return entries
+
+def read_manifest(manifest_path, group=None):
+    #CSV with the columns name, path and group (group may be left out when given on the command line)
+    manifest_path = Path(manifest_path)
+    entries = []
+    with open(manifest_path, newline="") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            name = (row.get("name") or "").strip()
+            student_group = (row.get("group") or group or "").strip()
+            path = (row.get("path") or "").strip()
+            if not name or not student_group or not path:
+                logger.warning(f"enroll: {manifest_path}:{line} needs name, group and path, skipping")
+                continue
+            entries.append({"name": name, "group": student_group, "path": str(manifest_path.parent / path)})
+    return entries
+
+def _init_worker():
+    setup_logger()
+    Recognition.warm_up()
+
+def process_batch(entries, detector_backend="mtcnn", max_batch_size=Recognition.EMBED_MAX_BATCH_SIZE):
+    #Detects the face in every photo and embeds all of them in one batch.
+    #Returns one (entry, embedding bytes, failure reason) tuple per photo, embedding is None on failure
+    faces = []
+    reasons = []
+    for entry in entries:
+        image = cv2.imread(entry["path"])
+        if image is None:
+            face, reason = None, UNREADABLE
+        else:
+            face, reason = Recognition.extract_single_face(image, detector_backend)
+        faces.append(face)
+        reasons.append(reason)
+    embeddings = Recognition.embed_faces(faces, max_batch_size)
+    results = []
+    for entry, face, reason, embedding in zip(entries, faces, reasons, embeddings):
+        if face is not None and embedding is None:
+            reason = EMBEDDING_FAILED
+        if reason is not None:
+            results.append((entry, None, reason))
+        else:
+            results.append((entry, np.asarray(embedding, dtype=np.float32).tobytes(), None))
+    return results
+
+def write_embeddings(session, rows, student_ids):
+    #Adds (name, group, embedding bytes) rows, creating missing students.
+    #student_ids = {(name, group): id} cache of known students, extended in place. Returns the number of new students
+    new_students = []
+    for name, group, _ in rows:
+        if (name, group) not in student_ids:
+            student = Student(name=name, group=group)
+            session.add(student)
+            new_students.append(student)
+            student_ids[(name, group)] = None
+    if new_students:
+        session.flush()
+        for student in new_students:
+            student_ids[(student.name, student.group)] = student.id
+    add_embeds_bulk(session, [(student_ids[(name, group)], embedding) for name, group, embedding in rows])
+    return len(new_students)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll students in bulk from photo folders or a CSV manifest")
+    parser.add_argument("source", help="directory of photos or CSV manifest (name, group, path)")
+    parser.add_argument("--group", help="group of every student, for a directory with one folder per student")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--batch-size", type=int, default=Recognition.EMBED_MAX_BATCH_SIZE, help="photos per worker task, embedded in one batch")
+    parser.add_argument("--commit-size", type=int, default=1000, help="embeddings written per transaction")
+    parser.add_argument("--detector-backend", default="mtcnn", help="DeepFace detector used to find the face in each photo")
+    parser.add_argument("-r", "--report", default="enrollment_report.json", help="where the JSON report is written")
+    args = parser.parse_args(argv)
+
+    setup_logger()
+    if Path(args.source).suffix.lower() == ".csv":
+        entries = read_manifest(args.source, args.group)
+    else:
+        entries = find_images(args.source, args.group)
+    if not entries:
+        logger.error("enroll: no photos found")
+        return 1
+
+    mode = enable_wal()
+    if str(mode).lower() != "wal":
+        logger.warning(f"enroll: could not enable WAL mode, journal mode is {mode}")
+
+    start = time.perf_counter()
+    failures = []
+    enrolled = 0
+    students_created = 0
+    pending = []
+    batches = [entries[i:i + args.batch_size] for i in range(0, len(entries), args.batch_size)]
+    workers = max(1, min(args.workers, len(batches)))
+    with Session() as session:
+        student_ids = get_student_ids(session)
+        # TensorFlow does not survive fork(), so workers are spawned
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker) as executor:
+            futures = {executor.submit(process_batch, batch, args.detector_backend, args.batch_size): batch for batch in batches}
+            for done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.error(f"enroll: batch of {len(futures[future])} photos failed: {e}")
+                    results = [(entry, None, f"error: {e}") for entry in futures[future]]
+                for entry, embedding, reason in results:
+                    if embedding is None:
+                        failures.append(dict(entry, reason=reason))
+                    else:
+                        pending.append((entry["name"], entry["group"], embedding))
+                if len(pending) >= args.commit_size or done == len(futures):
+                    students_created += write_embeddings(session, pending, student_ids)
+                    session.commit()
+                    enrolled += len(pending)
+                    pending = []
+                    logger.info(f"enroll: {done}/{len(futures)} batches, {enrolled} photos enrolled, {len(failures)} failed")
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "source": args.source,
+        "photos": len(entries),
+        "enrolled": enrolled,
+        "students_created": students_created,
+        "failed": len(failures),
+        "failure_reasons": dict(Counter(failure["reason"] for failure in failures)),
+        "workers": workers,
+        "wall_time_s": elapsed,
+        "photos_per_s": len(entries) / elapsed if elapsed > 0 else 0.0,
+        "failures": failures,
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    for failure in failures:
+        logger.warning(f"enroll: {failure['path']} ({failure['name']}, {failure['group']}): {failure['reason']}")
+    # the gallery snapshot no longer matches the database and is rebuilt on the next start
+    logger.info(f"enroll: {enrolled}/{len(entries)} photos enrolled, {students_created} new students, "
+                f"in {elapsed:.1f}s, report written to {args.report}")
+    return 0 if enrolled else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
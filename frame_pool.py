@@ -0,0 +1,40 @@
+import threading
+import numpy as np
+
+import metrics
+
+class FramePool:
+    #Recycles frame-sized arrays so the per-frame path (capture, colour conversion, display) stops allocating
+    #a new multi-megabyte array for every frame. acquire() hands out a free array of the requested shape,
+    #release() gives it back once no stage holds it anymore. When every array is in use a new one is
+    #allocated (counted in mpface_frame_allocations_total), so a missing release() costs memory churn, not correctness
+    def __init__(self, name, size=4, dtype=np.uint8):
+        #name = label of the allocation metric, size = arrays kept for reuse
+        self.name = name
+        self.size = size
+        self.dtype = dtype
+        self.shape = None
+        self.allocations = 0
+        self._free = []
+        self._lock = threading.Lock()
+        self._allocations_metric = metrics.FRAME_ALLOCATIONS.labels(name)
+
+    def acquire(self, shape):
+        shape = tuple(shape)
+        with self._lock:
+            if shape != self.shape:
+                # resolution changed, the old arrays are useless
+                self.shape = shape
+                self._free = []
+            if self._free:
+                return self._free.pop()
+            self.allocations += 1
+        self._allocations_metric.inc()
+        return np.empty(shape, dtype=self.dtype)
+
+    def release(self, frame):
+        if frame is None:
+            return
+        with self._lock:
+            if frame.shape == self.shape and frame.dtype == self.dtype and len(self._free) < self.size and not any(frame is free for free in self._free):
+                self._free.append(frame)
@@ -0,0 +1,92 @@
+import os
+import json
+import struct
+import tempfile
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Single file snapshot of the in-memory gallery, loaded with np.memmap so startup does not touch the ORM.
+#Layout: magic, format version and header length (little endian uint32), a JSON header, then the
+#float32 gallery matrix and the int64 embed ids, both aligned to ALIGNMENT bytes.
+#The header stores the db version (see db.get_gallery_version) the snapshot was written from,
+#a reader compares it with the database and falls back to SQL when they differ.
+
+MAGIC = b"MPFGAL\0\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_snapshot(path, db_version, students, matrix, embed_ids):
+    #students = [[name, group, number of rows], ...] in row order, the rows of a student are contiguous
+    #matrix = (count, dim) float32 gallery rows, embed_ids = embed id of every row
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    embed_ids = np.ascontiguousarray(embed_ids, dtype="<i8")
+    header = {
+        "db_version": db_version,
+        "count": int(matrix.shape[0]),
+        "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+        "students": students,
+    }
+    # offsets depend on the header length, which depends on the offsets: reserve room for them first
+    header["matrix_offset"] = header["embed_ids_offset"] = 0
+    header_size = len(json.dumps(header).encode("utf-8")) + 64
+    header["matrix_offset"] = _align(_PREAMBLE.size + header_size)
+    header["embed_ids_offset"] = _align(header["matrix_offset"] + matrix.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8").ljust(header_size)
+
+    # write next to the target and rename, readers never see a half written file; the temporary file is unique
+    # to this writer, several processes (offline.py workers) may write the snapshot at the same time
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            f.seek(header["matrix_offset"])
+            f.write(matrix.tobytes())
+            f.seek(header["embed_ids_offset"])
+            f.write(embed_ids.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def read_header(path):
+    #returns the JSON header, or None if the file is missing or not a snapshot of this format version
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                logger.info(f"gallery_snapshot: {path} has an unsupported format, ignoring it")
+                return None
+            return json.loads(f.read(header_length))
+    except (OSError, struct.error, ValueError) as e:
+        logger.warning(f"gallery_snapshot: could not read {path}: {e}")
+        return None
+
+def read_snapshot(path):
+    #Maps a snapshot read-only. Returns a dict with the header fields plus 'matrix' and 'embed_ids'
+    #(np.memmap views, nothing is copied) or None if the file is missing or unreadable
+    header = read_header(path)
+    if header is None:
+        return None
+    count, dim = header["count"], header["dim"]
+    try:
+        if count == 0:
+            # an empty file region cannot be mapped
+            header["matrix"] = np.empty((0, dim), dtype=np.float32)
+            header["embed_ids"] = np.empty(0, dtype=np.int64)
+        else:
+            header["matrix"] = np.memmap(path, dtype="<f4", mode="r", offset=header["matrix_offset"], shape=(count, dim))
+            header["embed_ids"] = np.memmap(path, dtype="<i8", mode="r", offset=header["embed_ids_offset"], shape=(count,))
+    except (OSError, ValueError) as e:
+        logger.warning(f"gallery_snapshot: could not map {path}: {e}")
+        return None
+    return header
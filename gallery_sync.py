@@ -0,0 +1,33 @@
+import logging
+import threading
+
+from embedded_db import EmbeddedDb
+
+logger = logging.getLogger(__name__)
+
+class GallerySync:
+    #Polls the embed change log on a background thread and applies what other stations enrolled or deleted
+    #to EmbeddedDb (see EmbeddedDb.sync), so stations sharing a database see each other's enrollments without a restart.
+    #A poll is one indexed query past the last seen revision; the capture loop never waits for it
+    def __init__(self, interval=2.0):
+        #interval = seconds between polls
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                EmbeddedDb.sync()
+            except Exception as e:
+                logger.error(f"GallerySync: sync failed: {e}")
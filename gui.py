@@ -1,15 +1,46 @@
 import sys
 from PyQt5.QtWidgets import (
-    QFileDialog, QMessageBox, QDialog, QCheckBox, QFormLayout, QDialogButtonBox, QLineEdit, QLabel, QComboBox, QSplitter, QVBoxLayout, QHBoxLayout, QWidget, QListWidget, QFrame, QPushButton, QSizePolicy, QAbstractItemView
+    QApplication, QFileDialog, QMessageBox, QDialog, QCheckBox, QFormLayout, QDialogButtonBox, QLineEdit, QLabel, QComboBox, QSplitter, QVBoxLayout, QHBoxLayout, QGridLayout, QWidget, QListWidget, QFrame, QPushButton, QSizePolicy, QAbstractItemView
 )
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtPrintSupport import QPrinter, QPrintDialog
 from db import Session, get_all_students
 import time
+import queue
+import threading
 import cv2
+import metrics
 from embedded_db import EmbeddedDb
 
+# used when the screen does not report its refresh rate
+DEFAULT_REFRESH_RATE = 60.0
+
+def frame_to_pixmap(frame, size):
+    #converts an RGB frame to a QPixmap that fits size (keeping the aspect ratio).
+    #The frame is resized once with OpenCV's bilinear filter before the conversion,
+    #so Qt copies the small image and never rescales the full frame
+    h, w, ch = frame.shape
+    scale = min(size.width() / w, size.height() / h)
+    if scale > 0 and scale != 1.0:
+        target = (max(1, int(w * scale)), max(1, int(h * scale)))
+        frame = cv2.resize(frame, target, interpolation=cv2.INTER_LINEAR)
+        h, w, ch = frame.shape
+    bytes_per_line = ch * w
+    qt_img = QImage(frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
+    return QPixmap.fromImage(qt_img)
+
+def _release_frame(frame, release):
+    if release is not None:
+        release(frame)
+
+def _put_answer(answers, answer):
+    # a prompt is answered once, by the dialog or by AppGui.cancel_prompts
+    try:
+        answers.put_nowait(answer)
+    except queue.Full:
+        pass
+
 class RegistrationWindow(QDialog):
     def __init__(self, camera_index=0, parent=None):
         super().__init__(parent)
@@ -103,11 +134,14 @@ class RegistrationWindow(QDialog):
                 QMessageBox.warning(self, "Error", "Please capture a photo.")
                 return
             
-        from Recognition import embed_face, detect_and_extract_face_from_image
+        from Recognition import embed_face, extract_single_face, MULTIPLE_FACES
         
-        extracted_face = detect_and_extract_face_from_image(self.captured_image)
+        extracted_face, reason = extract_single_face(self.captured_image)
         if extracted_face is None:
-            QMessageBox.warning(self, "Error", "No face detected in the captured photo.")
+            if reason == MULTIPLE_FACES:
+                QMessageBox.warning(self, "Error", "More than one face detected in the captured photo.")
+            else:
+                QMessageBox.warning(self, "Error", "No face detected in the captured photo.")
             return
         embedding = embed_face(extracted_face)
 
@@ -126,7 +160,7 @@ class RegistrationWindow(QDialog):
             embed = Embed(student=student, embedding=np.array(embedding, dtype=np.float32).tobytes())
             session.add(embed)
             session.commit()
-            EmbeddedDb.add_to_embedded_db(name, group, embedding)
+            EmbeddedDb.add_to_embedded_db(name, group, embedding, embed.id)
 
         QMessageBox.information(self, "Success", f"Student {name} registered.")
         self.accept()
@@ -216,15 +250,45 @@ class InfoDialog(QDialog):
         return self.subject_input.text(), self.group_input.text()
 
 class AppGui(QWidget):
-    def __init__(self):
+    #The processing loop runs on its own thread: update_frame only stores the newest frame of a camera,
+    #a timer at the display refresh rate converts and shows it, frames replaced before a tick are never drawn.
+    #add_student, prompt_for_info and request_close may be called from any thread, they are forwarded
+    #to the GUI thread through queued signals. The GUI thread never blocks a caller: the answer of a prompt
+    #comes back through a queue the caller polls, so closing the window cannot leave it waiting
+    _add_student_requested = pyqtSignal(str, str)
+    _prompt_requested = pyqtSignal(object, object)
+    _close_requested = pyqtSignal()
+
+    def __init__(self, num_cameras=1, registration_enabled=True):
+        #registration_enabled = False in thin client mode: students would be enrolled into the station's own
+        #database and gallery, which the recognition server never searches
         super().__init__()
         self.setWindowTitle("Face Recognition Attendance")
         self.subject_name = ""
         self.group = ""
+        self.num_cameras = num_cameras
+        self.registration_enabled = registration_enabled
         self.prompt_for_subject_and_group()
         self.init_ui()
         self.students = set()
 
+        self._frame_lock = threading.Lock()
+        self._latest_frames = [None] * num_cameras # (newest RGB frame, release callback) per camera, None once shown
+        self._live_registration = False
+        self._prompt_lock = threading.Lock()
+        self._pending_prompts = set() # answer queues of the prompts requested from other threads
+        self._prompts_cancelled = False
+        self.live_registration_checkbox.toggled.connect(self._set_live_registration)
+        self._add_student_requested.connect(self._add_student, Qt.QueuedConnection)
+        self._prompt_requested.connect(self._answer_prompt, Qt.QueuedConnection)
+        self._close_requested.connect(self.close, Qt.QueuedConnection)
+
+        screen = QApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else DEFAULT_REFRESH_RATE
+        self.render_timer = QTimer(self)
+        self.render_timer.timeout.connect(self._render_frames)
+        self.render_timer.start(int(1000 / refresh_rate))
+
     def prompt_for_subject_and_group(self):
         dialog = InfoDialog()
         if dialog.exec_() == QDialog.Accepted:
@@ -239,16 +303,25 @@ class AppGui(QWidget):
         self.subject_label.setAlignment(Qt.AlignCenter)
         main_layout.addWidget(self.subject_label)
 
-        self.video_label = QLabel()
-        self.video_label.setAlignment(Qt.AlignCenter)
-        self.video_label.setMinimumSize(960, 720)
+        # one view per camera, in a grid of two columns when there are several
+        self.video_labels = []
+        video_grid = QGridLayout()
+        columns = 1 if self.num_cameras == 1 else 2
+        for index in range(self.num_cameras):
+            video_label = QLabel()
+            video_label.setAlignment(Qt.AlignCenter)
+            video_label.setMinimumSize(960 // columns, 720 // columns)
+            video_grid.addWidget(video_label, index // columns, index % columns)
+            self.video_labels.append(video_label)
+        self.video_label = self.video_labels[0]
         # splitter.addWidget(self.video_label)
 
         self.live_registration_checkbox = QCheckBox("Live registration")
         self.live_registration_checkbox.setChecked(False)
+        self.live_registration_checkbox.setEnabled(self.registration_enabled)
 
         camera_vbox = QVBoxLayout()
-        camera_vbox.addWidget(self.video_label)
+        camera_vbox.addLayout(video_grid)
         camera_vbox.addWidget(self.live_registration_checkbox)
         camera_widget = QWidget()
         camera_widget.setLayout(camera_vbox)
@@ -269,6 +342,11 @@ class AppGui(QWidget):
 
         self.register_btn = QPushButton("Manual Registration")
         self.register_btn.clicked.connect(self.open_registration_window)
+        self.register_btn.setEnabled(self.registration_enabled)
+        if not self.registration_enabled:
+            tooltip = "Enroll students on the recognition server, this station only sends it faces"
+            self.register_btn.setToolTip(tooltip)
+            self.live_registration_checkbox.setToolTip(tooltip)
         vbox.addWidget(self.register_btn)
 
         self.setLayout(main_layout)
@@ -279,26 +357,88 @@ class AppGui(QWidget):
         reg_win.exec_()
 
     def is_live_registration_enabled(self) -> bool:
-        return self.live_registration_checkbox.isChecked()
+        # mirrored from the checkbox, widgets must not be read from the processing thread
+        return self.registration_enabled and self._live_registration
+
+    def _set_live_registration(self, checked):
+        self._live_registration = checked
     
-    def update_frame(self, frame):
-        h, w, ch = frame.shape
-        bytes_per_line = ch * w
-        qt_img = QImage(frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qt_img)
-        self.video_label.setPixmap(pixmap.scaled(
-            self.video_label.size(),
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
-        ))
+    def update_frame(self, frame, camera=0, release=None):
+        #Hands over the newest annotated RGB frame, cheap enough to call from the processing loop.
+        #The frame must not be modified afterwards; release(frame) is called once it was shown or skipped,
+        #e.g. to return it to a FramePool
+        with self._frame_lock:
+            replaced = self._latest_frames[camera]
+            self._latest_frames[camera] = (frame, release)
+        if replaced is not None:
+            metrics.DISPLAY_FRAMES_SKIPPED.inc()
+            _release_frame(*replaced)
+
+    def _render_frames(self):
+        with self._frame_lock:
+            frames = self._latest_frames
+            self._latest_frames = [None] * self.num_cameras
+        for video_label, latest in zip(self.video_labels, frames):
+            if latest is None:
+                continue
+            with metrics.stage("display").time():
+                video_label.setPixmap(frame_to_pixmap(latest[0], video_label.size()))
+            _release_frame(*latest)
+
+    def _on_gui_thread(self):
+        return QThread.currentThread() is self.thread()
     
-    def prompt_for_info(self, frame):
+    def prompt_for_info(self, frame, stop_event=None):
+        #Asks who the face is, returns the selection or None if the dialog was cancelled.
+        #From another thread the dialog is requested on the GUI thread and the answer is awaited in short
+        #intervals, giving up (None) once stop_event is set or the prompts were cancelled by cancel_prompts
+        if self._on_gui_thread():
+            return self._prompt_for_info(frame)
+        answers = queue.Queue(maxsize=1)
+        with self._prompt_lock:
+            if self._prompts_cancelled:
+                return None
+            self._pending_prompts.add(answers)
+        try:
+            self._prompt_requested.emit(frame, answers)
+            while True:
+                try:
+                    return answers.get(timeout=0.1)
+                except queue.Empty:
+                    if stop_event is not None and stop_event.is_set():
+                        return None
+        finally:
+            with self._prompt_lock:
+                self._pending_prompts.discard(answers)
+
+    def cancel_prompts(self):
+        #answers every pending and future prompt with None, called before waiting for the processing thread
+        with self._prompt_lock:
+            self._prompts_cancelled = True
+            pending = list(self._pending_prompts)
+        for answers in pending:
+            _put_answer(answers, None)
+
+    def _answer_prompt(self, frame, answers):
+        with self._prompt_lock:
+            if self._prompts_cancelled:
+                return
+        _put_answer(answers, self._prompt_for_info(frame))
+
+    def _prompt_for_info(self, frame):
         dialog = PromptDialog(frame)
-        if dialog.exec_() == QDialog.Accepted:
-            return dialog.get_selection()
-        return None
+        return dialog.get_selection() if dialog.exec_() == QDialog.Accepted else None
+
+    def request_close(self):
+        self._close_requested.emit()
 
     def add_student(self, name, group):
+        if not self._on_gui_thread():
+            self._add_student_requested.emit(name, group)
+            return
+        self._add_student(name, group)
+
+    def _add_student(self, name, group):
         if (name, group) not in self.students:
             self.students.add((name, group))
             self.student_list.addItem(name)
@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+from recognition_client import RecognitionClient, encode_face
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+#Load test of recognition_server: concurrent clients send synthetic crops, throughput and latency are
+#reported for every micro-batch window.
+#    python load_test.py --windows 0 2 5 10 20          # starts a local server per window (loads the model once)
+#    python load_test.py --url http://host:5000         # tests a running server with its own window
+
+def run_clients(url, clients, requests_per_client, faces_per_request, seed=0):
+    #runs the clients on threads, returns (latencies in seconds, batch sizes seen, wall time, errors)
+    rng = np.random.default_rng(seed)
+    # encoded once, the clients measure the server and not the JPEG encoder
+    encoded = [encode_face(rng.integers(0, 256, (224, 224, 3), dtype=np.uint8)) for _ in range(faces_per_request)]
+    latencies = []
+    batch_sizes = []
+    errors = []
+    lock = threading.Lock()
+
+    def client_loop():
+        client = RecognitionClient(url, timeout=30.0)
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            try:
+                results = client.post_faces(encoded, k=1)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                batch_sizes.append(results[0]["batch_size"] if results else 0)
+
+    threads = [threading.Thread(target=client_loop, name=f"load-client-{i}") for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, batch_sizes, time.perf_counter() - start, errors
+
+def summarize(batch_window, latencies, batch_sizes, wall_time, errors, faces_per_request):
+    latencies_ms = 1000 * np.asarray(latencies) if latencies else np.zeros(1)
+    return {
+        "batch_window_ms": None if batch_window is None else 1000 * batch_window,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": wall_time,
+        "requests_per_s": len(latencies) / wall_time,
+        "faces_per_s": len(latencies) * faces_per_request / wall_time,
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_batch_faces": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+    }
+
+def start_local_server(batch_window, max_batch_size, load):
+    #serves create_app on a free local port from a background thread, returns (url, http server, app)
+    from werkzeug.serving import make_server
+    from recognition_server import create_app
+    app = create_app(batch_window, max_batch_size, load=load)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of recognition_server against the micro-batch window")
+    parser.add_argument("--url", help="test a running server instead of starting local ones")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 2, 5, 10, 20], help="batch windows in milliseconds (local servers only)")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client threads, i.e. stations")
+    parser.add_argument("--requests", type=int, default=50, help="requests per client")
+    parser.add_argument("--faces-per-request", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args(argv)
+
+    setup_logger()
+    results = []
+    if args.url:
+        RecognitionClient(args.url).wait_until_ready()
+        measurement = run_clients(args.url, args.clients, args.requests, args.faces_per_request)
+        results.append(summarize(None, *measurement, args.faces_per_request))
+    else:
+        for i, window_ms in enumerate(args.windows):
+            # the model and the gallery are loaded by the first server and reused by the next ones
+            url, server, app = start_local_server(window_ms / 1000, args.max_batch_size, load=(i == 0))
+            # warm-up round, not measured
+            run_clients(url, args.clients, 2, args.faces_per_request)
+            measurement = run_clients(url, args.clients, args.requests, args.faces_per_request)
+            server.shutdown()
+            app.config["batcher"].stop()
+            results.append(summarize(window_ms / 1000, *measurement, args.faces_per_request))
+
+    for result in results:
+        window = "server" if result["batch_window_ms"] is None else f"{result['batch_window_ms']:.1f}ms"
+        print(f"window {window:>8}: {result['requests_per_s']:8.1f} req/s  {result['faces_per_s']:8.1f} faces/s  "
+              f"p50 {result['latency_p50_ms']:7.1f}ms  p99 {result['latency_p99_ms']:7.1f}ms  "
+              f"batch {result['mean_batch_faces']:5.1f} faces  errors {result['errors']}", file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    return 1 if any(result["errors"] for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
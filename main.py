@@ -1,18 +1,25 @@
 import cv2
-import mediapipe as mp
 import Tracking
 import Recognition
-from pathlib import Path
 from gui import AppGui
 from PyQt5.QtWidgets import QApplication
 import sys
+import time
+import threading
+import argparse
 import numpy as np
 from PyQt5.QtCore import Qt
 
-from Recognition import compare_embeddings
-
-from embedded_db import EmbeddedDb
+from embedded_db import EmbeddedDb, MATCH_THRESHOLD
 from logger import setup_logger
+from startup import StartupOrchestrator
+from recognition_worker import RecognitionWorker
+from capture import FrameGrabber
+from frame_pool import FramePool
+from scheduler import StageScheduler
+from gallery_sync import GallerySync
+from detection import RegionDetector, TiledDetector, run_detector
+import metrics
 import logging
 from db import Session, Student, Embed
 
@@ -20,124 +27,344 @@ setup_logger()
 
 logger = logging.getLogger(__name__)
 
-EmbeddedDb.populate_db()
-embedded_db = EmbeddedDb.get()
+#initializing Recognition
+face_recognition = Recognition
 
+def load_gallery(quantization=None, ann_nprobe=None):
+    #ann_nprobe = clusters scanned per query by the approximate index, None keeps the exact search
+    EmbeddedDb.populate_db()
+    if ann_nprobe:
+        # approximate search only kicks in for large galleries (see EmbeddedDb.enable_ann_index)
+        EmbeddedDb.enable_ann_index(nprobe=ann_nprobe)
+    if quantization:
+        # compact int8/float16 copy scanned first, exact float32 re-rank of mapped rows: saves memory, not time
+        EmbeddedDb.enable_quantization(quantization)
 
-# Initialize MediaPipe Face Detection
-mp_face_detection = mp.solutions.face_detection
+def create_face_detector():
+    # MediaPipe is imported here so that its import cost is paid in the background
+    import mediapipe as mp
+    return mp.solutions.face_detection.FaceDetection(
+                                    model_selection=1,
+                                    min_detection_confidence=0.5)
 
-# Initialize video capture
-cap = cv2.VideoCapture(0)
+def create_tiled_detector(rows, columns, overlap, workers=None):
+    # one MediaPipe instance per worker thread, the tiles of a frame are detected in parallel
+    return TiledDetector(create_face_detector, rows, columns, overlap, workers)
 
-# Frame skipping
-frame_count = 0
-frame_skip = 2 # Process every (frame_skip + 1)-th frame
+def parse_tile_grid(grid):
+    # "ROWSxCOLUMNS", e.g. 2x3
+    try:
+        rows, columns = (int(value) for value in grid.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected ROWSxCOLUMNS, got {grid!r}")
+    if rows < 1 or columns < 1:
+        raise argparse.ArgumentTypeError(f"tile grid must be at least 1x1, got {grid!r}")
+    return rows, columns
 
+def parse_tile_overlap(value):
+    # fraction of a tile shared with its neighbour, a tile must still advance past the previous one
+    overlap = float(value)
+    if not 0.0 <= overlap < 1.0:
+        raise argparse.ArgumentTypeError(f"tile overlap must be in [0, 1), got {value!r}")
+    return overlap
 
-#initializing FaceTracker
-face_tracker = Tracking.FaceTracker()
-#initializing Recognition
-face_recognition = Recognition
+def create_gui(num_cameras=1, registration_enabled=True):
+    app = QApplication(sys.argv)
+    app.setStyle('Fusion')
+    app.setAttribute(Qt.AA_EnableHighDpiScaling)
+    app.setAttribute(Qt.AA_UseHighDpiPixmaps)
+    app.setStyleSheet("QMainWindow {background-color: #2E2E2E;}")
+    app_gui = AppGui(num_cameras, registration_enabled)
+    app_gui.show()
+    return app, app_gui
 
-# initializing gui
-app = QApplication(sys.argv)
-app.setStyle('Fusion')
-app.setAttribute(Qt.AA_EnableHighDpiScaling)
-app.setAttribute(Qt.AA_UseHighDpiPixmaps)
-app.setStyleSheet("QMainWindow {background-color: #2E2E2E;}")
-app_gui = AppGui()
-app_gui.show()
+def submit_recognition_jobs(face_tracker, recognition_worker, camera_index=0):
+    #queues the best crop of every unrecognized track that got a better crop since its last attempt
+    #and is not already being recognized; jobs are keyed by (camera index, track id)
+    for face_data in face_tracker.get_all_tracked_faces_data():
+        if face_data["name"] is None and not face_data["pending"] and face_data["has_new_best_face"]:
+            best_face = face_tracker.take_best_face(face_data["id"])
+            recognition_worker.submit((camera_index, face_data["id"]), face_recognition.resize_face(best_face))
+            face_tracker.set_recognition_pending(face_data["id"], True)
 
-with mp_face_detection.FaceDetection(
-                                    model_selection=1,
-                                    min_detection_confidence=0.5) as face_detection:
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            logger.error("Error: Cannot read camera input.")
-            break
-
-        if frame_count % (frame_skip + 1) == 0:
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            results = face_detection.process(frame_rgb)
-            current_detections = []
-
-            if results.detections:
-                current_detections = list(results.detections)
-            face_tracker.update_tracks(current_detections, frame.shape)
-
-            #drawing the annotations on the frame
+def parse_source(source):
+    # camera indices are given as numbers, anything else is a video file or stream URL
+    return int(source) if source.isdigit() else source
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Live attendance with face recognition")
+    parser.add_argument("--source", dest="sources", action="append", type=parse_source,
+                        help="camera index or video path, repeat for several cameras (default: camera 0)")
+    parser.add_argument("--server", help="URL of a recognition_server: thin client mode, no local model or gallery (enroll students on the server, registration is turned off here)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics (default 0: off)")
+    parser.add_argument("--metrics-overlay", action="store_true", help="draw per-stage latency percentiles on the video")
+    parser.add_argument("--ann-index", action="store_true",
+                        help="search galleries of 10000+ embeddings through the approximate IVF index: faster, but a few "
+                             "match decisions can change (check EmbeddedDb.ann_recall on your gallery first)")
+    parser.add_argument("--ann-nprobe", type=int, default=8, help="with --ann-index: clusters scanned per query, higher = closer to exact")
+    parser.add_argument("--gallery-quantization", choices=("int8", "float16"),
+                        help="keep an int8/float16 copy of the gallery in memory and the float32 rows mapped from disk for the "
+                             "re-rank: less memory for very large galleries, the search is not faster (see quantization_report.py)")
+    parser.add_argument("--detection-mode", choices=("full", "roi", "tiled"), default="full",
+                        help="full: detect on the whole frame, roi: only around the tracked faces between full-frame sweeps, "
+                             "tiled: detect on overlapping tiles in parallel (high resolution cameras)")
+    parser.add_argument("--full-sweep-interval", type=int, default=5, help="roi mode: every how many detections the whole frame is searched")
+    parser.add_argument("--tile-grid", type=parse_tile_grid, default=(2, 2), help="tiled mode: ROWSxCOLUMNS tiles (default 2x2)")
+    parser.add_argument("--tile-overlap", type=parse_tile_overlap, default=0.15, help="tiled mode: fraction of a tile shared with its neighbours")
+    parser.add_argument("--detection-workers", type=int, help="tiled mode: detector instances and threads (default: one per tile, at most one per core)")
+    # unknown arguments are left for Qt
+    args, _ = parser.parse_known_args()
+    if args.ann_nprobe < 1:
+        parser.error("--ann-nprobe must be at least 1")
+    args.sources = args.sources or [0]
+    return args
+
+class CameraPipeline:
+    #One video source with its own capture thread, FaceTracker and StageScheduler.
+    #All cameras share the detector, the embedding model, the gallery and the recognition worker
+    def __init__(self, index, source, detection_mode="full", full_sweep_interval=5, frame_event=None):
+        #frame_event = shared by the cameras, set whenever any of them has a new frame (see run_vision_loop)
+        self.index = index
+        self.source = source
+        # frames are grabbed on their own thread so the loop always gets the newest one
+        self.cap = FrameGrabber(source, frame_event=frame_event)
+        self.face_tracker = Tracking.FaceTracker()
+        # Which stages run on a given frame is decided from measured stage costs (see StageScheduler)
+        self.scheduler = StageScheduler()
+        # RGB frames for detection and display, handed back by the GUI once shown or skipped
+        self.rgb_pool = FramePool("display")
+        # in roi mode the detector only looks around the tracked faces, new faces are found on the full sweeps
+        self.region_detector = RegionDetector(full_sweep_interval=full_sweep_interval) if detection_mode == "roi" else None
+
+    def detect(self, face_detection, frame_rgb, capture_time):
+        if self.region_detector is None:
+            return run_detector(face_detection, frame_rgb)
+        track_boxes = self.face_tracker.get_predicted_boxes(frame_rgb.shape, capture_time)
+        return self.region_detector.detect(face_detection, frame_rgb, track_boxes)
+
+    def process_frame(self, frame, capture_time, face_detection, recognition_ready, recognition_worker, app_gui, metrics_overlay=False):
+        #Detects or predicts the faces of one frame, queues recognition jobs and shows the annotated frame.
+        #The frame is converted to RGB once, into a pooled array: detection reads it, then the annotations are
+        #drawn into it and it goes to the display. Crops are views of the BGR frame, copied only when kept
+        face_tracker = self.face_tracker
+        scheduler = self.scheduler
+        new_unrecognized, retry_unrecognized = face_tracker.count_unrecognized()
+        plan = scheduler.plan_frame(new_unrecognized, retry_unrecognized,
+                                    recognition_worker.pending_jobs(), face_tracker.get_motion_level())
+
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.rgb_pool.acquire(frame.shape))
+        if face_detection is not None and plan["detect"]:
+            with scheduler.measure("detection"):
+                current_detections = self.detect(face_detection, frame_rgb, capture_time)
+            with scheduler.measure("tracking"):
+                face_tracker.update_tracks(current_detections, frame.shape, capture_time)
+            if recognition_ready:
+                with scheduler.measure("recognition"):
+                    face_recognition.update_best_faces(frame, face_tracker)
+        else:
+            with scheduler.measure("tracking"):
+                face_tracker.predict_tracks(frame.shape, capture_time)
+
+        #Face Recognition part: queue the best crops of unrecognized faces, the worker embeds them
+        if recognition_ready and plan["recognize"]:
+            with scheduler.measure("recognition"):
+                submit_recognition_jobs(face_tracker, recognition_worker, self.index)
+
+        with scheduler.measure("rendering"):
+            #drawing the annotations on the RGB frame (colours are given as RGB here)
             #displaying number of tracked faces
             num_tracked_faces= face_tracker.get_tracked_faces_count()
             tracked_faces_text = f"Tracked faces: { num_tracked_faces }"
-            cv2.putText(frame, tracked_faces_text, (10,30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255,0,0), 2 )
-
-            #Face Recognition part:
-            if frame_count % 5 == 0: # every 5 frames run face recognition
-                tracked_faces_for_recognition = face_tracker.get_all_tracked_faces_data()
-                for face_data in tracked_faces_for_recognition:
-                    face_id = face_data["id"]
-                    current_name = face_data["name"]
-                    relative_bbox = face_data["bbox_relative"]
-                    if current_name is None and relative_bbox:
-                        extracted_face = face_recognition.extract_face(frame, relative_bbox)
-                        live_embedding = face_recognition.embed_face(extracted_face)
-                        if live_embedding is not None:
-                            best_match_name = None
-                            best_match_group = None
-                            best_match_distance = float('inf')
-                            for db_name, db_data in embedded_db.items():
-                                for db_embedding in db_data["embeddings"]:
-                                    distance = face_recognition.get_distance(live_embedding, db_embedding)
-
-                                    if distance < best_match_distance:
-                                        best_match_distance = distance
-                                        best_match_name = db_name
-                                        best_match_group = db_data["group"]
-                                    # if face_recognition.compare_embeddings(live_embedding, db_embedding):
-                                    #     face_tracker.update_face_name_by_id(face_id, db_name)
-                                    #     recognized = True
-                                    #     app_gui.add_student(db_name, db_data["group"])
-                                    #     break
-                            recognized = False
-                            if best_match_name is not None and best_match_distance < 0.6:
-                                face_tracker.update_face_name_by_id(face_id, best_match_name)
-                                recognized = True
-                                app_gui.add_student(best_match_name, best_match_group)
-                            if not recognized and app_gui.is_live_registration_enabled():
-                                res = app_gui.prompt_for_info(cv2.cvtColor(extracted_face, cv2.COLOR_BGR2RGB))
-                                if res:
-                                    if res["new"]:
-                                        with Session() as session:
-                                            new_student = Student(name=res["name"], group=res["group"])
-                                            embed = Embed(student=new_student, embedding=np.array(live_embedding, dtype=np.float32).tobytes())
-                                            session.add(new_student)
-                                            session.add(embed)
-                                            session.commit()
-                                            EmbeddedDb.add_to_embedded_db(new_student.name, new_student.group, live_embedding)
-                                            face_tracker.update_face_name_by_id(face_id, res["name"])
-                                            app_gui.add_student(new_student.name, new_student.group)
-                                    else:
-                                        with Session() as session:
-                                            student = res["student"]
-                                            if student not in embedded_db:
-                                                embed = Embed(student=student, embedding=np.array(live_embedding, dtype=np.float32).tobytes())
-                                                session.add(embed)
-                                                session.commit()
-                                                EmbeddedDb.add_to_embedded_db(student.name, student.group, live_embedding)
-                                                face_tracker.update_face_name_by_id(face_id, student.name)
-                                                app_gui.add_student(student.name, student.group)
-
-
-            face_tracker.draw_annotations(frame)
-            new_frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            app_gui.update_frame(new_frame_rgb)
-
-        frame_count += 1
-        # update the gui
-        app.processEvents()
-
-# Release capture
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+            cv2.putText(frame_rgb, tracked_faces_text, (10,30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0,0,255), 2 )
+            face_tracker.draw_annotations(frame_rgb)
+            if metrics_overlay:
+                metrics.draw_overlay(frame_rgb, color=(0, 255, 255))
+            app_gui.update_frame(frame_rgb, self.index, self.rgb_pool.release)
+
+def handle_recognition_result(face_id, result, face_tracker, app_gui, stop_event=None):
+    embedded_db = EmbeddedDb.get()
+    # the track may have expired while its crop was being recognized
+    if not face_tracker.set_recognition_pending(face_id, False):
+        metrics.RECOGNITIONS.labels("expired").inc()
+        return
+    if result["embedding"] is None:
+        metrics.RECOGNITIONS.labels("failed").inc()
+        return
+    extracted_face = result["face"]
+    live_embedding = result["embedding"]
+    matches = result["matches"]
+    best_match_name = None
+    best_match_group = None
+    best_match_distance = float('inf')
+    if matches:
+        best_match_name = matches[0]["name"]
+        best_match_group = matches[0]["group"]
+        best_match_distance = matches[0]["distance"]
+    recognized = False
+    if best_match_name is not None and best_match_distance < MATCH_THRESHOLD:
+        face_tracker.update_face_name_by_id(face_id, best_match_name)
+        recognized = True
+        app_gui.add_student(best_match_name, best_match_group)
+    metrics.RECOGNITIONS.labels("matched" if recognized else "unmatched").inc()
+    if not recognized and app_gui.is_live_registration_enabled():
+        # returns None without an answer once the app is closing
+        res = app_gui.prompt_for_info(cv2.cvtColor(extracted_face, cv2.COLOR_BGR2RGB), stop_event)
+        if res:
+            if res["new"]:
+                with Session() as session, metrics.stage("db_write").time():
+                    new_student = Student(name=res["name"], group=res["group"])
+                    embed = Embed(student=new_student, embedding=np.array(live_embedding, dtype=np.float32).tobytes())
+                    session.add(new_student)
+                    session.add(embed)
+                    session.commit()
+                    EmbeddedDb.add_to_embedded_db(new_student.name, new_student.group, live_embedding, embed.id)
+                    face_tracker.update_face_name_by_id(face_id, res["name"])
+                    app_gui.add_student(new_student.name, new_student.group)
+            else:
+                with Session() as session, metrics.stage("db_write").time():
+                    student = res["student"]
+                    if student not in embedded_db:
+                        embed = Embed(student=student, embedding=np.array(live_embedding, dtype=np.float32).tobytes())
+                        session.add(embed)
+                        session.commit()
+                        EmbeddedDb.add_to_embedded_db(student.name, student.group, live_embedding, embed.id)
+                        face_tracker.update_face_name_by_id(face_id, student.name)
+                        app_gui.add_student(student.name, student.group)
+
+def run_vision_loop(cameras, startup, recognition_worker, gallery_sync, app_gui, args, stop_event, frame_event):
+    #Processing loop of all cameras, runs until stop_event is set or every camera stopped delivering frames.
+    #frame_event is set by the capture threads whenever a camera has a new frame.
+    #GUI calls from here (update_frame, add_student, prompt_for_info) are thread-safe, see AppGui
+    face_detection = None
+    gallery_sync_started = False
+    active_cameras = list(cameras)
+    while active_cameras and not stop_event.is_set():
+        if face_detection is None and startup.is_ready("detector"):
+            face_detection = startup.result("detector")
+        recognition_ready = (args.server or startup.is_ready("gallery")) and startup.is_ready("model")
+        if not gallery_sync_started and startup.is_ready("gallery"):
+            gallery_sync.start()
+            gallery_sync_started = True
+
+        # cameras are served round robin, each read returns the newest frame of that camera without waiting:
+        # a camera without a new frame is skipped for this pass, so a slow or stalled camera never holds up the others
+        frame_event.clear()
+        processed_frames = 0
+        for camera in list(active_cameras):
+            ret, frame, capture_time = camera.cap.read(timeout=0)
+            if not ret:
+                if not camera.cap.isOpened():
+                    logger.error(f"Error: Cannot read input of camera {camera.index} ({camera.source}).")
+                    active_cameras.remove(camera)
+                continue
+            # how long the frame waited between capture and processing
+            metrics.stage("capture").observe(time.time() - capture_time)
+            camera.process_frame(frame, capture_time, face_detection, recognition_ready,
+                                 recognition_worker, app_gui, args.metrics_overlay)
+            camera.cap.recycle(frame)
+            startup.mark_first_frame()
+            metrics.FRAMES_PROCESSED.inc()
+            processed_frames += 1
+
+        metrics.TRACKED_FACES.set(sum(camera.face_tracker.get_tracked_faces_count() for camera in cameras))
+        metrics.GALLERY_EMBEDDINGS.set(EmbeddedDb.size())
+        metrics.RECOGNITION_BACKLOG.set(recognition_worker.pending_jobs())
+
+        # a student seen by several cameras is listed once, AppGui.add_student de-duplicates
+        for result in recognition_worker.poll_results():
+            camera_index, face_id = result["id"]
+            handle_recognition_result(face_id, result, cameras[camera_index].face_tracker, app_gui, stop_event)
+
+        if not processed_frames:
+            # no camera had a new frame, sleep until one has (bounded so recognition results are still applied)
+            frame_event.wait(0.05)
+
+    if face_detection is not None:
+        face_detection.close()
+    if not stop_event.is_set():
+        # every camera stopped, close the window so that main() can clean up
+        app_gui.request_close()
+
+def main():
+    args = parse_args()
+    # with --metrics-port, Prometheus can scrape stage latencies, frame counters and queue sizes while the app runs
+    metrics_server = metrics.start_http_server(args.metrics_port) if args.metrics_port else None
+
+    # Gallery, detector and embedding model load in the background while the camera and the
+    # GUI come up on the main thread; the loop shows live video and only starts detecting and
+    # recognizing once the corresponding phase is ready
+    startup = StartupOrchestrator()
+    if args.server:
+        # thin client: the server embeds and matches, "model" then only waits for the server to answer
+        face_recognition.use_server(args.server)
+    else:
+        startup.submit("gallery", load_gallery, args.gallery_quantization, args.ann_nprobe if args.ann_index else None)
+    if args.detection_mode == "tiled":
+        rows, columns = args.tile_grid
+        startup.submit("detector", create_tiled_detector, rows, columns, args.tile_overlap, args.detection_workers)
+    else:
+        startup.submit("detector", create_face_detector)
+    startup.submit("model", face_recognition.warm_up)
+
+    # Initialize video capture, one capture thread per source
+    cameras = []
+    frame_event = threading.Event()
+    for index, source in enumerate(args.sources):
+        camera = startup.run(f"camera{index}", CameraPipeline, index, source,
+                             args.detection_mode, args.full_sweep_interval, frame_event)
+        camera.cap.start()
+        cameras.append(camera)
+    # initializing gui, one video view per camera and a single attendance list
+    # in thin client mode enrollments would only reach the station's own database, the server would never see them
+    app, app_gui = startup.run("gui", create_gui, len(cameras), not args.server)
+
+    # embedding and matching of all cameras run batched on this worker, results are applied on the vision thread
+    def on_batch_done(num_faces, seconds):
+        for camera in cameras:
+            camera.scheduler.record("embedding", seconds / num_faces)
+    # faces are matched against the session's group first, the whole gallery is only searched when that fails
+    session_group = app_gui.group if app_gui.group and app_gui.group != "Unknown" else None
+    recognition_worker = RecognitionWorker(on_batch_done=on_batch_done, group=session_group)
+    recognition_worker.start()
+    # picks up enrollments made by other stations once the gallery is loaded
+    gallery_sync = GallerySync()
+
+    # detection, tracking and recognition run on their own thread, the main thread only runs Qt:
+    # AppGui shows the newest frame at the display refresh rate and the two never wait for each other
+    stop_event = threading.Event()
+    vision_thread = threading.Thread(
+        target=run_vision_loop,
+        args=(cameras, startup, recognition_worker, gallery_sync, app_gui, args, stop_event, frame_event),
+        name="vision"
+    )
+    vision_thread.start()
+    app.exec_()
+
+    # window closed (or every camera stopped), a live registration prompt the vision thread still waits for
+    # will never be shown: it is answered with None so that the thread can finish
+    stop_event.set()
+    app_gui.cancel_prompts()
+    vision_thread.join()
+    recognition_worker.stop()
+    gallery_sync.stop()
+    for camera in cameras:
+        camera.cap.release()
+        logger.info(f"Capture {camera.index}: {camera.cap.frames_captured} frames captured, {camera.cap.dropped_frames} dropped")
+        logger.info(f"Scheduler {camera.index}: {camera.scheduler.summary()}")
+        if camera.region_detector is not None:
+            logger.info(f"Detection {camera.index}: {camera.region_detector.full_sweeps} of "
+                        f"{camera.region_detector.runs} runs on the full frame")
+        logger.info(f"Frame pools {camera.index}: {camera.cap.pool.allocations} capture and "
+                    f"{camera.rgb_pool.allocations} display arrays allocated")
+    if args.detection_mode == "tiled" and startup.is_ready("detector"):
+        logger.info(f"Tiled detection: {startup.result('detector').tile_summary()}")
+    if session_group is not None and not args.server:
+        logger.info(f"Group search: {EmbeddedDb.group_search_stats()}")
+    startup.shutdown()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import cv2
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+#Lightweight always-on metrics: counters, gauges and latency histograms kept in process,
+#exposed in the Prometheus text format over a local HTTP endpoint and optionally drawn on the video.
+#Recording a value is a lock plus a few additions, cheap enough for the per-frame hot path.
+
+# latency buckets in seconds, from sub-millisecond matching up to multi-second model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        #returns the child metric for these label values, created on first use
+        labelvalues = tuple(str(value) for value in labelvalues)
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels() if not self.labelnames else None
+
+    def _samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for labelvalues, child in children:
+            yield dict(zip(self.labelnames, labelvalues)), child
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._default().inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1.0):
+        self._default().inc(amount)
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            self.last = value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        #approximate quantile: upper bound of the bucket holding the q-th observation
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get_or_create(Counter, name, help_text, labelnames=labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._get_or_create(Gauge, name, help_text, labelnames=labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labelnames=labelnames, buckets=buckets)
+
+    def render_prometheus(self):
+        #Prometheus text exposition format (version 0.0.4)
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, child in metric._samples():
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), child.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{metric.name}_bucket{_format_labels(dict(labels, le=le))} {cumulative}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {child.sum}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {child.count}")
+                else:
+                    lines.append(f"{metric.name}{_format_labels(labels)} {child.value}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REGISTRY = Registry()
+
+# pipeline metrics shared by main.py, the capture thread and the recognition worker
+# stage "capture" is the age of a frame when the loop starts processing it
+STAGE_SECONDS = REGISTRY.histogram("mpface_stage_seconds", "Time spent per pipeline stage", ("stage",))
+FRAMES_CAPTURED = REGISTRY.counter("mpface_frames_captured_total", "Frames read from the camera")
+FRAMES_DROPPED = REGISTRY.counter("mpface_frames_dropped_total", "Captured frames that were never processed")
+FRAMES_PROCESSED = REGISTRY.counter("mpface_frames_processed_total", "Frames that went through the processing loop")
+TRACKED_FACES = REGISTRY.gauge("mpface_tracked_faces", "Faces currently tracked")
+GALLERY_EMBEDDINGS = REGISTRY.gauge("mpface_gallery_embeddings", "Embeddings in the in-memory gallery")
+RECOGNITION_BACKLOG = REGISTRY.gauge("mpface_recognition_backlog", "Crops waiting for the recognition worker")
+FACES_EMBEDDED = REGISTRY.counter("mpface_faces_embedded_total", "Face crops embedded by the model")
+RECOGNITIONS = REGISTRY.counter("mpface_recognitions_total", "Recognition results by outcome", ("outcome",))
+FRAME_ALLOCATIONS = REGISTRY.counter("mpface_frame_allocations_total", "Frame arrays allocated because no pooled one was free", ("pool",))
+DISPLAY_FRAMES_SKIPPED = REGISTRY.counter("mpface_display_frames_skipped_total", "Processed frames replaced before the display showed them")
+GROUP_SEARCHES = REGISTRY.counter("mpface_group_searches_total", "Group-first gallery searches by outcome (hit, fallback, unknown_group)", ("outcome",))
+TILE_DETECTION_SECONDS = REGISTRY.histogram("mpface_tile_detection_seconds", "Detector time per tile of the tiled detection", ("tile",))
+
+def stage(name):
+    #histogram child of STAGE_SECONDS, use as `with metrics.stage("detection").time():`
+    return STAGE_SECONDS.labels(name)
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the log
+        pass
+
+def start_http_server(port, host="127.0.0.1"):
+    #Serves /metrics on a daemon thread, returns the server (call shutdown() to stop it).
+    #Metrics are optional: when the port can not be bound (in use, no permission) the error is logged and None returned
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f"Metrics: could not serve on {host}:{port}, continuing without the endpoint: {e}")
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics: serving http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def draw_overlay(frame, stages=("capture", "detection", "tracking", "embedding", "matching", "rendering"), origin=(10, 60),
+                 color=(255, 255, 0)):
+    #draws the approximate p50/p99 latency of the given stages on the frame
+    x, y = origin
+    for name in stages:
+        child = STAGE_SECONDS.labels(name)
+        if child.count == 0:
+            continue
+        text = f"{name}: p50 {1000 * child.quantile(0.5):.1f}ms p99 {1000 * child.quantile(0.99):.1f}ms"
+        cv2.putText(frame, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        y += 20
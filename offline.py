@@ -0,0 +1,205 @@
+import os
+import cv2
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import Tracking
+import Recognition
+from embedded_db import EmbeddedDb
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mkv", ".mov", ".webm", ".m4v"}
+
+# per worker process state, set up once by _init_worker
+_face_detection = None
+
+def _init_worker(ann_nprobe=None):
+    #ann_nprobe = clusters scanned per query by the approximate index, None keeps the exact search
+    global _face_detection
+    setup_logger()
+    import mediapipe as mp
+    EmbeddedDb.populate_db()
+    if ann_nprobe:
+        EmbeddedDb.enable_ann_index(nprobe=ann_nprobe)
+    Recognition.warm_up()
+    _face_detection = mp.solutions.face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
+
+def find_videos(inputs):
+    #Expands directories (recursively) into the video files they contain.
+    #Returns (video path, result name) pairs: the name is the path relative to the input directory joined
+    #with "__" (week1/lecture.mp4 -> week1__lecture), so videos sharing a file name get distinct result files
+    videos = []
+    used_names = set()
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            found = [(p, "__".join(p.relative_to(path).with_suffix("").parts))
+                     for p in sorted(path.rglob("*")) if p.suffix.lower() in VIDEO_EXTENSIONS]
+        elif path.is_file():
+            found = [(path, path.stem)]
+        else:
+            logger.warning(f"offline: {item} does not exist, skipping")
+            continue
+        for video, name in found:
+            # the same relative path can still come from two inputs
+            unique_name = name
+            suffix = 2
+            while unique_name in used_names:
+                unique_name = f"{name}__{suffix}"
+                suffix += 1
+            used_names.add(unique_name)
+            videos.append((video, unique_name))
+    return videos
+
+def _recognize_best_faces(face_tracker, threshold, max_batch_size):
+    #embeds the new best crops of all unrecognized tracks in one batch and names the matched tracks
+    best_faces = {}
+    for face_data in face_tracker.get_all_tracked_faces_data():
+        if face_data["name"] is None and face_data["has_new_best_face"]:
+            best_faces[face_data["id"]] = Recognition.resize_face(face_tracker.take_best_face(face_data["id"]))
+    if not best_faces:
+        return 0
+    embeddings = Recognition.embed_faces(best_faces, max_batch_size)
+    face_ids = [face_id for face_id, embedding in embeddings.items() if embedding is not None]
+    all_matches = EmbeddedDb.search_batch([embeddings[face_id] for face_id in face_ids], k=1)
+    for face_id, matches in zip(face_ids, all_matches):
+        if matches and matches[0]["distance"] < threshold:
+            face_tracker.update_face_name_by_id(face_id, matches[0]["name"])
+    return len(face_ids)
+
+def process_video(video_path, detection_interval=3, threshold=0.6, max_batch_size=Recognition.EMBED_MAX_BATCH_SIZE):
+    #Runs detection, tracking and recognition over a whole video as fast as it decodes.
+    #Track timing follows the video clock, not the wall clock, so results do not depend on processing speed
+    face_tracker = Tracking.FaceTracker()
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        raise IOError(f"cannot open {video_path}")
+    video_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    students = {} # name -> attendance entry
+    frames = 0
+    faces = 0
+    embeddings = 0
+    start = time.perf_counter()
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        timestamp = frames / video_fps
+        if frames % detection_interval == 0:
+            results = _face_detection.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            detections = list(results.detections) if results.detections else []
+            faces += len(detections)
+            face_tracker.update_tracks(detections, frame.shape, timestamp)
+            Recognition.update_best_faces(frame, face_tracker)
+            embeddings += _recognize_best_faces(face_tracker, threshold, max_batch_size)
+            for face_data in face_tracker.get_all_tracked_faces_data():
+                name = face_data["name"]
+                if name is None:
+                    continue
+                if name not in students:
+                    students[name] = {
+                        "name": name,
+                        "group": EmbeddedDb.get()[name]["group"],
+                        "first_seen_s": timestamp,
+                        "last_seen_s": timestamp,
+                        "detections": 0
+                    }
+                students[name]["last_seen_s"] = timestamp
+                students[name]["detections"] += 1
+        else:
+            face_tracker.predict_tracks(frame.shape, timestamp)
+        frames += 1
+    cap.release()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "video": str(video_path),
+        "frames": frames,
+        "video_duration_s": frames / video_fps,
+        "processing_s": elapsed,
+        "frames_per_s": frames / elapsed if elapsed > 0 else 0.0,
+        "faces": faces,
+        "faces_per_s": faces / elapsed if elapsed > 0 else 0.0,
+        "embeddings": embeddings,
+        "attendance": sorted(students.values(), key=lambda entry: entry["first_seen_s"])
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless attendance over recorded lecture videos")
+    parser.add_argument("inputs", nargs="+", help="video files or directories containing videos")
+    parser.add_argument("-o", "--output-dir", default="attendance_results", help="where the per-video JSON files are written")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes, one video per worker at a time")
+    parser.add_argument("--detection-interval", type=int, default=3, help="run the detector every N frames, tracks are predicted in between")
+    parser.add_argument("--threshold", type=float, default=0.6, help="maximum cosine distance for a match")
+    parser.add_argument("--max-batch-size", type=int, default=Recognition.EMBED_MAX_BATCH_SIZE)
+    parser.add_argument("--ann-index", action="store_true",
+                        help="search galleries of 10000+ embeddings through the approximate IVF index: faster, but a few "
+                             "match decisions can change (check EmbeddedDb.ann_recall on your gallery first)")
+    parser.add_argument("--ann-nprobe", type=int, default=8, help="with --ann-index: clusters scanned per query, higher = closer to exact")
+    args = parser.parse_args(argv)
+    if args.detection_interval < 1:
+        parser.error("--detection-interval must be at least 1")
+    if args.ann_nprobe < 1:
+        parser.error("--ann-nprobe must be at least 1")
+
+    setup_logger()
+    videos = find_videos(args.inputs)
+    if not videos:
+        logger.error("offline: no videos found")
+        return 1
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    failures = []
+    workers = max(1, min(args.workers, len(videos)))
+    # TensorFlow does not survive fork(), so workers are spawned
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(args.ann_nprobe if args.ann_index else None,)) as executor:
+        futures = {
+            executor.submit(process_video, video, args.detection_interval, args.threshold, args.max_batch_size): (video, name)
+            for video, name in videos
+        }
+        for future in as_completed(futures):
+            video, name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"offline: {video} failed: {e}")
+                failures.append({"video": str(video), "error": str(e)})
+                continue
+            results.append(result)
+            with open(output_dir / f"{name}.attendance.json", "w") as f:
+                json.dump(result, f, indent=2)
+            logger.info(f"offline: {video} done, {result['frames_per_s']:.1f} frames/s, "
+                        f"{result['faces_per_s']:.1f} faces/s, {len(result['attendance'])} students")
+
+    elapsed = time.perf_counter() - start
+    total_frames = sum(result["frames"] for result in results)
+    total_faces = sum(result["faces"] for result in results)
+    summary = {
+        "videos": len(results),
+        "failures": failures,
+        "workers": workers,
+        "wall_time_s": elapsed,
+        "frames": total_frames,
+        "frames_per_s": total_frames / elapsed if elapsed > 0 else 0.0,
+        "faces": total_faces,
+        "faces_per_s": total_faces / elapsed if elapsed > 0 else 0.0,
+    }
+    with open(output_dir / "summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"offline: {len(results)} videos in {elapsed:.1f}s, {summary['frames_per_s']:.1f} frames/s overall")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import numpy as np
+
+from ann_index import normalize_rows
+
+#Compaction of the embeddings of one student into a few prototypes (see EmbeddedDb.compact).
+#Most captures of a student are near-duplicates around one appearance: they are replaced by their centroid.
+#Captures far from it (glasses, other lighting, a new haircut) are kept as extra prototypes, clustered
+#together when there are more of them than prototype slots.
+
+def build_prototypes(embeddings, max_prototypes=4, outlier_distance=0.3, iterations=5):
+    #embeddings = (n, dim) array, returns (normalized prototypes, number of embeddings each one stands for).
+    #outlier_distance = cosine distance to the centroid beyond which an embedding is not represented by it
+    embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    centroid = _mean_direction(embeddings)
+    inliers = np.ones(len(embeddings), dtype=bool)
+    for _ in range(iterations):
+        # the centroid of the inliers only, outliers would pull it away from the common appearance
+        inliers = 1.0 - embeddings @ centroid <= outlier_distance
+        if not inliers.any():
+            inliers[np.argmax(embeddings @ centroid)] = True
+        new_centroid = _mean_direction(embeddings[inliers])
+        if np.allclose(new_centroid, centroid):
+            break
+        centroid = new_centroid
+
+    outliers = embeddings[~inliers]
+    prototypes = [centroid]
+    counts = [int(inliers.sum())]
+    if len(outliers) <= max_prototypes - 1:
+        prototypes.extend(outliers)
+        counts.extend([1] * len(outliers))
+    elif max_prototypes > 1:
+        centers, sizes = _cluster(outliers, max_prototypes - 1, iterations)
+        prototypes.extend(centers)
+        counts.extend(sizes)
+    else:
+        counts[0] = len(embeddings)
+    return np.array(prototypes, dtype=np.float32), counts
+
+def _mean_direction(rows):
+    return normalize_rows(rows.mean(axis=0, keepdims=True))[0]
+
+def _cluster(rows, num_clusters, iterations):
+    #spherical k-means seeded with farthest points, returns (centers, sizes) of the non-empty clusters
+    centers = [rows[0]]
+    for _ in range(num_clusters - 1):
+        similarities = (rows @ np.array(centers).T).max(axis=1)
+        centers.append(rows[np.argmin(similarities)])
+    centers = np.array(centers)
+    for _ in range(iterations):
+        assignment = np.argmax(rows @ centers.T, axis=1)
+        centers = np.array([_mean_direction(rows[assignment == i]) if np.any(assignment == i) else centers[i]
+                            for i in range(num_clusters)])
+    assignment = np.argmax(rows @ centers.T, axis=1)
+    sizes = np.bincount(assignment, minlength=num_clusters)
+    return centers[sizes > 0], [int(size) for size in sizes if size > 0]
@@ -0,0 +1,69 @@
+import sys
+import json
+import logging
+import argparse
+
+import numpy as np
+
+from embedded_db import EmbeddedDb
+from quantized_gallery import QuantizedMatrix
+from logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+#Accuracy, memory and speed of the quantized gallery against the float32 scan, at the recognition threshold.
+#    python quantization_report.py                          # the enrolled gallery
+#    python quantization_report.py --synthetic 50000        # 50000 random students, 2 embeddings each
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Accuracy of the int8/float16 gallery against float32")
+    parser.add_argument("--modes", nargs="+", default=list(QuantizedMatrix.MODES), choices=QuantizedMatrix.MODES)
+    parser.add_argument("--threshold", type=float, default=0.6, help="cosine distance below which a match is accepted")
+    parser.add_argument("--rerank", type=int, default=32, help="rows re-scored in float32 per query")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.3, help="perturbation of the gallery rows used as queries")
+    parser.add_argument("--k", type=int, default=1)
+    parser.add_argument("--synthetic", type=int, metavar="STUDENTS", help="use a random gallery instead of the database")
+    parser.add_argument("--dim", type=int, default=128, help="embedding size of the synthetic gallery (Facenet: 128)")
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args(argv)
+    if args.k < 1:
+        parser.error("--k must be at least 1")
+
+    setup_logger()
+    if args.synthetic:
+        from benchmark import load_synthetic_gallery
+        load_synthetic_gallery(args.synthetic, 2, args.dim, np.random.default_rng(0))
+    else:
+        EmbeddedDb.populate_db()
+    if EmbeddedDb.size() == 0:
+        logger.error("quantization_report: the gallery is empty")
+        return 1
+
+    results = []
+    for mode in args.modes:
+        EmbeddedDb.enable_quantization(mode, args.rerank)
+        results.append(EmbeddedDb.quantization_accuracy(k=args.k, threshold=args.threshold,
+                                                        num_queries=args.queries, noise=args.noise))
+    EmbeddedDb.disable_quantization()
+
+    for result in results:
+        # the search is reported as it is measured: numpy has no int8/float16 matrix product, the quantized scan
+        # is usually slower than the float32 one and the gain is the memory kept resident
+        speed = (f"{result['speedup']:.2f}x faster" if result["speedup"] >= 1.0
+                 else f"{1.0 / result['speedup']:.2f}x SLOWER")
+        float32_rows = "mapped, paged in for the re-rank" if result["float32_mapped"] else "on the heap"
+        print(f"{result['mode']:>8}: decisions {100 * result['decision_agreement']:6.2f}% same at {result['threshold']}  "
+              f"recall@k {100 * result['recall_at_k']:6.2f}%  first pass error max {result['first_pass_max_distance_error']:.4f}  "
+              f"codes {result['quantized_mb']:.1f}MB + float32 {result['float32_mb']:.1f}MB ({float32_rows})  "
+              f"{result['quantized_ms_per_query']:.3f}ms vs {result['exact_ms_per_query']:.3f}ms per query, {speed} than float32",
+              file=sys.stderr)
+    output = json.dumps({"gallery": EmbeddedDb.size(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import numpy as np
+
+class QuantizedMatrix:
+    #Compact copy of the normalized gallery matrix for the first pass of a search.
+    #int8 stores every dimension as a signed byte with a per-dimension scale (4x smaller than float32),
+    #float16 halves the size and is nearly lossless. Scores computed from the codes are approximate,
+    #EmbeddedDb re-ranks the best candidates against the float32 rows.
+    #numpy has no int8 or float16 matrix product (its integer matmul does not use BLAS and is ~5x slower than
+    #the float32 one), so a scan is at best as fast as the float32 scan: the point is the memory held
+    #Rows are kept in the same order as the gallery matrix, so row i of both is the same embedding
+    MODES = ("int8", "float16")
+
+    def __init__(self, mode="int8", chunk_rows=1024):
+        #chunk_rows = rows widened at a time during a scan, into one float32 buffer that stays in the L2 cache
+        if mode not in self.MODES:
+            raise ValueError(f"QuantizedMatrix: unknown mode {mode!r}, expected one of {self.MODES}")
+        self.mode = mode
+        self.chunk_rows = chunk_rows
+        self.codes = np.empty((0, 0), dtype=self._dtype())
+        self.scale = None # int8 only: value of one code step per dimension
+        self.count = 0
+
+    def _dtype(self):
+        return np.int8 if self.mode == "int8" else np.float16
+
+    def build(self, matrix):
+        #quantizes all rows of the normalized gallery matrix
+        matrix = np.asarray(matrix, dtype=np.float32)
+        self.scale = None
+        self.codes = np.empty((0, matrix.shape[1] if matrix.ndim == 2 else 0), dtype=self._dtype())
+        self.count = 0
+        self.add(matrix, 0)
+
+    def _encode(self, rows):
+        if self.mode == "int8":
+            # rows added after build() may exceed the trained range, they are clipped (the re-rank is exact)
+            return np.clip(np.rint(rows / self.scale), -127, 127).astype(np.int8)
+        return rows.astype(np.float16)
+
+    def add(self, rows, start_row):
+        #stores the codes of new gallery rows starting at start_row, growing geometrically like the gallery
+        if not len(rows):
+            return
+        rows = np.asarray(rows, dtype=np.float32)
+        if self.mode == "int8" and self.scale is None:
+            # the range of each dimension is taken from the first rows quantized, but never below a few standard
+            # deviations of a unit vector component, so a gallery started from a single enrollment is not clipped
+            max_abs = np.maximum(np.abs(rows).max(axis=0), 4.0 / np.sqrt(rows.shape[1]))
+            self.scale = (max_abs / 127.0).astype(np.float32)
+        new_count = start_row + len(rows)
+        if self.codes.shape[1] != rows.shape[1]:
+            self.codes = np.empty((0, rows.shape[1]), dtype=self._dtype())
+        if new_count > len(self.codes):
+            codes = np.empty((max(new_count, 2 * len(self.codes), 64), rows.shape[1]), dtype=self._dtype())
+            codes[:start_row] = self.codes[:start_row]
+            self.codes = codes
+        self.codes[start_row:new_count] = self._encode(rows)
+        self.count = new_count
+
+    def move_row(self, source, destination):
+        #mirrors the swap-remove of the gallery (the last row takes the place of a removed one)
+        self.codes[destination] = self.codes[source]
+
+    def truncate(self, count):
+        self.count = count
+
+    def scores(self, queries, rows=None):
+        #approximate cosine similarities of the normalized queries against all rows (or the given rows),
+        #shape (len(queries), number of rows)
+        if self.mode == "int8":
+            # q . (code * scale) == (q * scale) . code, the scale is folded into the queries once
+            queries = queries * self.scale
+        codes = self.codes[:self.count] if rows is None else self.codes[rows]
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        # the same buffer is reused for every chunk: no allocation and page faults per chunk,
+        # and the widened rows are read by the product while they are still in cache
+        buffer = np.empty((min(self.chunk_rows, len(codes)), codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), self.chunk_rows):
+            chunk = codes[start:start + self.chunk_rows]
+            widened = buffer[:len(chunk)]
+            np.copyto(widened, chunk, casting="unsafe")
+            scores[:, start:start + len(chunk)] = queries @ widened.T
+        return scores
+
+    def nbytes(self):
+        #memory held by the codes of the current rows
+        scale_bytes = 0 if self.scale is None else self.scale.nbytes
+        return self.count * self.codes.shape[1] * self.codes.itemsize + scale_bytes
@@ -0,0 +1,86 @@
+import time
+import base64
+import logging
+
+import cv2
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+#HTTP client of recognition_server, used by the stations in thin client mode (see Recognition.use_server).
+#Face crops travel as base64 JPEG, a 224x224 crop is ~15kB instead of 150kB raw.
+
+JPEG_QUALITY = 95
+
+def encode_face(face):
+    ok, buffer = cv2.imencode(".jpg", face, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError("encode_face: could not encode the face crop")
+    return base64.b64encode(buffer.tobytes()).decode("ascii")
+
+def decode_face(data):
+    #BGR crop, None if data is not a valid image
+    try:
+        buffer = np.frombuffer(base64.b64decode(data), dtype=np.uint8)
+    except (ValueError, TypeError):
+        return None
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+class RecognitionClient:
+    def __init__(self, url, timeout=5.0):
+        #url = base URL of the server, e.g. http://127.0.0.1:5000
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        # keeps the connection open between requests
+        self._session = requests.Session()
+
+    def wait_until_ready(self, timeout=60.0):
+        #blocks until the server answers /health, returns its status
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.health()
+            except requests.RequestException as e:
+                if time.monotonic() > deadline:
+                    raise
+                logger.info(f"RecognitionClient: waiting for {self.url} ({e})")
+                time.sleep(1.0)
+
+    def health(self):
+        response = self._session.get(f"{self.url}/health", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def recognize(self, face_images, k=1, group=None):
+        #Embeds the crops and matches them against the server's gallery in one round trip,
+        #against the students of group first when it is given.
+        #Returns (embeddings, matches) aligned with face_images: embedding is None for crops that could not be
+        #embedded, matches is a list of {'name', 'group', 'distance'} as returned by EmbeddedDb.search_batch
+        if not face_images:
+            return [], []
+        valid_indices = [i for i, face in enumerate(face_images) if face is not None and face.size > 0]
+        embeddings = [None] * len(face_images)
+        matches = [[] for _ in face_images]
+        if not valid_indices:
+            return embeddings, matches
+        results = self.post_faces([encode_face(face_images[i]) for i in valid_indices], k, group)
+        for i, result in zip(valid_indices, results):
+            if result["embedding"] is not None:
+                embeddings[i] = np.asarray(result["embedding"], dtype=np.float32)
+            matches[i] = result["matches"]
+        return embeddings, matches
+
+    def post_faces(self, encoded_faces, k=1, group=None):
+        #sends already encoded crops (see encode_face), returns the server's {'embedding', 'matches', 'batch_size'} dicts
+        payload = {"faces": encoded_faces, "k": k}
+        if group is not None:
+            payload["group"] = group
+        response = self._session.post(f"{self.url}/recognize", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["results"]
+
+    def embed_faces(self, face_images):
+        return self.recognize(face_images, k=0)[0]
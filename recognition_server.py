@@ -0,0 +1,197 @@
+import sys
+import time
+import queue
+import logging
+import argparse
+import threading
+from concurrent.futures import Future
+
+from flask import Flask, Response, jsonify, request
+
+import metrics
+import Recognition
+from embedded_db import EmbeddedDb
+from gallery_sync import GallerySync
+from logger import setup_logger
+from recognition_client import decode_face
+
+logger = logging.getLogger(__name__)
+
+#Recognition service for thin client stations: one process holds the embedding model and the gallery,
+#stations POST face crops to /recognize (see recognition_client.RecognitionClient).
+#Requests arriving within batch_window of each other are embedded and matched as one micro-batch.
+#    python recognition_server.py --port 5000
+#    gunicorn -w 1 --threads 16 -b 0.0.0.0:5000 'recognition_server:create_app()'
+#Use a single worker process: every process loads its own model, concurrency comes from the threads.
+
+BATCH_SIZES = metrics.REGISTRY.histogram("mpface_server_batch_faces", "Faces per server micro-batch",
+                                         buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+REQUESTS = metrics.REGISTRY.counter("mpface_server_requests_total", "Recognition requests served")
+
+class _Request:
+    __slots__ = ("faces", "k", "group", "future")
+
+    def __init__(self, faces, k, group=None):
+        self.faces = faces
+        self.k = k
+        self.group = group
+        self.future = Future()
+
+class MicroBatcher:
+    #Collects the crops of concurrent requests into one embedding forward pass and one gallery search.
+    #A batch is closed batch_window seconds after its first request arrived or once it holds max_batch_size crops
+    def __init__(self, batch_window=0.005, max_batch_size=Recognition.EMBED_MAX_BATCH_SIZE):
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._requests = queue.Queue()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+    def submit(self, faces, k=1, group=None):
+        #returns a Future resolving to one {'embedding', 'matches', 'batch_size'} dict per face
+        #group = the station's class group, its students are matched first
+        batch_request = _Request(faces, k, group)
+        self._requests.put(batch_request)
+        return batch_request.future
+
+    def _next_batch(self):
+        try:
+            batch = [self._requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        num_faces = len(batch[0].faces)
+        deadline = time.perf_counter() + self.batch_window
+        while num_faces < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch_request = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(batch_request)
+            num_faces += len(batch_request.faces)
+        return batch
+
+    def _run(self):
+        while self._running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"MicroBatcher: batch of {len(batch)} requests failed: {e}")
+                for batch_request in batch:
+                    # requests answered before the failure keep their results
+                    if not batch_request.future.done():
+                        batch_request.future.set_exception(e)
+
+    def _process(self, batch):
+        faces = [face for batch_request in batch for face in batch_request.faces]
+        BATCH_SIZES.observe(len(faces))
+        with metrics.stage("embedding").time():
+            embeddings = Recognition.embed_faces(faces, self.max_batch_size)
+        valid = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        metrics.FACES_EMBEDDED.inc(len(valid))
+        k = max(batch_request.k for batch_request in batch)
+        # the requests of a batch may come from stations of different groups, one search per group
+        face_groups = [batch_request.group for batch_request in batch for _ in batch_request.faces]
+        matches_by_face = {}
+        if k > 0 and valid:
+            with metrics.stage("matching").time():
+                for group in set(face_groups[i] for i in valid):
+                    indices = [i for i in valid if face_groups[i] == group]
+                    all_matches = EmbeddedDb.search_batch([embeddings[i] for i in indices], k=k, group=group)
+                    matches_by_face.update(zip(indices, all_matches))
+
+        start = 0
+        for batch_request in batch:
+            results = []
+            for i in range(start, start + len(batch_request.faces)):
+                results.append({
+                    "embedding": None if embeddings[i] is None else embeddings[i].tolist(),
+                    "matches": matches_by_face.get(i, [])[:batch_request.k],
+                    "batch_size": len(faces)
+                })
+            start += len(batch_request.faces)
+            batch_request.future.set_result(results)
+
+def create_app(batch_window=0.005, max_batch_size=Recognition.EMBED_MAX_BATCH_SIZE, request_timeout=10.0, load=True,
+               quantization=None, ann_nprobe=None):
+    #load = load the gallery and the model before serving (the load test reuses an already loaded process)
+    #quantization = "int8" or "float16" to search a compact copy of the gallery first, see EmbeddedDb.enable_quantization
+    #ann_nprobe = clusters scanned per query by the approximate index, None keeps the exact search
+    setup_logger()
+    if load:
+        EmbeddedDb.populate_db()
+        if ann_nprobe:
+            EmbeddedDb.enable_ann_index(nprobe=ann_nprobe)
+        if quantization:
+            EmbeddedDb.enable_quantization(quantization)
+        Recognition.warm_up()
+        # stations enroll into the shared database, the server picks their embeds up
+        GallerySync().start()
+    batcher = MicroBatcher(batch_window, max_batch_size)
+    batcher.start()
+
+    app = Flask(__name__)
+    app.config["batcher"] = batcher
+
+    @app.get("/health")
+    def health():
+        return jsonify({"status": "ok", "gallery": EmbeddedDb.size(), "model": Recognition.EMBEDDING_MODEL_NAME,
+                        "batch_window": batcher.batch_window, "group_search": EmbeddedDb.group_search_stats()})
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.REGISTRY.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    @app.post("/recognize")
+    def recognize():
+        #body {"faces": [base64 JPEG, ...], "k": 1, "group": optional}, answers {"results": [{"embedding", "matches", "batch_size"}, ...]}
+        payload = request.get_json(silent=True)
+        if not payload or not isinstance(payload.get("faces"), list):
+            return jsonify({"error": "expected a JSON body with a 'faces' list"}), 400
+        k = payload.get("k", 1)
+        if isinstance(k, bool) or not isinstance(k, int) or k < 0:
+            return jsonify({"error": "'k' must be a non-negative integer"}), 400
+        faces = [decode_face(data) for data in payload["faces"]]
+        REQUESTS.inc()
+        if not faces:
+            return jsonify({"results": []})
+        future = batcher.submit(faces, k, payload.get("group"))
+        return jsonify({"results": future.result(timeout=request_timeout)})
+
+    return app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recognition server for thin client stations")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--batch-window", type=float, default=0.005, help="seconds a micro-batch waits for more requests")
+    parser.add_argument("--max-batch-size", type=int, default=Recognition.EMBED_MAX_BATCH_SIZE)
+    parser.add_argument("--gallery-quantization", choices=("int8", "float16"), help="search a quantized copy of the gallery first (less memory, not faster)")
+    parser.add_argument("--ann-index", action="store_true",
+                        help="search galleries of 10000+ embeddings through the approximate IVF index: faster, but a few "
+                             "match decisions can change (check EmbeddedDb.ann_recall on your gallery first)")
+    parser.add_argument("--ann-nprobe", type=int, default=8, help="with --ann-index: clusters scanned per query, higher = closer to exact")
+    args = parser.parse_args(argv)
+    if args.ann_nprobe < 1:
+        parser.error("--ann-nprobe must be at least 1")
+    app = create_app(args.batch_window, args.max_batch_size, quantization=args.gallery_quantization,
+                     ann_nprobe=args.ann_nprobe if args.ann_index else None)
+    # one thread per request, the requests meet in the micro-batcher
+    app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
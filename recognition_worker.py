@@ -0,0 +1,104 @@
+import time
+import queue
+import logging
+import threading
+
+import metrics
+import Recognition
+from embedded_db import EmbeddedDb
+
+logger = logging.getLogger(__name__)
+
+class RecognitionWorker:
+    #Runs embedding and gallery matching on a background thread so that the capture loop never waits for the model.
+    #The loop submits face crops keyed by track ID and collects finished results with poll_results().
+    #Jobs waiting in the queue are embedded together (up to max_batch_size crops per forward pass)
+    def __init__(self, max_batch_size=Recognition.EMBED_MAX_BATCH_SIZE, k=1, on_batch_done=None, group=None):
+        #on_batch_done = optional callback(num_faces, seconds) called from the worker thread after every batch
+        #group = group expected in the session, matched first before the whole gallery (see EmbeddedDb.search_batch)
+        self.max_batch_size = max_batch_size
+        self.k = k
+        self.group = group
+        self.on_batch_done = on_batch_done
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="recognition", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+    def submit(self, face_id, face_image):
+        self._jobs.put((face_id, face_image))
+
+    def pending_jobs(self):
+        return self._jobs.qsize()
+
+    def poll_results(self):
+        #Returns every result finished since the last call, without blocking.
+        #Each result is a dict {'id', 'face', 'embedding', 'matches'}; embedding is None if the crop could not be embedded
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def _next_batch(self):
+        try:
+            jobs = [self._jobs.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        while len(jobs) < self.max_batch_size:
+            try:
+                jobs.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _recognize_locally(self, jobs):
+        #returns (embeddings aligned with jobs, {job index: matches})
+        with metrics.stage("embedding").time():
+            embeddings = Recognition.embed_faces([face for _, face in jobs], self.max_batch_size)
+        valid = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        metrics.FACES_EMBEDDED.inc(len(valid))
+        with metrics.stage("matching").time():
+            all_matches = EmbeddedDb.search_batch([embeddings[i] for i in valid], k=self.k, group=self.group)
+        return embeddings, dict(zip(valid, all_matches))
+
+    def _run(self):
+        while self._running:
+            jobs = self._next_batch()
+            if not jobs:
+                continue
+            start = time.perf_counter()
+            client = Recognition.get_client()
+            try:
+                if client is not None:
+                    # thin client: the server embeds and matches the whole batch in one round trip
+                    with metrics.stage("embedding").time():
+                        embeddings, all_matches = client.recognize([face for _, face in jobs], self.k, self.group)
+                    metrics.FACES_EMBEDDED.inc(sum(embedding is not None for embedding in embeddings))
+                    matches_by_job = dict(enumerate(all_matches))
+                else:
+                    embeddings, matches_by_job = self._recognize_locally(jobs)
+            except Exception as e:
+                logger.error(f"RecognitionWorker: recognition failed for {len(jobs)} faces: {e}")
+                embeddings = [None] * len(jobs)
+                matches_by_job = {}
+            if self.on_batch_done is not None:
+                self.on_batch_done(len(jobs), time.perf_counter() - start)
+            for i, (face_id, face) in enumerate(jobs):
+                self._results.put({
+                    "id": face_id,
+                    "face": face,
+                    "embedding": embeddings[i],
+                    "matches": matches_by_job.get(i, [])
+                })
@@ -0,0 +1,96 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+class StageScheduler:
+    #Decides for every frame which pipeline stages to run, based on how long each stage actually takes.
+    #Stage costs are tracked as exponential moving averages. Detection runs every detection_interval frames,
+    #the interval grows when the detector does not fit in the frame budget or the scene is static,
+    #and shrinks back as soon as faces move or appear. Recognition jobs are submitted at once for new
+    #unrecognized tracks and retried for unmatched ones so that a face is recognized within max_time_to_recognition
+    def __init__(self, target_fps=25.0, max_time_to_recognition=1.0, max_detection_interval=10,
+                 static_motion_threshold=0.02, smoothing=0.2):
+        #target_fps = display rate the loop tries to sustain
+        #max_time_to_recognition = seconds within which an unrecognized face should reach the model
+        #static_motion_threshold = mean face speed (frame widths per second) under which the scene counts as static
+        self.target_fps = target_fps
+        self.max_time_to_recognition = max_time_to_recognition
+        self.max_detection_interval = max_detection_interval
+        self.static_motion_threshold = static_motion_threshold
+        self.smoothing = smoothing
+        self.costs = {} # stage -> average seconds
+        self.detection_interval = 1
+        self._frames_since_detection = max_detection_interval # detect on the first frame
+        self._last_recognition_time = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage):
+        #times a stage of the loop, feeding both the scheduler and the stage latency metrics
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.record(stage, elapsed)
+            metrics.stage(stage).observe(elapsed)
+
+    def record(self, stage, seconds):
+        #thread-safe, the recognition worker reports embedding cost from its own thread
+        with self._lock:
+            previous = self.costs.get(stage)
+            self.costs[stage] = seconds if previous is None else (1 - self.smoothing) * previous + self.smoothing * seconds
+
+    def cost(self, stage):
+        with self._lock:
+            return self.costs.get(stage, 0.0)
+
+    def plan_frame(self, new_unrecognized, retry_unrecognized, recognition_backlog, motion_level, now=None):
+        #new_unrecognized = tracks never sent to recognition, retry_unrecognized = tracks sent before but not matched
+        #recognition_backlog = jobs waiting in the recognition worker, motion_level = FaceTracker.get_motion_level()
+        #returns {'detect': bool, 'recognize': bool}
+        now = now if now is not None else time.time()
+        needed_interval = self._budget_detection_interval()
+        moving = new_unrecognized > 0 or motion_level > self.static_motion_threshold
+        if moving:
+            self.detection_interval = needed_interval
+        self._frames_since_detection += 1
+        detect = self._frames_since_detection >= self.detection_interval
+        if detect:
+            self._frames_since_detection = 0
+            if not moving:
+                # nothing moves: back off detection a little more after every sweep
+                self.detection_interval = min(max(needed_interval, 2 * self.detection_interval), self.max_detection_interval)
+
+        # how long the worker needs for what is already queued
+        backlog_time = recognition_backlog * self.cost("embedding")
+        recognize = False
+        if backlog_time < self.max_time_to_recognition:
+            if new_unrecognized:
+                recognize = True
+            elif retry_unrecognized:
+                retry_interval = min(self.max_time_to_recognition, max(0.2, 2 * backlog_time))
+                recognize = now - self._last_recognition_time >= retry_interval
+        if recognize:
+            self._last_recognition_time = now
+        return {"detect": detect, "recognize": recognize}
+
+    def _budget_detection_interval(self):
+        #smallest interval at which the detector cost, spread over the frames, still fits the frame budget
+        budget = 1.0 / self.target_fps
+        per_frame_cost = self.cost("tracking") + self.cost("rendering") + self.cost("recognition")
+        detection_cost = self.cost("detection")
+        spare = budget - per_frame_cost
+        if detection_cost <= 0:
+            return 1
+        if spare <= 0:
+            return self.max_detection_interval
+        return int(min(max(math.ceil(detection_cost / spare), 1), self.max_detection_interval))
+
+    def summary(self):
+        with self._lock:
+            costs = ", ".join(f"{stage}={1000 * seconds:.1f}ms" for stage, seconds in self.costs.items())
+        return f"detection every {self.detection_interval} frames ({costs})"
@@ -0,0 +1,72 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class StartupOrchestrator:
+    #Runs the independent startup phases (gallery, detector, embedding model...) concurrently
+    #and records how long each phase took, so the camera feed can come up before everything is loaded.
+    #Phases that must stay on the main thread (camera, Qt widgets) are timed with run()
+    def __init__(self, max_workers=3):
+        self.start_time = time.perf_counter()
+        self.timings = {} # phase name -> seconds spent in the phase
+        self.first_frame_time = None
+        self._summary_logged = False
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="startup")
+
+    def submit(self, phase, fn, *args, **kwargs):
+        #starts a phase in the background and returns its future
+        future = self._executor.submit(self._timed, phase, fn, *args, **kwargs)
+        self._futures[phase] = future
+        future.add_done_callback(lambda _: self._on_phase_done())
+        return future
+
+    def run(self, phase, fn, *args, **kwargs):
+        #runs a phase on the calling thread
+        return self._timed(phase, fn, *args, **kwargs)
+
+    def is_ready(self, phase):
+        future = self._futures.get(phase)
+        return future is not None and future.done() and future.exception() is None
+
+    def result(self, phase, timeout=None):
+        return self._futures[phase].result(timeout)
+
+    def mark_first_frame(self):
+        #called when the first camera frame reaches the screen
+        if self.first_frame_time is None:
+            self.first_frame_time = time.perf_counter() - self.start_time
+            logger.info(f"Startup: time to first frame {self.first_frame_time:.2f}s")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _timed(self, phase, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Startup: phase '{phase}' failed: {e}")
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[phase] = elapsed
+            logger.info(f"Startup: phase '{phase}' took {elapsed:.2f}s")
+
+    def _on_phase_done(self):
+        with self._lock:
+            if self._summary_logged or not all(future.done() for future in self._futures.values()):
+                return
+            self._summary_logged = True
+        self.log_summary()
+
+    def log_summary(self):
+        with self._lock:
+            breakdown = ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in self.timings.items())
+        total = time.perf_counter() - self.start_time
+        logger.info(f"Startup: all phases done after {total:.2f}s ({breakdown})")
@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, select, text
+
+#Checks the change log state machine: embeds added, deleted and updated by another station reach EmbeddedDb
+#through sync(), and the swap-removes keep the gallery rows, their labels and embed ids, the quantized codes
+#and the ANN lists in step with the database.
+#    python -m pytest -q test_gallery_sync.py
+
+DIM = 16
+
+@pytest.fixture(params=["exact", "int8", "ann"])
+def gallery(request, tmp_path, monkeypatch):
+    # importing db creates db.sqlite in the working directory, keep it out of the repository
+    monkeypatch.chdir(tmp_path)
+    import db
+    from embedded_db import EmbeddedDb
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'gallery.sqlite'}")
+    db.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for trigger in db._CHANGE_LOG_TRIGGERS:
+            connection.execute(text(trigger))
+    db.Session.configure(bind=engine)
+
+    if request.param == "int8":
+        EmbeddedDb.enable_quantization("int8")
+    elif request.param == "ann":
+        # min_size=1 so the tiny test gallery goes through the index
+        EmbeddedDb.enable_ann_index(min_size=1, path=str(tmp_path / "gallery.ivf.npz"))
+    yield db, EmbeddedDb, tmp_path / "gallery.snapshot"
+    EmbeddedDb.disable_quantization()
+    EmbeddedDb.disable_ann_index()
+    db.Session.configure(bind=db.engine)
+
+def _vector(rng):
+    return rng.standard_normal(DIM).astype(np.float32)
+
+def _add_student(db, session, name, vectors):
+    student = db.Student(name=name, group="g")
+    session.add(student)
+    for vector in vectors:
+        session.add(db.Embed(student=student, embedding=vector.tobytes()))
+    return student
+
+def _wait_for_ann_retrain(EmbeddedDb, timeout=10.0):
+    deadline = time.time() + timeout
+    while EmbeddedDb._ann_training and time.time() < deadline:
+        time.sleep(0.01)
+    assert not EmbeddedDb._ann_training
+
+def _assert_gallery_matches_db(db, EmbeddedDb):
+    with db.Session() as session:
+        rows = session.execute(select(db.Embed.id, db.Student.name, db.Embed.embedding).join(db.Student)).all()
+    expected = {}
+    for embed_id, name, blob in rows:
+        vector = np.frombuffer(blob, dtype=np.float32)
+        expected[embed_id] = (name, vector / np.linalg.norm(vector))
+
+    count = EmbeddedDb.size()
+    embed_ids = EmbeddedDb._embed_ids[:count]
+    assert sorted(embed_ids.tolist()) == sorted(expected)
+    for row, embed_id in enumerate(embed_ids.tolist()):
+        name, vector = expected[embed_id]
+        assert EmbeddedDb._names[EmbeddedDb._labels[row]] == name
+        np.testing.assert_allclose(EmbeddedDb._matrix[row], vector, atol=1e-6)
+
+    if EmbeddedDb._quantized is not None:
+        # row i of the codes is still row i of the matrix after the swap-removes
+        assert EmbeddedDb._quantized.count == count
+        self_scores = EmbeddedDb._quantized.scores(EmbeddedDb._matrix[:count]).diagonal()
+        np.testing.assert_allclose(self_scores, 1.0, atol=0.05)
+    if EmbeddedDb._ann_index is not None:
+        _wait_for_ann_retrain(EmbeddedDb)
+        assert EmbeddedDb._use_ann_index()
+        listed = np.sort(np.concatenate(EmbeddedDb._ann_index.lists))
+        np.testing.assert_array_equal(listed, np.arange(count))
+
+    # every stored embedding finds its own student, whichever search path is on
+    for name, vector in expected.values():
+        assert EmbeddedDb.search(vector)[0]["name"] == name
+
+def test_sync_applies_adds_deletes_and_updates(gallery):
+    db, EmbeddedDb, snapshot_path = gallery
+    rng = np.random.default_rng(0)
+    with db.Session() as session:
+        alice = _add_student(db, session, "alice", [_vector(rng) for _ in range(3)])
+        bob = _add_student(db, session, "bob", [_vector(rng) for _ in range(2)])
+        session.commit()
+        alice_ids = [embed.id for embed in alice.embeds]
+        bob_ids = [embed.id for embed in bob.embeds]
+    EmbeddedDb.populate_db(str(snapshot_path))
+    _assert_gallery_matches_db(db, EmbeddedDb)
+
+    # another station: new embed, new student, a delete of a row that is not the last one and an update
+    with db.Session() as session:
+        session.add(db.Embed(student_id=bob.id, embedding=_vector(rng).tobytes()))
+        _add_student(db, session, "carol", [_vector(rng) for _ in range(2)])
+        session.delete(session.get(db.Embed, alice_ids[0]))
+        session.get(db.Embed, bob_ids[0]).embedding = _vector(rng).tobytes()
+        session.commit()
+    # this station registers a face live: stored and added at once, sync must not add it twice
+    with db.Session() as session:
+        dave = _add_student(db, session, "dave", [_vector(rng)])
+        session.commit()
+        dave_embed = dave.embeds[0]
+        EmbeddedDb.add_to_embedded_db("dave", "g", np.frombuffer(dave_embed.embedding, dtype=np.float32), dave_embed.id)
+
+    added, removed = EmbeddedDb.sync()
+    assert (added, removed) == (4, 2)
+    _assert_gallery_matches_db(db, EmbeddedDb)
+
+    # a whole student removed: every one of its rows is swap-removed in one sync
+    with db.Session() as session:
+        session.delete(session.query(db.Student).filter_by(name="carol").one())
+        session.commit()
+    assert EmbeddedDb.sync() == (0, 2)
+    _assert_gallery_matches_db(db, EmbeddedDb)
+    assert EmbeddedDb.sync() == (0, 0)